@@ -54,7 +54,7 @@ function appendMessage(sender, text = "", loading = false) {
     
     // *** KHẮC PHỤC LỖI CUỘN ***
     // Chỉ cuộn xuống cuối khi tin nhắn mới được thêm vào, 
-    // không cuộn trong quá trình gõ chữ (typeText)
+    // không cuộn trong quá trình nhận stream
     if (!loading) {
         chatContainer.scrollTop = chatContainer.scrollHeight;
     }
@@ -64,19 +64,41 @@ function appendMessage(sender, text = "", loading = false) {
 // Biến toàn cục để lưu trữ tin nhắn đang tải (loading message)
 let currentLoadingMsg = null; 
 
-// --- TYPE TEXT EFFECT (Đã sửa lỗi thêm chữ Dừng lặp lại) ---
-async function typeText(element, text, speed = 30) {
-    element.textContent = "";
-    // Vòng lặp gõ chữ chỉ thêm từng ký tự
-    for (let char of text) {
-        // Nếu request bị hủy, DỪNG GÕ chữ NGAY LẬP TỨC
-        if (abortController && abortController.signal.aborted) {
-            return; // KHÔNG thêm bất kỳ chữ nào ở đây
+// --- READ NDJSON STREAM (/ask_stream) ---
+// Mỗi dòng là một sự kiện: meta (model), token (đoạn chữ mới), done (câu trả lời đầy đủ)
+async function readAnswerStream(res, element) {
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let prefix = "";
+    let answer = "";
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let newline;
+        while ((newline = buffer.indexOf("\n")) >= 0) {
+            const line = buffer.slice(0, newline).trim();
+            buffer = buffer.slice(newline + 1);
+            if (!line) continue;
+
+            const event = JSON.parse(line);
+            if (event.type === "meta") {
+                prefix = `(${event.model}) `;
+            } else if (event.type === "token") {
+                answer += event.content;
+            } else if (event.type === "done") {
+                answer = event.answer;
+            } else if (event.type === "error") {
+                // Server dừng lượt sinh (quá hạn) -> giữ phần đã nhận và báo lỗi
+                answer += (answer ? "\n" : "") + event.error;
+            }
+            element.className = "ai-msg";
+            element.textContent = prefix + answer;
         }
-        element.textContent += char;
-        await new Promise(r => setTimeout(r, speed));
     }
-    // Sau khi gõ xong, cuộn xuống cuối để hiển thị kết quả hoàn chỉnh
     chatContainer.scrollTop = chatContainer.scrollHeight;
 }
 
@@ -96,7 +118,7 @@ async function sendQuestion() {
     currentLoadingMsg = loadingMsg; // Lưu lại reference của loading message
 
     try {
-        const res = await fetch("http://127.0.0.1:8000/ask", {
+        const res = await fetch("http://127.0.0.1:8000/ask_stream", {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({ session_id: sessionId, question }),
@@ -104,10 +126,14 @@ async function sendQuestion() {
         });
         
         if (res.ok) {
-            const data = await res.json();
-            await typeText(loadingMsg, `(${data.model}) ${data.answer}`);
-            // typeText đã hoàn thành, không cần thêm class loading nữa
+            // Hiển thị token ngay khi server gửi về, không chờ cả câu trả lời
+            await readAnswerStream(res, loadingMsg);
             loadingMsg.className = "ai-msg"; 
+        } else if (res.status === 429 || res.status === 503) {
+            // Server từ chối nhanh khi model quá tải
+            const retryAfter = res.headers.get("Retry-After") || "vài";
+            loadingMsg.className = "ai-msg";
+            loadingMsg.textContent = `AI đang quá tải, vui lòng thử lại sau ${retryAfter} giây.`;
         } else {
             loadingMsg.className = "ai-msg";
             loadingMsg.textContent = `Lỗi Server: ${res.status}. Vui lòng kiểm tra lại Server Python.`;
@@ -128,7 +154,7 @@ async function sendQuestion() {
             // Nếu request bị hủy
             if (currentLoadingMsg) {
                  // Đảm bảo nội dung chỉ là "Quá trình tạo phản hồi đã dừng."
-                 // hoặc thêm vào cuối nếu đã có chữ nào đó từ typeText
+                 // hoặc thêm vào cuối nếu đã có chữ nào đó từ stream
                  if (currentLoadingMsg.textContent === "AI đang trả lời...") {
                      currentLoadingMsg.textContent = "";
                  } else if (!currentLoadingMsg.textContent.includes("(Dừng)")) {
@@ -137,7 +163,7 @@ async function sendQuestion() {
                  currentLoadingMsg.className = "ai-msg error-msg"; // Tắt nhấp nháy, có thể đổi màu nếu muốn
             }
         } else if (currentLoadingMsg && currentLoadingMsg.className.includes("loading")) {
-             // Nếu không bị hủy, nhưng vẫn còn trạng thái loading (ví dụ: typeText chưa kịp hoàn tất)
+             // Nếu không bị hủy, nhưng vẫn còn trạng thái loading (ví dụ: stream rỗng)
              currentLoadingMsg.className = "ai-msg"; 
         }
         
@@ -1,41 +1,112 @@
 import os
 import asyncio
+import shutil
 import logging
 import math
-import hashlib 
+from collections import Counter
 from datetime import datetime, timedelta
 from typing import Any, List, Dict 
+from dataclasses import dataclass, field
 import json 
 
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from langdetect import detect
+
+from Train.session_store import create_session_store
+from Train.semantic_cache import SemanticReplyCache
+from Train.reply_cache import ExactReplyCache
+from Train.router import ComplexityRouter
+from Train.lang_detect import detect_language_fast, detect_language_for_session
+from Train.singleflight import SingleFlight
+from Train.admission import AdmissionRejected, all_stats as admission_stats, get_limiter
+from Train.history import HistoryManager
+from Train.prompt_builder import LANGUAGE_DIRECTIVES, prompt_stats
+from Train.cascade import CascadePolicy
+from Train.load_governor import TierGovernor
+from Train.cancellation import ClientDisconnected, DeadlineExceeded, abort_stats, iterate_with_deadline, run_until_disconnected
+from Train.mindmap_cache import MindmapCache, mindmap_payload, normalize_mindmap_text, normalize_ocr_text, text_cache_key
+from Train.perceptual_hash import image_hashes
+from Train.upload_spool import SpooledUpload, UploadSizeLimit, UploadTooLarge, spool_upload
+from Train.mindmap_jobs import JobQueueFull, MindmapJobs
 
 # ----------------- MODULES -----------------
 try:
     # Cần đảm bảo các module này tồn tại hoặc được mock
-    from Train.model_gemma_pro_chat import call_gemma_pro_chat
-    from Train.model_gemma_small_chat import call_gemma__small_chat
-    from Train.model_llava import call_mindmap_generation # Dùng phiên bản đã sửa
+    from Train.model_gemma_pro_chat import call_gemma_pro_chat, stream_gemma_pro_chat, MODEL_NAME as PRO_MODEL_NAME
+    from Train.model_gemma_small_chat import call_gemma__small_chat, call_gemma__small_chat_scored, call_gemma__small_summary, stream_gemma__small_chat, MODEL_NAME as SMALL_MODEL_NAME
+    from Train.model_llava import call_mindmap_generation, read_image_text, MODEL_NAME as LLAVA_MODEL_NAME # Dùng phiên bản đã sửa
+    from Train.model_llava import call_mindmap_generation_from_text, pipeline_fingerprint as mindmap_pipeline_fingerprint
+    from Train.ollama_client import close_client, embed, flight as model_flight, warm_up, resident_models, keep_alive_policy
+    from Train.ollama_client import host_stats, start_health_checks
+    CHAT_MODEL_NAMES = [SMALL_MODEL_NAME, PRO_MODEL_NAME]
+    TIER_MODEL_NAMES = {"small": SMALL_MODEL_NAME, "pro": PRO_MODEL_NAME}
+    AI_MODEL_NAMES = CHAT_MODEL_NAMES + [LLAVA_MODEL_NAME]
 except ImportError as e:
     logging.error(f"Error importing AI modules: {e}. Using local mocks.")
-    def call_gemma_pro_chat(messages):
+    async def call_gemma_pro_chat(messages, num_predict=None):
         logging.info("Calling mock gemma pro...")
         last_user_message = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), "Hello!")
         return f"Mock Pro: I am running in mock mode. You asked: {last_user_message}" 
 
-    def call_gemma__small_chat(messages):
+    async def call_gemma__small_chat(messages):
         logging.info("Calling mock gemma small...")
         last_user_message = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), "Hello!")
         return f"Mock Small: I am running in mock mode. You asked: {last_user_message}"
+
+    async def call_gemma__small_chat_scored(messages):
+        return await call_gemma__small_chat(messages), None
+
+    async def call_gemma__small_summary(messages):
+        return "Mock Small: summary of the conversation."
+
+    async def stream_gemma_pro_chat(messages, num_predict=None):
+        for word in (await call_gemma_pro_chat(messages)).split(" "):
+            yield word + " "
+
+    async def stream_gemma__small_chat(messages):
+        for word in (await call_gemma__small_chat(messages)).split(" "):
+            yield word + " "
     
-    def call_mindmap_generation(input_data: Any) -> List[Any]:
+    async def call_mindmap_generation(input_data: Any, on_stage=None, ocr_lines=None) -> List[Any]:
         # SỬA MOCK: Đảm bảo nodes mock KHÔNG CÓ x, y 
         return ["Mock Topic - Document Analysis (English)", [{"text": "Mock Node Main", "children": [{"text": "Mock Child Node"}], "id": "m1"}]]
 
+    async def read_image_text(image_path: str):
+        return None
+
+    async def call_mindmap_generation_from_text(text: str, on_stage=None) -> List[Any]:
+        return ["Mock Topic - Text Analysis (English)", [{"text": "Mock Node Main", "children": [{"text": "Mock Child Node"}], "id": "m1"}]]
+
+    def mindmap_pipeline_fingerprint():
+        return "mock"
+
+    async def close_client():
+        pass
+
+    embed = None # Không có Ollama -> không bật semantic cache
+    model_flight = None
+    CHAT_MODEL_NAMES = []
+    TIER_MODEL_NAMES = {}
+    AI_MODEL_NAMES = []
+
+    async def warm_up(model):
+        pass
+
+    async def resident_models():
+        return {}
+
+    def keep_alive_policy():
+        return {}
+
+    def host_stats():
+        return {}
+
+    def start_health_checks():
+        pass
+
 
 # ----------------- APP INIT -----------------
 app = FastAPI()
@@ -48,6 +119,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc: AdmissionRejected):
+    # Trả lời nhanh khi model quá tải thay vì để request treo nhiều phút
+    return JSONResponse(
+        {"error": f"Model {exc.model} đang quá tải ({exc.reason}). Vui lòng thử lại sau.", "retry_after": exc.retry_after},
+        status_code=exc.status_code,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request, exc: ClientDisconnected):
+    # Client đã đi, không ai đọc phản hồi này (499 theo quy ước của nginx để phân biệt trong log)
+    return Response(status_code=499)
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request, exc: DeadlineExceeded):
+    return JSONResponse({"error": f"Quá thời gian xử lý ({exc.deadline:g}s). Vui lòng thử lại."}, status_code=504)
+
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large_handler(request, exc: UploadTooLarge):
+    return JSONResponse({"error": f"File quá lớn (tối đa {exc.limit // (1024 * 1024)} MB)."}, status_code=413)
+
+# Giới hạn kích thước file upload cho mindmap (byte)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+
+# Từ chối theo Content-Length trước khi FastAPI đọc và parse cả body multipart
+app.add_middleware(UploadSizeLimit, paths=("/generate_mindmap", "/mindmap_jobs"), max_bytes=MAX_UPLOAD_BYTES)
+
+# Hạn chót (giây) cho từng endpoint, gồm cả thời gian xếp hàng chờ model
+ASK_DEADLINE = float(os.getenv("ASK_DEADLINE", "240"))
+ASK_STREAM_DEADLINE = float(os.getenv("ASK_STREAM_DEADLINE", "300"))
+MINDMAP_DEADLINE = float(os.getenv("MINDMAP_DEADLINE", "900"))
+
 if os.path.exists("Css"):
     app.mount("/Css", StaticFiles(directory="Css"), name="Css")
 if os.path.exists("Js"):
@@ -56,9 +160,107 @@ if os.path.exists("Js"):
 os.makedirs("tmp_files", exist_ok=True)
 
 # ----------------- CACHE & SESSION GLOBAL -----------------
-mindmap_cache: Dict[str, Any] = {} # Key: file_hash, Value: (topic, nodes, detail, summary)
-sessions = {}
+# Key: file_hash, Value: phản hồi của /generate_mindmap. LRU trong RAM + SQLite trên đĩa để
+# kết quả OCR + llava (vài phút mỗi file) sống qua các lần restart / deploy
+mindmap_cache = MindmapCache(
+    os.getenv("MINDMAP_CACHE_PATH", "mindmap_cache_data/mindmap_cache.db"),
+    memory_entries=int(os.getenv("MINDMAP_CACHE_MEMORY_ENTRIES", "128")),
+    max_bytes=int(os.getenv("MINDMAP_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+    legacy_json_path="mindmap_cache_data/mindmap_results.json",
+    # Số bit pHash/dHash (trên 64) được phép khác để một ảnh là ứng viên gần trùng (0 = tắt tìm gần trùng)
+    near_max_distance=int(os.getenv("MINDMAP_NEAR_MAX_DISTANCE", "8")),
+    # Ứng viên chỉ được trả về khi text OCR giống text OCR của ảnh mới tới mức này (0..1)
+    near_min_similarity=float(os.getenv("MINDMAP_NEAR_MIN_TEXT_SIMILARITY", "0.9")),
+    # Entry sinh bởi model / prompt / options / OCR cũ: "stale" = trả ngay rồi sinh lại trong nền,
+    # "strict" = sinh lại trước khi trả, "ignore" = dùng luôn
+    pipeline=mindmap_pipeline_fingerprint(),
+    version_policy=os.getenv("MINDMAP_CACHE_VERSION_POLICY", "stale"),
+)
+# Số lượt sinh lại mindmap stale chạy nền cùng lúc (phần dư bỏ qua, lần hit sau sẽ thử lại)
+MINDMAP_REVALIDATE_MAX = int(os.getenv("MINDMAP_REVALIDATE_MAX", "2"))
+mindmap_revalidations: set = set()
+# Nhiều upload cùng file_hash đang xử lý -> chỉ chạy OCR + llava một lần
+mindmap_flight = SingleFlight()
 SESSION_TIMEOUT = timedelta(minutes=120)
+SESSION_MAX_ENTRIES = 5000
+SESSION_MAX_BYTES = 64 * 1024 * 1024
+# "memory" cho 1 worker; "sqlite" để chạy `uvicorn Server:app --workers N` với history dùng chung
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "session_data/sessions.db")
+sessions = create_session_store(
+    SESSION_BACKEND, SESSION_TIMEOUT, sqlite_path=SESSION_DB_PATH,
+    max_entries=SESSION_MAX_ENTRIES, max_bytes=SESSION_MAX_BYTES
+)
+
+# Lịch sử gửi cho model được cắt theo ngân sách token của từng tier; phần cũ được model small
+# tóm tắt trong nền để thời gian prompt-eval gần như không tăng khi cuộc trò chuyện dài ra
+async def summarize_history(messages: List[Dict[str, str]]) -> str:
+    # Không dùng call_gemma__small_chat: hàm đó coi system message đầu là chỉ dẫn theo lượt
+    # và đặt persona chat lên trước, SUMMARY_INSTRUCTIONS sẽ bị nối vào cuối bản ghi hội thoại
+    return await call_gemma__small_summary(messages)
+
+history = HistoryManager(
+    sessions, summarize_history,
+    budgets={
+        "small": int(os.getenv("HISTORY_TOKENS_SMALL", "2000")),
+        "pro": int(os.getenv("HISTORY_TOKENS_PRO", "2500")),
+    },
+    summarize_threshold=int(os.getenv("HISTORY_SUMMARY_THRESHOLD", "1500")),
+)
+
+# Cache khớp chính xác cho model small (chào hỏi, cảm ơn...), chỉ dùng ở lượt đầu của session
+small_reply_cache = ExactReplyCache(
+    max_entries=int(os.getenv("SMALL_REPLY_CACHE_SIZE", "1024")),
+    answers_per_key=int(os.getenv("SMALL_REPLY_CACHE_ANSWERS", "3")),
+)
+
+# Semantic cache cho /ask (opt-in): chỉ áp dụng cho câu hỏi có ít lịch sử
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_EMBED_MODEL = os.getenv("SEMANTIC_CACHE_EMBED_MODEL", "bge-m3")
+SEMANTIC_CACHE_MAX_HISTORY = 0 # Số tin nhắn trước đó tối đa để còn dùng cache (0 = chỉ lượt đầu)
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED and embed is not None:
+    semantic_cache = SemanticReplyCache(
+        lambda text: embed(SEMANTIC_CACHE_EMBED_MODEL, text),
+        capacity=int(os.getenv("SEMANTIC_CACHE_CAPACITY", "2048")),
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+        ttl_seconds=float(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+    )
+
+# ----------------- MODEL WARM-UP -----------------
+# Nạp sẵn model khi khởi động để request đầu tiên không phải chờ Ollama load (llava:13b mất hàng chục giây)
+WARMUP_MODELS = [m for m in os.getenv("WARMUP_MODELS", ",".join(AI_MODEL_NAMES)).split(",") if m]
+warmup_status: Dict[str, str] = {m: "pending" for m in WARMUP_MODELS}
+warmup_task = None
+
+async def warm_up_models():
+    # Nạp lần lượt: nạp song song nhiều model trên CPU chỉ làm chúng chậm lẫn nhau
+    for model in WARMUP_MODELS:
+        warmup_status[model] = "loading"
+        try:
+            await warm_up(model)
+            warmup_status[model] = "ready"
+            logging.info(f"Model warmed up: {model}")
+        except Exception as e:
+            warmup_status[model] = f"error: {e}"
+            logging.warning(f"Warm-up failed for {model}: {e}")
+
+@app.on_event("startup")
+async def startup_background_tasks():
+    global warmup_task
+    sessions.start()
+    start_health_checks()
+    await mindmap_jobs.start()
+    warmup_task = asyncio.create_task(warm_up_models())
+
+@app.on_event("shutdown")
+async def shutdown_background_tasks():
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+    await sessions.close()
+    await mindmap_jobs.close()
+    mindmap_cache.close()
+    await close_client()
 
 # ----------------- HELPERS -----------------
 def extract_reply_content(response: Any) -> str:
@@ -67,35 +269,38 @@ def extract_reply_content(response: Any) -> str:
     return getattr(response, "message", {}).get("content") or getattr(response, "content", None) or str(response)
 
 def detect_language(text: str) -> str:
-    try:
-        lang = detect(text)
-        if lang not in ["vi", "en"]:
-            return "en" 
-        return lang
-    except:
-        return "en"
+    # Quét dấu tiếng Việt trước, langdetect chỉ dùng cho câu ASCII mơ hồ
+    return detect_language_fast(text)[0]
+
+# Router biên dịch sẵn từ khóa; đặt ROUTER_WEIGHTS=<file .npy> để dùng classifier n-gram
+router = ComplexityRouter(weights_path=os.getenv("ROUTER_WEIGHTS"))
 
 def assess_complexity(question: str) -> str:
-    q_lower = question.lower().strip()
-    low_complexity_keywords = [
-        "chào", "hello", "xin chào", "hi", "hey",
-        "bạn là ai", "ai tạo ra bạn", "tên bạn", "who are you", "what is your name",
-        "hôm nay là ngày mấy", "ngày hôm nay", "ngày mấy", "today's date", "what time is it",
-        "lộ vậy", "đùa tao à", "hả", "sao", "what", "fuck", "shit", "why you so small", 
-        "làm ơn", "please", "thank you", "cảm ơn" 
-    ]
-    
-    if any(word in q_lower for word in low_complexity_keywords) or len(q_lower.split()) <= 4:
-        return "small"
-    
-    high_complexity_keywords = ["giải thích", "phân tích", "tóm tắt", "sự khác biệt", "vì sao", "how does", "what is the difference", "tóm gọn"]
-    if any(word in q_lower for word in high_complexity_keywords):
-        return "pro"
-        
-    if len(q_lower.split()) > 6:
-        return "pro"
+    return router.route(question)
+
+# CHAT_ROUTING=cascade: luôn để small trả lời trước, chỉ chuyển lên pro khi câu trả lời kém tự tin
+CHAT_ROUTING = os.getenv("CHAT_ROUTING", "router")
+cascade = CascadePolicy(min_confidence=float(os.getenv("CASCADE_MIN_CONFIDENCE", "0.6")))
+
+# Hạ cấp pro -> small (hoặc rút ngắn câu trả lời) khi model pro đang quá tải; LOAD_GOVERNOR=0 để tắt
+governor = TierGovernor(
+    TIER_MODEL_NAMES["pro"],
+    max_queue_depth=int(os.getenv("PRO_DOWNGRADE_QUEUE_DEPTH", "4")),
+    max_wait_p95=float(os.getenv("PRO_DOWNGRADE_WAIT_P95", "10")),
+    max_service_p95=float(os.getenv("PRO_DOWNGRADE_LATENCY_P95", "90")),
+    short_num_predict=int(os.getenv("PRO_SHORT_NUM_PREDICT", "384")),
+) if os.getenv("LOAD_GOVERNOR", "1") == "1" and "pro" in TIER_MODEL_NAMES else None
 
-    return "small"
+def govern_tier(model_tier: str):
+    """Trả về (tier sau khi xét tải, num_predict cho pro, thông tin hạ cấp hoặc None)."""
+    if model_tier != "pro" or governor is None:
+        return model_tier, None, None
+    action, reason = governor.decide()
+    if action == "downgrade":
+        return "small", None, {"action": action, "from": "pro", "reason": reason}
+    if action == "shorten":
+        return "pro", governor.short_num_predict, {"action": action, "num_predict": governor.short_num_predict, "reason": reason}
+    return "pro", None, None
 
 
 # ----------------- HOMEPAGE & CHAT (Giữ nguyên) -----------------
@@ -110,123 +315,747 @@ class Question(BaseModel):
     session_id: str
     question: str
 
-@app.post("/ask")
-async def ask_ai(data: Question):
+@dataclass
+class ChatTurn:
+    session_id: str
+    question: str
+    session: Dict[str, Any]
+    messages_with_system: List[Dict[str, str]]
+    model_tier: str
+    language: str
+    now: datetime
+    # Đường đi của câu hỏi, trả về cho client: {"mode": "router"|"cascade", "path": ["small", "pro"], ...}
+    route: Dict[str, Any] = field(default_factory=dict)
+    num_predict: int | None = None  # Giới hạn độ dài câu trả lời pro khi tải cao
+    # Tier do router chọn, trước khi governor hạ cấp / cascade chuyển lên pro: key của các cache câu trả lời
+    routed_tier: str = ""
+
+    @property
+    def messages(self) -> List[Dict[str, str]]:
+        return self.session["messages"]
+
+    @property
+    def prior_messages(self) -> float:
+        # Session đã có tóm tắt nghĩa là lịch sử dài, không bao giờ coi là lượt đầu
+        return math.inf if self.session.get("summary") else len(self.messages) - 1
+
+def build_turn_messages(session: Dict[str, Any], language: str, model_tier: str) -> List[Dict[str, str]]:
+    # Thứ tự do prompt_builder quyết định: system đầu tiên = chỉ dẫn ngôn ngữ (gắn vào cuối câu hỏi),
+    # system tiếp theo = tóm tắt (đứng ngay sau prompt tĩnh) -> phần đầu prompt ổn định giữa các lượt
+    messages_with_system = []
+    if language in LANGUAGE_DIRECTIVES:
+        messages_with_system.append({"role": "system", "content": LANGUAGE_DIRECTIVES[language]})
+    if session.get("summary"):
+        messages_with_system.append({"role": "system", "content": f"Tóm tắt phần trước của cuộc trò chuyện: {session['summary']}"})
+    return messages_with_system + history.select_messages(session, model_tier)
+
+def route_question(question: str) -> str:
+    return "small" if CHAT_ROUTING == "cascade" else assess_complexity(question)
+
+def prepare_chat_turn(data: Question, tier_decision: tuple | None = None) -> ChatTurn:
+    """
+    Nạp session, thêm câu hỏi và chọn model. Dùng chung cho /ask và /ask_stream.
+    `tier_decision` = kết quả govern_tier đã có sẵn (/ask_batch chọn model trước khi giữ slot) -> không route lại.
+    """
     now = datetime.utcnow()
+    # SessionStore tự loại session đã rảnh quá SESSION_TIMEOUT
     session = sessions.get(data.session_id)
 
-    if not session or now - session["created_at"] > SESSION_TIMEOUT:
+    if not session:
         session = {"messages": [], "created_at": now}
 
     messages = session["messages"]
     messages.append({"role": "user", "content": data.question})
 
-    model_tier = assess_complexity(data.question)
-    language = detect_language(data.question) 
-
-    system_prompt = {
-        "vi": "Bạn là trợ lý AI hữu ích, lịch sự và thân thiện. Luôn trả lời bằng tiếng Việt.",
-        "en": "You are a helpful, polite, and friendly AI assistant. Always reply in English.",
-    }.get(language, "You are a helpful, polite, and friendly AI assistant.")
+    model_tier, num_predict, load = tier_decision or govern_tier(route_question(data.question))
+    # Ngôn ngữ được nhớ theo session, chỉ phát hiện lại khi kiểu chữ (có dấu/không dấu...) thay đổi
+    previous = tuple(session["language"]) if session.get("language") else None
+    language, script = detect_language_for_session(data.question, previous)
+    session["language"] = [language, script]
 
-    messages_with_system = [{"role": "system", "content": system_prompt}] + messages[-5:]
+    messages_with_system = build_turn_messages(session, language, model_tier)
 
     logging.info(f"[{data.session_id}] Ngôn ngữ: {language} | Model: {model_tier}")
+    route = {"mode": CHAT_ROUTING, "path": [model_tier]}
+    if load:
+        route["load"] = load
+        logging.info(f"[{data.session_id}] Pro quá tải ({load['reason']}): {load['action']}")
+    routed_tier = load["from"] if load and load["action"] == "downgrade" else model_tier
+    return ChatTurn(data.session_id, data.question, session, messages_with_system, model_tier, language, now, route,
+                    num_predict, routed_tier)
 
-    if model_tier == "small":
-        model_response = await asyncio.to_thread(call_gemma__small_chat, messages_with_system)
-        model_used = "gemmaSmall"
-    else:
-        model_response = await asyncio.to_thread(call_gemma_pro_chat, messages_with_system)
-        model_used = "gemmaPro"
+def discard_chat_turn(turn: ChatTurn):
+    """Bỏ câu hỏi vừa thêm khi lượt chat bị hủy (session trong RAM là cùng một object với store)."""
+    if turn.messages and turn.messages[-1] == {"role": "user", "content": turn.question}:
+        turn.messages.pop()
+
+def save_chat_turn(turn: ChatTurn, reply_text: str):
+    turn.messages.append({"role": "assistant", "content": reply_text})
+    turn.session["created_at"] = turn.now
+    sessions.set(turn.session_id, turn.session)
+    history.maybe_schedule_summary(turn.session_id, turn.session)
+
+MODEL_LABELS = {"small": "gemmaSmall", "pro": "gemmaPro"}
+
+def model_label(turn: ChatTurn) -> str:
+    """Tên model trả về client, kèm ghi chú khi bị hạ cấp/rút ngắn vì tải cao."""
+    label = MODEL_LABELS[turn.model_tier]
+    action = turn.route.get("load", {}).get("action")
+    if action == "downgrade" and turn.model_tier == "small":
+        return f"{label} (downgraded from {MODEL_LABELS['pro']})"
+    if action == "shorten" and turn.model_tier == "pro":
+        return f"{label} (shortened)"
+    return label
+
+# Câu trả lời lỗi/mock của các module model -> không bao giờ đưa vào cache
+MODEL_ERROR_PREFIXES = ("Xin lỗi, mô hình Pro hiện đang gặp lỗi", "Xin lỗi, tôi không thể trả lời lúc này", "Mock ")
+
+def is_model_error(reply_text: str) -> bool:
+    return not reply_text or reply_text.startswith(MODEL_ERROR_PREFIXES)
+
+TIER_RANK = {"small": 0, "pro": 1}
 
+async def lookup_cached_reply(turn: ChatTurn):
+    """
+    Trả về (câu trả lời cache hoặc None, vector câu hỏi cho semantic cache).
+    Tra theo tier được route (không phải tier cuối cùng): câu cascade đã chuyển lên pro được lưu dưới tier
+    small mà lần hỏi sau sẽ tra, và câu bị governor hạ cấp vẫn dùng được câu trả lời pro đã có.
+    """
+    prior_turns = turn.prior_messages
+    if turn.routed_tier == "small" and prior_turns == 0:
+        reply = small_reply_cache.get(turn.question, turn.language)
+        if reply is not None:
+            return reply, None
+    if semantic_cache is None or prior_turns > SEMANTIC_CACHE_MAX_HISTORY:
+        return None, None
+    return await semantic_cache.lookup(turn.question, turn.language, turn.routed_tier)
+
+def store_cached_reply(turn: ChatTurn, question_vector, reply_text: str):
+    # Gọi sau save_chat_turn: messages lúc này gồm câu hỏi và câu trả lời vừa thêm
+    if is_model_error(reply_text):
+        return
+    # Câu trả lời của tier thấp hơn tier được route (pro quá tải -> small) không được đứng thay câu trả lời pro
+    if TIER_RANK[turn.model_tier] < TIER_RANK[turn.routed_tier]:
+        return
+    if turn.routed_tier == "small" and turn.prior_messages == 1:
+        small_reply_cache.put(turn.question, turn.language, reply_text)
+    if semantic_cache is not None and question_vector is not None:
+        semantic_cache.store(question_vector, turn.language, turn.routed_tier, reply_text)
+
+async def cascade_small_pass(turn: ChatTurn):
+    """
+    Lượt đầu của chế độ cascade: small trả lời trọn vẹn rồi CascadePolicy chấm độ tự tin.
+    Trả về (câu trả lời của small, có cần chuyển lên pro không). Khi cần chuyển, turn được đổi sang
+    tier pro (lịch sử được chọn lại theo ngân sách của pro).
+    """
+    reply_text, mean_logprob = await call_gemma__small_chat_scored(turn.messages_with_system)
+    decision = cascade.decide(turn.question, reply_text, mean_logprob, failed=is_model_error(reply_text))
+    turn.route.update(reason=decision.reason, confidence=round(decision.confidence, 3) if decision.confidence is not None else None)
+    logging.info(f"[{turn.session_id}] Cascade: {decision.reason} (confidence={decision.confidence})")
+
+    if decision.escalate:
+        _, turn.num_predict, load = govern_tier("pro")
+        if load:
+            turn.route["load"] = load
+        if load and load["action"] == "downgrade":
+            turn.route["reason"] += "+pro_overloaded"
+            return reply_text, False
+        turn.model_tier = "pro"
+        turn.messages_with_system = build_turn_messages(turn.session, turn.language, "pro")
+        turn.route["path"].append("pro")
+    return reply_text, decision.escalate
+
+def cascade_keep_small(turn: ChatTurn):
+    """Pro quá tải lúc cần chuyển lên: dùng luôn câu trả lời của small thay vì trả 429/503."""
+    cascade.record_busy_fallback()
+    turn.model_tier = "small"
+    turn.route["path"].pop()
+    turn.route["reason"] += "+pro_busy"
+
+async def answer_question(data: Question, tier_decision: tuple | None = None) -> Dict[str, Any]:
+    turn = prepare_chat_turn(data, tier_decision)
+    model_used = model_label(turn)
+    try:
+        cached_reply, question_vector = await lookup_cached_reply(turn)
+        if cached_reply is not None:
+            save_chat_turn(turn, cached_reply)
+            return {"model": model_used, "answer": cached_reply, "cached": True}
+
+        if CHAT_ROUTING == "cascade":
+            model_response, escalate = await cascade_small_pass(turn)
+            if escalate:
+                try:
+                    model_response = await call_gemma_pro_chat(turn.messages_with_system, turn.num_predict)
+                except AdmissionRejected:
+                    cascade_keep_small(turn)
+        elif turn.model_tier == "small":
+            model_response = await call_gemma__small_chat(turn.messages_with_system)
+        else:
+            model_response = await call_gemma_pro_chat(turn.messages_with_system, turn.num_predict)
+    except BaseException:
+        # Bị hủy (client ngắt, quá hạn) hoặc bị từ chối: câu hỏi không được trả lời thì không nằm lại trong lịch sử
+        discard_chat_turn(turn)
+        raise
+
+    model_used = model_label(turn)
     reply_text = extract_reply_content(model_response)
-    
-    messages.append({"role": "assistant", "content": reply_text})
-    sessions[data.session_id] = {"messages": messages, "created_at": now}
+    save_chat_turn(turn, reply_text)
+    store_cached_reply(turn, question_vector, reply_text)
+
+    return {"model": model_used, "answer": reply_text, "route": turn.route}
+
+# Cùng session gửi lại đúng câu hỏi khi lượt trước chưa xong (bấm gửi hai lần) -> nhận chung câu trả lời,
+# lịch sử chỉ có một cặp hỏi/đáp. Phải gộp ở đây, trước khi đụng tới lịch sử: key single-flight của lời gọi
+# model gồm cả lịch sử, mà lịch sử của lượt sau đã chứa câu hỏi của lượt trước nên không bao giờ khớp.
+ask_flight = SingleFlight()
+
+def answer_question_once(data: Question):
+    key = ("ask", data.session_id, " ".join(data.question.split()))
+    return ask_flight.do(key, lambda: answer_question(data))
+
+@app.post("/ask")
+async def ask_ai(data: Question, request: Request):
+    # Client bấm dừng (AbortController) hoặc quá hạn -> hủy luôn lượt sinh của Ollama
+    return JSONResponse(await run_until_disconnected("/ask", answer_question_once(data), request.is_disconnected, ASK_DEADLINE))
+
+async def single_chunk(text: str):
+    yield text
+
+async def open_answer_stream(data: Question, started_at: float):
+    turn = prepare_chat_turn(data)
+    model_used = model_label(turn)
+    try:
+        cached_reply, question_vector = await lookup_cached_reply(turn)
+        if cached_reply is not None:
+            save_chat_turn(turn, cached_reply)
+
+            async def cached_stream():
+                yield json.dumps({"type": "meta", "model": model_used, "cached": True}) + "\n"
+                yield json.dumps({"type": "done", "model": model_used, "answer": cached_reply, "cached": True}, ensure_ascii=False) + "\n"
 
-    return JSONResponse({"model": model_used, "answer": reply_text})
+            return StreamingResponse(cached_stream(), media_type="application/x-ndjson")
+
+        if CHAT_ROUTING == "cascade":
+            # Câu trả lời của small phải được chấm trọn vẹn trước khi biết có gửi nó hay không
+            small_reply, escalate = await cascade_small_pass(turn)
+            token_stream = stream_gemma_pro_chat(turn.messages_with_system, turn.num_predict) if escalate else single_chunk(small_reply)
+        elif turn.model_tier == "small":
+            token_stream = stream_gemma__small_chat(turn.messages_with_system)
+        else:
+            token_stream = stream_gemma_pro_chat(turn.messages_with_system, turn.num_predict)
+
+        # Chờ token đầu tiên trước khi gửi header: nếu model quá tải thì vẫn kịp trả 429/503
+        try:
+            first_chunk = await token_stream.__anext__()
+        except StopAsyncIteration:
+            first_chunk = ""
+        except AdmissionRejected:
+            if CHAT_ROUTING != "cascade" or turn.model_tier != "pro":
+                raise
+            cascade_keep_small(turn)
+            token_stream = single_chunk(small_reply)
+            first_chunk = await token_stream.__anext__()
+    except BaseException:
+        discard_chat_turn(turn)
+        raise
+    model_used = model_label(turn)
+
+    async def event_stream():
+        parts = [first_chunk]
+        try:
+            yield json.dumps({"type": "meta", "model": model_used, "route": turn.route}) + "\n"
+            yield json.dumps({"type": "token", "content": first_chunk}, ensure_ascii=False) + "\n"
+            # Client ngắt giữa chừng -> Starlette hủy generator này -> stream Ollama bị đóng theo
+            async for chunk in iterate_with_deadline("/ask_stream", token_stream, ASK_STREAM_DEADLINE, started_at):
+                parts.append(chunk)
+                yield json.dumps({"type": "token", "content": chunk}, ensure_ascii=False) + "\n"
+        except DeadlineExceeded as e:
+            discard_chat_turn(turn)
+            yield json.dumps({"type": "error", "error": f"Quá thời gian trả lời ({e.deadline:g}s)."}, ensure_ascii=False) + "\n"
+            return
+        except BaseException:
+            discard_chat_turn(turn)
+            raise
+
+        reply_text = "".join(parts).strip()
+        save_chat_turn(turn, reply_text)
+        store_cached_reply(turn, question_vector, reply_text)
+        yield json.dumps({"type": "done", "model": model_used, "answer": reply_text, "route": turn.route}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+@app.post("/ask_stream")
+async def ask_ai_stream(data: Question, request: Request):
+    """
+    Bản stream của /ask: trả về NDJSON, mỗi dòng một sự kiện
+    {"type": "meta"|"token"|"done"|"error", ...} ngay khi Ollama sinh token.
+    Hạn chót ASK_STREAM_DEADLINE tính cho cả lượt, kể cả phần chờ token đầu tiên.
+    """
+    started_at = asyncio.get_running_loop().time()
+    return await run_until_disconnected(
+        "/ask_stream", open_answer_stream(data, started_at), request.is_disconnected, ASK_STREAM_DEADLINE
+    )
+
+class BatchItem(BaseModel):
+    session_id: str
+    question: str
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    parallel: int | None = None  # Số câu chạy song song cho mỗi model (mặc định BATCH_PARALLEL)
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_PARALLEL = int(os.getenv("BATCH_PARALLEL", "2"))
+# Batch chạy nền nên không bỏ câu khi model quá tải: chờ Retry-After rồi thử lại
+BATCH_MAX_RETRIES = 5
+
+def plan_batch(items: List[BatchItem]) -> tuple[List[List[int]], List[str]]:
+    """
+    Gom các câu theo session thành chuỗi (giữ thứ tự vì câu sau dùng lịch sử của câu trước)
+    và route từng câu đúng một lần, độc lập với các câu khác trong chuỗi: (các chuỗi, tier của từng câu).
+    """
+    chains: Dict[str, List[int]] = {}
+    for index, item in enumerate(items):
+        chains.setdefault(item.session_id, []).append(index)
+    return list(chains.values()), [route_question(item.question) for item in items]
+
+async def answer_with_slot(item: BatchItem, routed_tier: str, slots: Dict[str, asyncio.Semaphore]) -> tuple[str, Dict[str, Any]]:
+    """
+    Trả lời một câu khi đang giữ slot batch của model thực sự được gọi: governor quyết định khi đã giữ slot
+    của tier được route (số liệu tải còn mới), bị hạ cấp thì nhả slot đó và chờ slot của tier mới.
+    Chế độ cascade: câu chuyển lên pro vẫn chạy dưới slot small, pro chỉ được giới hạn bởi admission limiter.
+    """
+    question = Question(session_id=item.session_id, question=item.question)
+    async with slots[routed_tier]:
+        decision = govern_tier(routed_tier)
+        if decision[0] == routed_tier:
+            return routed_tier, await answer_question(question, decision)
+    async with slots[decision[0]]:
+        return decision[0], await answer_question(question, decision)
+
+async def answer_batch_item(item: BatchItem, routed_tier: str, slots: Dict[str, asyncio.Semaphore]) -> tuple[str, Dict[str, Any]]:
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        try:
+            return await asyncio.wait_for(answer_with_slot(item, routed_tier, slots), ASK_DEADLINE)
+        except AdmissionRejected as e:
+            if attempt == BATCH_MAX_RETRIES:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+@app.post("/ask_batch")
+async def ask_batch(data: BatchRequest):
+    """
+    Trả lời nhiều câu hỏi trong một request (job FAQ, tập đánh giá). Kết quả trả về dạng NDJSON
+    ngay khi từng câu xong, theo thứ tự hoàn thành: {"type": "result"|"error", "index", ...},
+    dòng cuối {"type": "done", ...}. Các câu cùng session chạy lần lượt; mỗi câu giữ một slot của
+    model nó được gửi tới, mỗi model tối đa `parallel` câu cùng lúc (không quá số slot của model đó).
+    Client ngắt kết nối thì các câu chưa xong bị hủy.
+    """
+    if len(data.items) > BATCH_MAX_ITEMS:
+        return JSONResponse({"error": f"Tối đa {BATCH_MAX_ITEMS} câu hỏi mỗi batch."}, status_code=413)
+
+    chains, routed_tiers = plan_batch(data.items)
+    parallel = max(1, data.parallel or BATCH_PARALLEL)
+    slots = {
+        tier: asyncio.Semaphore(min(parallel, get_limiter(TIER_MODEL_NAMES[tier]).max_concurrency)
+                                if tier in TIER_MODEL_NAMES else parallel)
+        for tier in ("small", "pro")
+    }
+    tiers_used: Counter = Counter()
+
+    async def run_chain(chain: List[int], results: asyncio.Queue):
+        for index in chain:
+            item = data.items[index]
+            try:
+                tier, reply = await answer_batch_item(item, routed_tiers[index], slots)
+                tiers_used[tier] += 1
+                result = {"type": "result", "index": index, "session_id": item.session_id, **reply}
+            except Exception as e:
+                logging.warning(f"[{item.session_id}] Batch item {index} failed: {e!r}")
+                result = {"type": "error", "index": index, "session_id": item.session_id, "error": str(e) or type(e).__name__}
+            await results.put(result)
+
+    async def result_stream():
+        started = asyncio.get_running_loop().time()
+        results: asyncio.Queue = asyncio.Queue()
+        tasks = [asyncio.create_task(run_chain(chain, results)) for chain in chains]
+
+        errors = 0
+        try:
+            for _ in range(len(data.items)):
+                result = await results.get()
+                errors += result["type"] == "error"
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            # Client ngắt giữa chừng -> hủy các câu chưa chạy xong (hủy lan xuống lời gọi model)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        yield json.dumps({
+            "type": "done",
+            "items": len(data.items),
+            "errors": errors,
+            "groups": dict(tiers_used),
+            "elapsed_s": round(asyncio.get_running_loop().time() - started, 3),
+        }) + "\n"
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
 
 @app.post("/end_session")
 async def end_session(data: dict):
     sid = data.get("session_id")
-    if sid in sessions:
-        del sessions[sid]
+    sessions.delete(sid)
     return {"message": "Session đã được xóa"}
 
+@app.get("/ready")
+async def ready():
+    """Sẵn sàng khi các model chat đang nằm trong RAM của Ollama. llava được phép nhả khi rảnh."""
+    try:
+        resident = await resident_models()
+    except Exception as e:
+        return JSONResponse({"ready": False, "error": f"Ollama không phản hồi: {e}"}, status_code=503)
+
+    policy = keep_alive_policy()
+    models = {
+        m: {
+            "resident": m in resident,
+            "keep_alive": policy.get(m),
+            "warmup": warmup_status.get(m, "skipped"),
+            **resident.get(m, {}),
+        }
+        for m in AI_MODEL_NAMES
+    }
+    is_ready = all(models[m]["resident"] for m in CHAT_MODEL_NAMES)
+    return JSONResponse({"ready": is_ready, "models": models}, status_code=200 if is_ready else 503)
+
+@app.get("/stats")
+async def stats():
+    return {
+        "sessions": sessions.stats(),
+        "small_reply_cache": small_reply_cache.stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache else {"enabled": False},
+        "history": history.stats(),
+        "mindmap_cache": {**mindmap_cache.stats(), "versions": await mindmap_cache.version_counts()},
+        "mindmap_jobs": mindmap_jobs.stats(),
+        "aborts": abort_stats.stats(),
+        "load_governor": governor.stats() if governor else {"enabled": False},
+        "cascade": {"enabled": CHAT_ROUTING == "cascade", **cascade.stats()},
+        "prompt_cache": prompt_stats.stats(),
+        "admission": admission_stats(),
+        "hosts": host_stats(),
+        "singleflight": {
+            "ask": ask_flight.stats(),
+            "model": model_flight.stats() if model_flight else {},
+            "mindmap": mindmap_flight.stats(),
+        },
+    }
+
 # ----------------- MINDMAP (KÈM CACHE) -----------------
+@dataclass
+class UploadImage:
+    """Upload là ảnh: hash gần trùng và các dòng OCR (None nếu không OCR được), OCR được dùng lại khi sinh mới."""
+    hashes: tuple[int, int]
+    ocr_lines: List[str] | None
+
+    @property
+    def text(self) -> str | None:
+        return None if self.ocr_lines is None else normalize_ocr_text(self.ocr_lines)
+
+def generate_from_upload(upload, on_stage=None, image: UploadImage | None = None):
+    # Đánh dấu ngay khi single-flight tạo lượt chạy: từ đây lượt chạy chịu trách nhiệm xóa file tạm
+    upload.taken = True
+
+    async def run() -> List[Any]:
+        try:
+            return await call_mindmap_generation(upload.path, on_stage=on_stage,
+                                                 ocr_lines=image.ocr_lines if image else None)
+        finally:
+            upload.remove()
+
+    return run()
+
+def can_revalidate() -> bool:
+    return len(mindmap_revalidations) < MINDMAP_REVALIDATE_MAX
+
+def start_revalidation(key: str, work):
+    """Chạy `work()` (sinh lại + lưu cache một mindmap stale) trong nền, lỗi chỉ được log."""
+    async def run():
+        try:
+            await work()
+            logging.info(f"Cache REVALIDATED for key: {key}")
+        except Exception as e:
+            logging.warning(f"Revalidation of {key} failed: {e!r}")
+
+    task = asyncio.create_task(run())
+    mindmap_revalidations.add(task)
+    task.add_done_callback(mindmap_revalidations.discard)
+
+def revalidate_mindmap(upload, image: UploadImage | None, matched_key: str | None = None):
+    """
+    Sinh lại mindmap stale của file bằng pipeline hiện tại; task nhận luôn file tạm của upload.
+    `matched_key`: entry stale gần trùng đã được trả về thay cho file này -> được ghi đè bằng kết quả mới,
+    nếu không entry cũ sẽ còn được trả về (stale) cho mọi ảnh gần trùng về sau.
+    """
+    if not can_revalidate():
+        return
+    if upload.persistent:
+        # File của job bị xóa khi job xong -> lượt sinh lại dùng một hard link riêng
+        path = f"{upload.path}.{os.urandom(4).hex()}.revalidate"
+        try:
+            os.link(upload.path, path)
+        except OSError:
+            shutil.copyfile(upload.path, path)
+        owned = SpooledUpload(path, upload.sha256, upload.size)
+    else:
+        owned = SpooledUpload(upload.path, upload.sha256, upload.size)
+        upload.taken = True  # Bên gọi không xóa file nữa
+
+    async def work():
+        try:
+            await build_mindmap(owned, image=image)
+            if matched_key and matched_key != owned.sha256:
+                fresh = await mindmap_cache.lookup(owned.sha256)
+                if fresh is not None and not fresh[1]:
+                    # Giữ nguyên hash ảnh của entry cũ trong chỉ mục gần trùng
+                    await mindmap_cache.put(matched_key, fresh[0])
+        finally:
+            if not owned.taken:
+                owned.remove()
+
+    start_revalidation(owned.sha256, work)
+
+async def lookup_mindmap(upload, near: bool = True) -> tuple[Dict[str, Any] | None, UploadImage | None]:
+    """
+    Tìm mindmap đã có cho file: khớp chính xác SHA-256, không có thì (nếu là ảnh và `near`) tìm ảnh gần trùng.
+    Ảnh gần trùng theo perceptual hash chỉ là ứng viên: file mới được OCR và chỉ nhận ứng viên có text OCR
+    giống (slide cùng template khác chữ có hash gần như nhau). Kết quả OCR được trả về trong UploadImage
+    để lượt sinh mới dùng lại. Trả về (payload | None, UploadImage | None).
+    Entry của pipeline cũ (policy "stale") được trả về kèm "stale": true và được sinh lại trong nền.
+    """
+    image = matched_key = None
+    entry = await mindmap_cache.lookup(upload.sha256)
+    if entry is not None:
+        logging.info(f"Cache HIT for hash: {upload.sha256}")
+        payload, stale = entry
+    else:
+        if not near or mindmap_cache.near_max_distance <= 0:
+            return None, None
+        hashes = await asyncio.to_thread(image_hashes, upload.path)
+        if hashes is None:
+            return None, None
+        image = UploadImage(hashes, await read_image_text(upload.path))
+        found = await mindmap_cache.find_similar(image.hashes, image.text)
+        if found is None:
+            return None, image
+        matched_key, distance, payload, stale = found
+        logging.info(f"Cache NEAR HIT for hash: {upload.sha256} ~ {matched_key} (distance {distance})")
+        payload = {**payload, "near_duplicate": {"file_hash": matched_key, "distance": distance}}
+
+    if stale:
+        revalidate_mindmap(upload, image, matched_key)
+        payload = {**payload, "stale": True}
+    return payload, image
+
+async def build_mindmap(upload, on_stage=None, image: UploadImage | None = None) -> Dict[str, Any]:
+    """
+    OCR + llava cho file đã spool (dùng chung single-flight theo file_hash), rồi lưu cache.
+    `on_stage(stage, **info)` nhận các mốc ocr_done / llm_running / parsed / cached; upload trùng hash
+    nhập vào lượt đang chạy của request khác thì chỉ nhận parsed / cached.
+    """
+    result = await mindmap_flight.do(("mindmap", upload.sha256), lambda: generate_from_upload(upload, on_stage, image))
+    return await finish_mindmap(upload.sha256, result, on_stage, image)
+
+async def finish_mindmap(key: str, result: Any, on_stage=None, image: UploadImage | None = None) -> Dict[str, Any]:
+    """Kiểm tra kết quả [topic, nodes] của model, dựng phản hồi và lưu cache dưới `key` nếu hợp lệ."""
+    stage = on_stage or (lambda *args, **kwargs: None)
+    if not isinstance(result, list) or len(result) != 2:
+        raise Exception(f"Vision Model trả về định dạng không hợp lệ: {result}")
+
+    topic, final_nodes = result # final_nodes ở đây là cấu trúc cây không có tọa độ
+
+    if isinstance(topic, str) and topic.startswith(("Lỗi", "Error", "Cannot", "Undefined Topic")):
+        # Xử lý lỗi từ mô hình vision/OCR/Fallback
+        return {
+            "topic": topic,
+            "detail": [f"Không thể phân tích hoặc Mindmap bị lỗi: {topic}"],
+            "summary": [],
+            "mindmap_nodes": []
+        }
+
+    if not final_nodes:
+        return {
+            "topic": topic if topic else "Topic Not Found",
+            "detail": ["Not enough content to create mindmap."],
+            "summary": [],
+            "mindmap_nodes": []
+        }
+
+    payload = mindmap_payload(topic, final_nodes) # Nodes dạng cây không tọa độ + detail/summary
+    stage("parsed", nodes=len(final_nodes))
+
+    # LƯU VÀO CACHE TRƯỚC KHI TRẢ VỀ
+    await mindmap_cache.put(key, payload, image.hashes if image else None, image.text if image else None)
+    stage("cached")
+    logging.info(f"Cache SAVED for key: {key}")
+    return payload
+
 @app.post("/generate_mindmap")
-async def generate_mindmap(file: UploadFile = File(...)):
+async def generate_mindmap(request: Request, file: UploadFile = File(...)):
+    upload = None
     try:
-        file_bytes = await file.read()
-        
-        # 1. Tính Hash SHA-256
-        file_hash = hashlib.sha256(file_bytes).hexdigest()
-        
-        # 2. KIỂM TRA CACHE
-        if file_hash in mindmap_cache:
-            logging.info(f"Cache HIT for hash: {file_hash}")
-            topic, final_nodes, detail_list, summary_list = mindmap_cache[file_hash]
-            return JSONResponse({
-                "topic": topic,
-                "mindmap_nodes": final_nodes, # Nodes không có x, y
-                "detail": detail_list,
-                "summary": summary_list
-            })
+        # 1. Chép upload ra một file tạm theo từng chunk, tính SHA-256 trong lúc chép
+        upload = await spool_upload(file, "tmp_files", MAX_UPLOAD_BYTES)
+        file_hash = upload.sha256
+
+        # 2. KIỂM TRA CACHE (khớp chính xác, rồi ảnh gần trùng)
+        cached, image = await lookup_mindmap(upload)
+        if cached is not None:
+            return JSONResponse(cached)
 
         # 3. KHÔNG CÓ CACHE -> GỌI MODEL
         logging.info(f"Cache MISS for hash: {file_hash}. Calling Mindmap generation...")
-        result = await asyncio.to_thread(call_mindmap_generation, file_bytes) 
-
-        if not isinstance(result, list) or len(result) != 2:
-            raise Exception(f"Vision Model trả về định dạng không hợp lệ: {result}")
-
-        topic, final_nodes = result # final_nodes ở đây là cấu trúc cây không có tọa độ
-
-        if isinstance(topic, str) and topic.startswith(("Lỗi", "Error", "Cannot", "Undefined Topic")):
-            # Xử lý lỗi từ mô hình vision/OCR/Fallback
-            return JSONResponse({
-                 "topic": topic,
-                 "detail": [f"Không thể phân tích hoặc Mindmap bị lỗi: {topic}"],
-                 "summary": [],
-                 "mindmap_nodes": []
-               })
-
-        if not final_nodes:
-            return JSONResponse({
-                "topic": topic if topic else "Topic Not Found",
-                "detail": ["Not enough content to create mindmap."],
-                "summary": [],
-                "mindmap_nodes": []
-            })
-
-        # Extract text for detail/summary
-        def extract_all_text(node):
-            items = [node.get("text", "")]
-            for child in node.get("children", []):
-                items.extend(extract_all_text(child))
-            return [i for i in items if i.strip()]
-
-        detail_list = []
-        summary_list = []
-        for node in final_nodes:
-            detail_list.extend(extract_all_text(node))
-            summary_list.append(node.get("text", ""))
-
-        # 4. LƯU VÀO CACHE TRƯỚC KHI TRẢ VỀ
-        mindmap_cache[file_hash] = (topic, final_nodes, detail_list, summary_list)
-        logging.info(f"Cache SAVED for hash: {file_hash}")
-
-        return JSONResponse({
-            "topic": topic,
-            "mindmap_nodes": final_nodes, # Trả về nodes dạng cây không tọa độ
-            "detail": detail_list, 
-            "summary": summary_list[:4]
-        })
+        # Tab bị đóng -> hủy lượt chờ này; single-flight chỉ hủy lời gọi llava khi không còn upload nào khác chờ
+        payload = await run_until_disconnected(
+            "/generate_mindmap",
+            build_mindmap(upload, image=image),
+            request.is_disconnected,
+            MINDMAP_DEADLINE,
+        )
+        return JSONResponse(payload)
 
+    except (AdmissionRejected, ClientDisconnected, DeadlineExceeded, UploadTooLarge):
+        raise
     except Exception as e:
         logging.exception("Lỗi Server Mindmap:")
         return JSONResponse({"error": f"Lỗi xử lý Mindmap: {str(e)}"}, status_code=500)
+    finally:
+        # File tạm thuộc về lượt OCR khi lượt này được chạy (nó có thể sống lâu hơn request bị hủy);
+        # upload trùng hash nhập vào lượt khác hoặc trúng cache thì xóa ngay
+        if upload is not None and not upload.taken:
+            upload.remove()
+
+# ----------------- MINDMAP TỪ TEXT -----------------
+# Text dán vào không cần file tạm, EasyOCR hay nhận diện ảnh: đi thẳng vào bước dựng mindmap của llava.
+# Cache theo hash của text đã chuẩn hóa (khoảng trắng, Unicode), chung kho với mindmap từ file.
+MINDMAP_TEXT_MIN_CHARS = 5
+MINDMAP_TEXT_MAX_CHARS = int(os.getenv("MINDMAP_TEXT_MAX_CHARS", "12000")) # ~ num_ctx 4096 của llava
+
+class MindmapTextRequest(BaseModel):
+    prompt: str
+
+async def build_text_mindmap(text: str, key: str) -> Dict[str, Any]:
+    result = await mindmap_flight.do(("mindmap-text", key), lambda: call_mindmap_generation_from_text(text))
+    return await finish_mindmap(key, result)
+
+@app.post("/generate_mindmap_from_text")
+async def generate_mindmap_from_text(request: Request, data: MindmapTextRequest):
+    text = normalize_mindmap_text(data.prompt)
+    if len(text) < MINDMAP_TEXT_MIN_CHARS:
+        return JSONResponse({"error": f"Văn bản quá ngắn (tối thiểu {MINDMAP_TEXT_MIN_CHARS} ký tự)."}, status_code=400)
+    if len(text) > MINDMAP_TEXT_MAX_CHARS:
+        return JSONResponse({"error": f"Văn bản quá dài (tối đa {MINDMAP_TEXT_MAX_CHARS} ký tự)."}, status_code=413)
+
+    key = text_cache_key(text)
+    try:
+        entry = await mindmap_cache.lookup(key)
+        if entry is not None:
+            logging.info(f"Cache HIT for key: {key}")
+            payload, stale = entry
+            if stale:
+                if can_revalidate():
+                    start_revalidation(key, lambda: build_text_mindmap(text, key))
+                payload = {**payload, "stale": True}
+            return JSONResponse(payload)
+
+        logging.info(f"Cache MISS for key: {key}. Calling Mindmap generation from text...")
+        payload = await run_until_disconnected(
+            "/generate_mindmap_from_text",
+            build_text_mindmap(text, key),
+            request.is_disconnected,
+            MINDMAP_DEADLINE,
+        )
+        return JSONResponse(payload)
+
+    except (AdmissionRejected, ClientDisconnected, DeadlineExceeded):
+        raise
+    except Exception as e:
+        logging.exception("Lỗi Server Mindmap (text):")
+        return JSONResponse({"error": f"Lỗi xử lý Mindmap: {str(e)}"}, status_code=500)
+
+# ----------------- MINDMAP JOB (BẤT ĐỒNG BỘ) -----------------
+# POST trả job_id ngay; client poll GET /mindmap_jobs/{id} hoặc nghe SSE /mindmap_jobs/{id}/events
+# thay vì giữ một kết nối HTTP suốt lượt llava (dễ vượt timeout của proxy / trình duyệt)
+async def process_mindmap_job(job) -> Dict[str, Any]:
+    # File thuộc về job (MindmapJobs xóa khi job xong): bị hủy vì tắt server thì file còn để chạy lại
+    upload = SpooledUpload(job.upload_path, job.file_hash, job.size, persistent=True)
+    # Có thể đã được request khác sinh xong trong lúc job xếp hàng
+    cached, image = await lookup_mindmap(upload)
+    if cached is not None:
+        mindmap_jobs.record_stage(job, "cached")
+        return cached
+    return await build_mindmap(upload, lambda stage, **info: mindmap_jobs.record_stage(job, stage, **info),
+                               image)
+
+mindmap_jobs = MindmapJobs(
+    os.getenv("MINDMAP_JOBS_PATH", "mindmap_cache_data/mindmap_jobs.db"),
+    process_mindmap_job,
+    workers=int(os.getenv("MINDMAP_JOB_WORKERS", "2")),
+    max_queued=int(os.getenv("MINDMAP_JOB_QUEUE", "100")),
+    deadline=MINDMAP_DEADLINE,
+)
+
+@app.exception_handler(JobQueueFull)
+async def job_queue_full_handler(request, exc: JobQueueFull):
+    return JSONResponse(
+        {"error": "Hàng đợi mindmap đang đầy. Vui lòng thử lại sau.", "retry_after": exc.retry_after},
+        status_code=429,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+def job_links(job_id: str) -> Dict[str, str]:
+    return {"poll": f"/mindmap_jobs/{job_id}", "events": f"/mindmap_jobs/{job_id}/events"}
+
+@app.post("/mindmap_jobs")
+async def create_mindmap_job(file: UploadFile = File(...)):
+    upload = await spool_upload(file, "tmp_files", MAX_UPLOAD_BYTES)
+    # Chỉ khớp chính xác: tìm gần trùng cần OCR, việc đó để job làm thay vì giữ request này
+    cached, _ = await lookup_mindmap(upload, near=False)
+    if cached is not None:
+        if not upload.taken:
+            upload.remove()
+        return {"status": "done", "cached": True, "result": cached}
+
+    try:
+        job, created = await mindmap_jobs.submit(upload.sha256, upload.path, upload.size)
+    except BaseException:
+        upload.remove()
+        raise
+    if not created:
+        # Cùng file đang có job chờ/chạy -> dùng job đó
+        upload.remove()
+    return JSONResponse({"job_id": job.id, "status": job.status, **job_links(job.id)}, status_code=202)
+
+@app.get("/mindmap_jobs/{job_id}")
+async def get_mindmap_job(job_id: str):
+    job = await mindmap_jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"error": "Không tìm thấy job"}, status_code=404)
+    return {**job.to_dict(), **job_links(job.id)}
+
+@app.get("/mindmap_jobs/{job_id}/events")
+async def mindmap_job_events(job_id: str):
+    if await mindmap_jobs.get(job_id) is None:
+        return JSONResponse({"error": "Không tìm thấy job"}, status_code=404)
+
+    async def event_stream():
+        async for event in mindmap_jobs.events(job_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {event['stage']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 # ----------------- RUN -----------------
 if __name__ == "__main__":
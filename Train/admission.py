@@ -0,0 +1,155 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict
+
+
+class AdmissionRejected(Exception):
+    """Model đang quá tải: hàng đợi đầy (429) hoặc chờ quá hạn (503). Server trả về kèm Retry-After."""
+
+    def __init__(self, model: str, reason: str, status_code: int, retry_after: int):
+        super().__init__(f"{model}: {reason}")
+        self.model = model
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def _percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)]
+
+
+class ModelLimiter:
+    """
+    Giới hạn số lời gọi đồng thời tới một model, với hàng đợi FIFO có giới hạn và hạn chờ.
+    Ghi lại thời gian chờ trong hàng đợi và thời gian giữ slot (≈ thời gian sinh) gần đây.
+    """
+
+    def __init__(self, model: str, max_concurrency: int, max_queue: int, queue_timeout: float, window: int = 200):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        # max_concurrency được cấu hình cho MỘT host; pool nhiều host nhân lên theo số host dùng được
+        self.per_host_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.wait_times: Deque[float] = deque(maxlen=window)
+        self.service_times: Deque[float] = deque(maxlen=window)
+
+        self.arrivals = 0  # Số lần gọi _acquire, kể cả bị từ chối (TierGovernor dùng để khớp các route đang tới)
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        if self.service_times:
+            avg_service = sum(self.service_times) / len(self.service_times)
+        else:
+            # Chưa có mẫu thời gian sinh: ước lượng thô bằng phần queue_timeout của mỗi slot. Ví dụ pro
+            # (queue_timeout 20, 2 slot, hàng đợi đầy 16): 10 s × 8.5 vòng = 85 s thay vì 20 s × 8.5 = 170 s
+            avg_service = self.queue_timeout / max(self.max_concurrency, 1)
+        rounds = (self.queue_depth + 1) / max(self.max_concurrency, 1)
+        return max(1, int(math.ceil(avg_service * rounds)))
+
+    async def _acquire(self):
+        self.arrivals += 1
+        if self.in_flight < self.max_concurrency and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_full += 1
+            raise AdmissionRejected(self.model, "queue full", 429, self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                return  # Slot được trao đúng lúc hết hạn: vẫn dùng
+            self._waiters.remove(waiter)
+            self.rejected_timeout += 1
+            raise AdmissionRejected(self.model, "queue wait deadline exceeded", 503, self.retry_after())
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # Đã được trao slot nhưng bên gọi bỏ đi -> trả lại
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        # Trao slot trực tiếp cho người chờ đầu tiên, in_flight giữ nguyên
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def set_hosts(self, hosts: int):
+        self.max_concurrency = self.per_host_concurrency * max(1, hosts)
+        # Thêm host -> trao ngay slot mới cho các request đang xếp hàng
+        while self.in_flight < self.max_concurrency and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self):
+        queued_at = time.monotonic()
+        await self._acquire()
+        started = time.monotonic()
+        self.wait_times.append(started - queued_at)
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.service_times.append(time.monotonic() - started)
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "wait_p50_s": round(_percentile(self.wait_times, 0.5), 3),
+            "wait_p95_s": round(_percentile(self.wait_times, 0.95), 3),
+            "service_p95_s": round(_percentile(self.service_times, 0.95), 3),
+        }
+
+
+# Mặc định cho model chưa được cấu hình riêng
+DEFAULT_LIMITS = {"max_concurrency": 4, "max_queue": 32, "queue_timeout": 30.0}
+
+_limiters: Dict[str, ModelLimiter] = {}
+
+
+def configure_limit(model: str, max_concurrency: int, max_queue: int, queue_timeout: float) -> ModelLimiter:
+    _limiters[model] = ModelLimiter(model, max_concurrency, max_queue, queue_timeout)
+    return _limiters[model]
+
+
+def get_limiter(model: str) -> ModelLimiter:
+    if model not in _limiters:
+        configure_limit(model, **DEFAULT_LIMITS)
+    return _limiters[model]
+
+
+def all_stats() -> Dict[str, Dict[str, Any]]:
+    return {model: limiter.stats() for model, limiter in _limiters.items()}
@@ -0,0 +1,305 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List
+
+import httpx
+
+from .history import estimate_tokens
+
+logging.basicConfig(level=logging.INFO)
+
+
+class ChatResult(dict):
+    """Kết quả dạng dict nhưng đọc được cả kiểu thuộc tính (response.message) như ChatResponse của ollama."""
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+def _result(model: str, content: str, done: bool = True, **fields) -> ChatResult:
+    return ChatResult(model=model, message=ChatResult(role="assistant", content=content), done=done, **fields)
+
+
+class InferenceBackend:
+    """
+    Giao diện chung của runtime suy luận, theo đúng hình dạng của ollama.AsyncClient mà các module
+    Train/ đang dùng (qua ollama_client), nên đổi runtime chỉ cần đổi INFERENCE_BACKEND.
+
+    - chat(model, messages, options, stream=False, **kwargs): stream=False trả về một kết quả có
+      message.content; stream=True trả về async iterator các phần, phần cuối có done=True.
+      Cả hai mang prompt_eval_count / prompt_eval_duration (ns) / eval_count khi runtime có số liệu.
+    - generate(model, prompt, keep_alive): nạp model (warm-up).
+    - ps(): {"models": [{"model", "size", "expires_at"}]} các model đang nằm trong RAM.
+    - embed(model, input): {"embeddings": [[...]]}.
+    """
+
+    name = "base"
+
+    async def chat(self, model: str, messages: List[Dict[str, Any]], options: Dict[str, Any] | None = None,
+                   stream: bool = False, **kwargs):
+        raise NotImplementedError
+
+    async def generate(self, model: str, prompt: str = "", keep_alive: Any = None):
+        raise NotImplementedError
+
+    async def ps(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    async def embed(self, model: str, input: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class OllamaBackend(InferenceBackend):
+    name = "ollama"
+
+    def __init__(self, host: str, limits: httpx.Limits, connect_timeout: float):
+        from ollama import AsyncClient
+        # Timeout tổng do ollama_client quản lý; httpx chỉ cần giới hạn connect
+        self._client = AsyncClient(host=host, timeout=httpx.Timeout(None, connect=connect_timeout), limits=limits)
+
+    async def chat(self, model, messages, options=None, stream=False, **kwargs):
+        return await self._client.chat(model=model, messages=messages, options=options, stream=stream, **kwargs)
+
+    async def generate(self, model, prompt="", keep_alive=None):
+        return await self._client.generate(model=model, prompt=prompt, keep_alive=keep_alive)
+
+    async def ps(self):
+        return await self._client.ps()
+
+    async def embed(self, model, input):
+        return await self._client.embed(model=model, input=input)
+
+    async def aclose(self):
+        # AsyncClient của ollama không có close() ở mọi phiên bản -> đóng httpx client bên trong
+        await self._client._client.aclose()
+
+
+# Tên option của Ollama -> tham số tương ứng của API OpenAI (llama.cpp server hiểu thêm top_k, seed...)
+OPENAI_OPTION_NAMES = {
+    "temperature": "temperature", "top_p": "top_p", "top_k": "top_k", "seed": "seed",
+    "num_predict": "max_tokens", "stop": "stop", "repeat_penalty": "repeat_penalty",
+}
+
+
+class OpenAICompatBackend(InferenceBackend):
+    """
+    Server tương thích OpenAI chạy local (llama.cpp `llama-server`, vLLM...), qua /v1/chat/completions.
+    Tên model trong request phải trùng tên server công bố ở /v1/models (llama-server --alias gemma3:1b).
+    Số liệu prompt-eval lấy từ `timings` của llama.cpp (chỉ đếm token không nằm trong KV cache),
+    nếu không có thì từ `usage`.
+    """
+
+    name = "openai"
+
+    def __init__(self, host: str, limits: httpx.Limits, connect_timeout: float, api_key: str | None = None):
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self._http = httpx.AsyncClient(base_url=host, headers=headers, limits=limits,
+                                       timeout=httpx.Timeout(None, connect=connect_timeout))
+
+    @staticmethod
+    def _convert_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Ảnh kiểu Ollama (images=[...] hoặc phần {"type": "image", "path": ...}) -> image_url base64."""
+        def image_part(image) -> Dict[str, Any]:
+            if isinstance(image, str) and os.path.exists(image):
+                with open(image, "rb") as f:
+                    image = f.read()
+            data = base64.b64encode(image).decode() if isinstance(image, bytes) else image
+            return {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{data}"}}
+
+        converted = []
+        for m in messages:
+            content = m.get("content", "")
+            if isinstance(content, list):
+                content = [image_part(p["path"]) if p.get("type") == "image" else p for p in content]
+            if m.get("images"):
+                content = ([{"type": "text", "text": content}] if isinstance(content, str) else content)
+                content += [image_part(i) for i in m["images"]]
+            converted.append({"role": m["role"], "content": content})
+        return converted
+
+    def _payload(self, model, messages, options, stream, kwargs) -> Dict[str, Any]:
+        payload = {"model": model, "messages": self._convert_messages(messages), "stream": stream}
+        for key, value in (options or {}).items():
+            if key in OPENAI_OPTION_NAMES:
+                payload[OPENAI_OPTION_NAMES[key]] = value
+        if kwargs.get("format") == "json":
+            payload["response_format"] = {"type": "json_object"}
+        if kwargs.get("logprobs"):
+            payload["logprobs"] = True
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    @staticmethod
+    def _metrics(body: Dict[str, Any]) -> Dict[str, Any]:
+        timings = body.get("timings") or {}
+        usage = body.get("usage") or {}
+        return {
+            "prompt_eval_count": timings.get("prompt_n", usage.get("prompt_tokens")),
+            "prompt_eval_duration": int(timings["prompt_ms"] * 1e6) if "prompt_ms" in timings else None,
+            "eval_count": timings.get("predicted_n", usage.get("completion_tokens")),
+        }
+
+    async def chat(self, model, messages, options=None, stream=False, **kwargs):
+        payload = self._payload(model, messages, options, stream, kwargs)
+        if stream:
+            return self._stream(model, payload)
+
+        response = await self._http.post("/v1/chat/completions", json=payload)
+        response.raise_for_status()
+        body = response.json()
+        choice = body["choices"][0]
+        logprobs = [{"token": t["token"], "logprob": t["logprob"]}
+                    for t in ((choice.get("logprobs") or {}).get("content") or [])]
+        return _result(model, choice["message"].get("content") or "", logprobs=logprobs or None, **self._metrics(body))
+
+    async def _stream(self, model, payload) -> AsyncIterator[ChatResult]:
+        last: Dict[str, Any] = {}
+        async with self._http.stream("POST", "/v1/chat/completions", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage") or chunk.get("timings"):
+                    last = chunk
+                for choice in chunk.get("choices") or []:
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        yield _result(model, content, done=False)
+        yield _result(model, "", done=True, **self._metrics(last))
+
+    async def generate(self, model, prompt="", keep_alive=None):
+        # Server OpenAI nạp model lúc khởi động: một request 1 token là đủ để "làm nóng"
+        payload = {"model": model, "messages": [{"role": "user", "content": prompt or "hi"}], "max_tokens": 1}
+        response = await self._http.post("/v1/chat/completions", json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    async def ps(self):
+        response = await self._http.get("/v1/models")
+        response.raise_for_status()
+        return {"models": [{"model": m["id"], "size": 0, "expires_at": None} for m in response.json().get("data", [])]}
+
+    async def embed(self, model, input):
+        response = await self._http.post("/v1/embeddings", json={"model": model, "input": input})
+        response.raise_for_status()
+        return {"embeddings": [d["embedding"] for d in response.json()["data"]]}
+
+    async def aclose(self):
+        await self._http.aclose()
+
+
+FAKE_VOCABULARY = (
+    "mô hình trả lời câu hỏi này bằng một đoạn văn bản giả lập có độ dài cố định để đo thời gian xử lý "
+    "the fake backend answers with deterministic text so load tests are repeatable across runs"
+).split()
+
+
+class FakeBackend(InferenceBackend):
+    """
+    Backend giả, tất định, không cần model: dùng để đo overhead và hành vi đồng thời của chính Server.py.
+    Độ trễ mô phỏng = token prompt phải tính × prompt_ms_per_token + output_tokens / tokens_per_sec.
+    Mô phỏng thêm KV cache theo prefix (phần đầu giống prompt trước của model không phải tính lại) và
+    số slot song song của runtime (OLLAMA_NUM_PARALLEL): request vượt quá phải chờ.
+    """
+
+    name = "fake"
+
+    def __init__(self, prompt_ms_per_token: float = 0.5, tokens_per_sec: float = 30.0,
+                 output_tokens: int = 64, parallel: int = 1):
+        self.prompt_ms_per_token = prompt_ms_per_token
+        self.tokens_per_sec = tokens_per_sec
+        self.output_tokens = output_tokens
+        self.parallel = parallel
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+        self._last_prompt: Dict[str, str] = {}
+        self._loaded: Dict[str, float] = {}
+
+    def _slot(self, model: str) -> asyncio.Semaphore:
+        if model not in self._slots:
+            self._slots[model] = asyncio.Semaphore(self.parallel)
+        return self._slots[model]
+
+    def _prompt_eval(self, model: str, messages: List[Dict[str, Any]]) -> tuple:
+        prompt = json.dumps(messages, ensure_ascii=False, default=str)
+        previous = self._last_prompt.get(model, "")
+        common = os.path.commonprefix([prompt, previous])
+        self._last_prompt[model] = prompt
+        total = estimate_tokens(prompt)
+        evaluated = max(1, total - estimate_tokens(common))
+        return evaluated, evaluated * self.prompt_ms_per_token / 1e3
+
+    def _answer(self, model: str, messages: List[Dict[str, Any]]) -> List[str]:
+        last = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "")
+        digest = hashlib.sha256(f"{model}\n{last}".encode("utf-8")).digest()
+        return [FAKE_VOCABULARY[digest[i % len(digest)] % len(FAKE_VOCABULARY)] for i in range(self.output_tokens)]
+
+    async def chat(self, model, messages, options=None, stream=False, **kwargs):
+        words = self._answer(model, messages)
+        limit = (options or {}).get("num_predict")
+        if limit is not None and limit >= 0:
+            words = words[:limit]
+        extra = {"logprobs": [{"token": w, "logprob": math.log(0.8)} for w in words]} if kwargs.get("logprobs") else {}
+        if stream:
+            return self._stream(model, messages, words)
+
+        async with self._slot(model):
+            evaluated, prompt_seconds = self._prompt_eval(model, messages)
+            await asyncio.sleep(prompt_seconds + len(words) / self.tokens_per_sec)
+        self._loaded[model] = time.time()
+        return _result(model, " ".join(words), prompt_eval_count=evaluated,
+                       prompt_eval_duration=int(prompt_seconds * 1e9), eval_count=len(words), **extra)
+
+    async def _stream(self, model, messages, words) -> AsyncIterator[ChatResult]:
+        async with self._slot(model):
+            evaluated, prompt_seconds = self._prompt_eval(model, messages)
+            await asyncio.sleep(prompt_seconds)
+            for i, word in enumerate(words):
+                await asyncio.sleep(1 / self.tokens_per_sec)
+                yield _result(model, word if i == 0 else f" {word}", done=False)
+        self._loaded[model] = time.time()
+        yield _result(model, "", done=True, prompt_eval_count=evaluated,
+                      prompt_eval_duration=int(prompt_seconds * 1e9), eval_count=len(words))
+
+    async def generate(self, model, prompt="", keep_alive=None):
+        self._loaded[model] = time.time()
+        return {}
+
+    async def ps(self):
+        return {"models": [{"model": m, "size": 0, "expires_at": None} for m in self._loaded]}
+
+    async def embed(self, model, input):
+        # Vector tất định từ hash: cùng câu -> cùng vector, câu khác -> gần như trực giao
+        digest = hashlib.sha256(input.encode("utf-8")).digest()
+        return {"embeddings": [[(b - 127.5) / 127.5 for b in digest]]}
+
+
+def create_backend(name: str, host: str, limits: httpx.Limits, connect_timeout: float) -> InferenceBackend:
+    if name == "ollama":
+        return OllamaBackend(host, limits, connect_timeout)
+    if name == "openai":
+        return OpenAICompatBackend(host, limits, connect_timeout, api_key=os.getenv("OPENAI_API_KEY"))
+    if name == "fake":
+        return FakeBackend(
+            prompt_ms_per_token=float(os.getenv("FAKE_PROMPT_MS_PER_TOKEN", "0.5")),
+            tokens_per_sec=float(os.getenv("FAKE_TOKENS_PER_SEC", "30")),
+            output_tokens=int(os.getenv("FAKE_OUTPUT_TOKENS", "64")),
+            parallel=int(os.getenv("FAKE_PARALLEL", "1")),
+        )
+    raise ValueError(f"Unknown inference backend: {name} (expected ollama, openai or fake)")
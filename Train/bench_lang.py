@@ -0,0 +1,67 @@
+"""
+So sánh bộ phát hiện ngôn ngữ nhanh với langdetect (cách cũ) trên tập câu chat đã gán nhãn.
+
+    python -m Train.bench_lang
+    python -m Train.bench_lang --rounds 50
+"""
+import argparse
+import json
+import os
+import time
+from typing import Callable, List, Tuple
+
+from .lang_detect import detect_language_fast
+
+CASES_PATH = os.path.join(os.path.dirname(__file__), "lang_cases.jsonl")
+
+
+def load_cases(path: str = CASES_PATH) -> List[Tuple[str, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [(c["text"], c["lang"]) for c in map(json.loads, f) if c]
+
+
+def legacy_detect_language(text: str) -> str:
+    """detect_language trước đây: langdetect cho mọi câu, không cố định seed."""
+    from langdetect import detect
+    try:
+        lang = detect(text)
+        return lang if lang in ["vi", "en"] else "en"
+    except Exception:
+        return "en"
+
+
+def measure(name: str, detect: Callable[[str], str], cases: List[Tuple[str, str]], rounds: int):
+    # Lần gọi đầu của langdetect phải nạp profile -> đo riêng
+    start = time.perf_counter()
+    detect(cases[0][0])
+    first_call_ms = (time.perf_counter() - start) * 1e3
+
+    correct = sum(detect(text) == lang for text, lang in cases)
+    wrong = [(text, lang) for text, lang in cases if detect(text) != lang]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text, _ in cases:
+            detect(text)
+    per_call_us = (time.perf_counter() - start) / (rounds * len(cases)) * 1e6
+
+    print(f"{name:<24} accuracy {correct}/{len(cases)} ({correct / len(cases):.1%})  "
+          f"{per_call_us:.1f} us/call  first call {first_call_ms:.1f} ms")
+    for text, lang in wrong:
+        print(f"    expected {lang} <- {text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", default=CASES_PATH)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    cases = load_cases(args.cases)
+    # Đo langdetect trước để "first call" của nó gồm cả thời gian nạp profile
+    measure("legacy langdetect", legacy_detect_language, cases, args.rounds)
+    measure("fast (diacritics+hints)", lambda t: detect_language_fast(t)[0], cases, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
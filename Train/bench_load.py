@@ -0,0 +1,105 @@
+"""
+Bắn tải đồng thời vào Server.py đang chạy và đo độ trễ / thông lượng / mã lỗi.
+Chạy server với backend giả để đo overhead và hành vi đồng thời của chính server, không cần model:
+
+    INFERENCE_BACKEND=fake FAKE_TOKENS_PER_SEC=50 uvicorn Server:app --port 8000
+    python -m Train.bench_load --concurrency 32 --requests 400
+    python -m Train.bench_load --endpoint /ask_stream --unique-sessions
+
+Với backend giả, độ trễ lý thuyết của một câu ≈ prompt × FAKE_PROMPT_MS_PER_TOKEN + FAKE_OUTPUT_TOKENS / FAKE_TOKENS_PER_SEC;
+phần vượt quá (khi tải thấp) là overhead của server.
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+from collections import Counter
+from typing import List
+
+import httpx
+
+QUESTIONS = [
+    "xin chào bạn",
+    "hello, who are you?",
+    "giải thích vì sao bầu trời có màu xanh",
+    "what is the difference between RAM and ROM?",
+    "tóm tắt lịch sử chiến tranh thế giới thứ hai",
+    "cảm ơn bạn nhiều",
+    "how does a transformer model work?",
+    "phân tích ưu nhược điểm của năng lượng mặt trời",
+]
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)]
+
+
+async def one_request(client: httpx.AsyncClient, args, i: int, latencies: List[float], first_tokens: List[float], codes: Counter):
+    session_id = f"bench-{i}" if args.unique_sessions else f"bench-{i % args.sessions}"
+    payload = {"session_id": session_id, "question": QUESTIONS[i % len(QUESTIONS)]}
+    start = time.perf_counter()
+    try:
+        if args.endpoint == "/ask_stream":
+            async with client.stream("POST", args.endpoint, json=payload) as response:
+                first = None
+                async for line in response.aiter_lines():
+                    if first is None and line and json.loads(line).get("type") == "token":
+                        first = time.perf_counter() - start
+                codes[response.status_code] += 1
+                if first is not None:
+                    first_tokens.append(first)
+        else:
+            response = await client.post(args.endpoint, json=payload)
+            codes[response.status_code] += 1
+    except httpx.HTTPError as e:
+        codes[type(e).__name__] += 1
+        return
+    latencies.append(time.perf_counter() - start)
+
+
+async def main_async(args):
+    latencies: List[float] = []
+    first_tokens: List[float] = []
+    codes: Counter = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout,
+                                 limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        async def bounded(i):
+            async with semaphore:
+                await one_request(client, args, i, latencies, first_tokens, codes)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(bounded(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+        print(f"{args.requests} requests, concurrency {args.concurrency}, {elapsed:.2f}s, "
+              f"{len(latencies) / elapsed:.1f} req/s")
+        print(f"status {dict(codes)}")
+        print(f"latency p50 {percentile(latencies, 0.5) * 1e3:.0f} ms  p95 {percentile(latencies, 0.95) * 1e3:.0f} ms  "
+              f"p99 {percentile(latencies, 0.99) * 1e3:.0f} ms")
+        if first_tokens:
+            print(f"first token p50 {percentile(first_tokens, 0.5) * 1e3:.0f} ms  p95 {percentile(first_tokens, 0.95) * 1e3:.0f} ms")
+        if args.stats:
+            print(json.dumps((await client.get("/stats")).json(), ensure_ascii=False, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoint", default="/ask", choices=["/ask", "/ask_stream"])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--sessions", type=int, default=50, help="số session dùng xoay vòng")
+    parser.add_argument("--unique-sessions", action="store_true", help="mỗi request một session mới")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--stats", action="store_true", help="in /stats của server sau khi chạy")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
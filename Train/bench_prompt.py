@@ -0,0 +1,99 @@
+"""
+Đo prompt-eval của một hội thoại nhiều lượt với Ollama thật: bố cục prompt cũ
+(system ngôn ngữ + tóm tắt đứng trước lịch sử) so với prompt_builder (prefix tĩnh).
+
+    python -m Train.bench_prompt
+    python -m Train.bench_prompt --model gemma3:4b-it-q8_0 --turns 8 --rounds 3
+
+Mỗi lượt chạy một bố cục bắt đầu từ model vừa nạp lại (KV cache rỗng), thứ tự các bố cục được xáo
+ngẫu nhiên mỗi vòng: bố cục chạy trước không được làm nóng prefix dùng chung cho bố cục chạy sau.
+"""
+import argparse
+import asyncio
+import random
+from typing import Callable, Dict, List
+
+from ollama import AsyncClient
+
+from .model_gemma_small_chat import SYSTEM_PROMPT_FORMAT
+from .prompt_builder import LANGUAGE_DIRECTIVES, build_chat_messages
+
+QUESTIONS = [
+    ("vi", "Xin chào, bạn có thể giúp tôi ôn tập sinh học không?"),
+    ("vi", "Quang hợp diễn ra ở đâu trong tế bào?"),
+    ("en", "Can you explain that again in English?"),
+    ("vi", "Vậy hô hấp tế bào khác quang hợp thế nào?"),
+    ("en", "Give me a short summary of both processes."),
+    ("vi", "Cho tôi một câu hỏi trắc nghiệm để tự kiểm tra."),
+    ("vi", "Đáp án đúng là gì và vì sao?"),
+    ("en", "Thanks, what topic should I study next?"),
+]
+
+
+def legacy_layout(language: str, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Bố cục trước đây: chỉ dẫn ngôn ngữ là system thứ hai, đứng trước toàn bộ lịch sử."""
+    lang_prompt = {
+        "vi": "Bạn là trợ lý AI hữu ích, lịch sự và thân thiện. Luôn trả lời bằng tiếng Việt.",
+        "en": "You are a helpful, polite, and friendly AI assistant. Always reply in English.",
+    }[language]
+    return [{"role": "system", "content": SYSTEM_PROMPT_FORMAT}, {"role": "system", "content": lang_prompt}] + history
+
+
+def prefix_layout(language: str, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    return build_chat_messages(SYSTEM_PROMPT_FORMAT, [{"role": "system", "content": LANGUAGE_DIRECTIVES[language]}] + history)
+
+
+async def run(name: str, layout: Callable, client: AsyncClient, model: str, turns: int, num_predict: int):
+    history: List[Dict[str, str]] = []
+    total_count = total_ns = 0
+    print(name)
+    for i, (language, question) in enumerate(QUESTIONS[:turns]):
+        history.append({"role": "user", "content": question})
+        response = await client.chat(model=model, messages=layout(language, history),
+                                     options={"temperature": 0, "num_predict": num_predict})
+        history.append({"role": "assistant", "content": response["message"]["content"]})
+        count, ns = response["prompt_eval_count"] or 0, response["prompt_eval_duration"] or 0
+        total_count += count
+        total_ns += ns
+        print(f"    turn {i + 1} [{language}] prompt_eval {count:>5} tokens {ns / 1e6:>8.1f} ms")
+    print(f"    total {total_count} tokens {total_ns / 1e6:.1f} ms")
+    return total_ns
+
+
+async def cold_start(client: AsyncClient, model: str):
+    # keep_alive=0 dỡ model (và KV cache của nó) khỏi bộ nhớ, lời gọi sau nạp lại từ đầu
+    await client.generate(model=model, prompt="", keep_alive=0)
+    await client.generate(model=model, prompt="")
+
+
+async def main_async(args):
+    client = AsyncClient(host=args.host)
+    rng = random.Random(args.seed)
+    layouts = [("legacy layout", legacy_layout), ("prefix-stable layout", prefix_layout)]
+    totals = {name: 0 for name, _ in layouts}
+    for round_no in range(args.rounds):
+        order = layouts[:]
+        rng.shuffle(order)
+        print(f"round {round_no + 1}: {' -> '.join(name for name, _ in order)}")
+        for name, layout in order:
+            await cold_start(client, args.model)
+            totals[name] += await run(name, layout, client, args.model, args.turns, args.num_predict)
+    legacy_ns, prefix_ns = totals["legacy layout"], totals["prefix-stable layout"]
+    if legacy_ns:
+        print(f"prompt-eval time saved: {(legacy_ns - prefix_ns) / 1e6:.1f} ms ({1 - prefix_ns / legacy_ns:.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="http://127.0.0.1:11434")
+    parser.add_argument("--model", default="gemma3:1b")
+    parser.add_argument("--turns", type=int, default=len(QUESTIONS))
+    parser.add_argument("--num-predict", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
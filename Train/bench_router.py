@@ -0,0 +1,96 @@
+"""
+Đo độ chính xác và chi phí mỗi lần gọi của router trên tập câu hỏi đã gán nhãn.
+
+    python -m Train.bench_router                      # keyword router vs assess_complexity cũ
+    python -m Train.bench_router --weights w.npy      # thêm classifier đã huấn luyện
+    python -m Train.bench_router --train w.npy        # huấn luyện logistic regression trên tập nhãn
+"""
+import argparse
+import json
+import os
+import time
+from typing import Callable, List, Tuple
+
+from .router import (
+    ComplexityRouter, DEFAULT_HASH_BUCKETS, HIGH_COMPLEXITY_KEYWORDS, LOW_COMPLEXITY_KEYWORDS,
+    hashed_ngram_features,
+)
+
+CASES_PATH = os.path.join(os.path.dirname(__file__), "routing_cases.jsonl")
+
+
+def load_cases(path: str = CASES_PATH) -> List[Tuple[str, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [(c["question"], c["tier"]) for c in map(json.loads, f) if c]
+
+
+def legacy_assess_complexity(question: str) -> str:
+    """Bản assess_complexity trước khi có router (quét chuỗi con trên list), để so sánh."""
+    q_lower = question.lower().strip()
+    if any(word in q_lower for word in LOW_COMPLEXITY_KEYWORDS) or len(q_lower.split()) <= 4:
+        return "small"
+    if any(word in q_lower for word in HIGH_COMPLEXITY_KEYWORDS):
+        return "pro"
+    if len(q_lower.split()) > 6:
+        return "pro"
+    return "small"
+
+
+def measure(name: str, route: Callable[[str], str], cases: List[Tuple[str, str]], rounds: int):
+    correct = sum(route(q) == tier for q, tier in cases)
+    misrouted = [(q, tier) for q, tier in cases if route(q) != tier]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for q, _ in cases:
+            route(q)
+    per_call_us = (time.perf_counter() - start) / (rounds * len(cases)) * 1e6
+
+    print(f"{name:<22} accuracy {correct}/{len(cases)} ({correct / len(cases):.1%})  {per_call_us:.2f} us/call")
+    for q, tier in misrouted:
+        print(f"    expected {tier:<5} <- {q}")
+
+
+def train(cases: List[Tuple[str, str]], out_path: str, buckets: int = DEFAULT_HASH_BUCKETS,
+          epochs: int = 300, lr: float = 0.5, l2: float = 1e-4):
+    """Logistic regression trên đặc trưng n-gram băm (gradient descent đầy đủ, đủ cho vài nghìn câu)."""
+    import numpy as np
+
+    weights = np.zeros(buckets + 1)
+    features = [hashed_ngram_features(q, buckets) for q, _ in cases]
+    labels = np.array([1.0 if tier == "pro" else 0.0 for _, tier in cases])
+
+    for _ in range(epochs):
+        scores = np.array([weights[idx].sum() + weights[-1] for idx in features])
+        errors = 1.0 / (1.0 + np.exp(-scores)) - labels
+        grad = l2 * weights
+        for idx, err in zip(features, errors):
+            np.add.at(grad, idx, err / len(cases))
+        grad[-1] = errors.mean()
+        weights -= lr * grad
+
+    np.save(out_path, weights)
+    print(f"Saved {buckets} bucket weights + bias to {out_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", default=CASES_PATH)
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--weights", help="file .npy của classifier để đánh giá")
+    parser.add_argument("--train", metavar="OUT", help="huấn luyện classifier và lưu vào OUT (.npy)")
+    args = parser.parse_args()
+
+    cases = load_cases(args.cases)
+    if args.train:
+        train(cases, args.train)
+        args.weights = args.train
+
+    measure("legacy substring scan", legacy_assess_complexity, cases, args.rounds)
+    measure("compiled keywords", ComplexityRouter().route_by_keywords, cases, args.rounds)
+    if args.weights:
+        measure("hashed n-gram LR", ComplexityRouter(weights_path=args.weights).route, cases, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
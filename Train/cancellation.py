@@ -0,0 +1,87 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict
+
+# Khoảng thời gian (giây) giữa hai lần hỏi xem client còn kết nối không
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+class ClientDisconnected(Exception):
+    """Client đã ngắt kết nối (bấm dừng, đóng tab) trước khi có kết quả."""
+
+
+class DeadlineExceeded(Exception):
+    """Request vượt quá hạn chót của endpoint."""
+
+    def __init__(self, deadline: float):
+        super().__init__(f"deadline of {deadline:g}s exceeded")
+        self.deadline = deadline
+
+
+class AbortStats:
+    def __init__(self):
+        self.disconnected: Dict[str, int] = {}
+        self.deadline_exceeded: Dict[str, int] = {}
+
+    def record(self, counter: Dict[str, int], endpoint: str):
+        counter[endpoint] = counter.get(endpoint, 0) + 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"disconnected": dict(self.disconnected), "deadline_exceeded": dict(self.deadline_exceeded)}
+
+
+abort_stats = AbortStats()
+
+
+async def run_until_disconnected(endpoint: str, work: Awaitable[Any], is_disconnected: Callable[[], Awaitable[bool]],
+                                 deadline: float) -> Any:
+    """
+    Chạy `work` nhưng hủy nó ngay khi client ngắt kết nối hoặc quá `deadline` giây.
+    Hủy task sẽ lan xuống lời gọi Ollama (single-flight hủy lời gọi chung khi không còn ai chờ,
+    httpx đóng kết nối và Ollama dừng sinh) nên CPU được giải phóng thay vì sinh cho người đã bỏ đi.
+    """
+    task = asyncio.ensure_future(work)
+    loop = asyncio.get_running_loop()
+    expires = loop.time() + deadline
+    try:
+        while True:
+            remaining = expires - loop.time()
+            if remaining <= 0:
+                abort_stats.record(abort_stats.deadline_exceeded, endpoint)
+                raise DeadlineExceeded(deadline)
+            done, _ = await asyncio.wait({task}, timeout=min(DISCONNECT_POLL_INTERVAL, remaining))
+            if done:
+                return task.result()
+            if await is_disconnected():
+                abort_stats.record(abort_stats.disconnected, endpoint)
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+            # Chờ task dọn dẹp xong (đóng stream, trả slot) trước khi trả lời
+            await asyncio.gather(task, return_exceptions=True)
+
+
+async def iterate_with_deadline(endpoint: str, parts: AsyncIterator[Any], deadline: float,
+                                started_at: float) -> AsyncIterator[Any]:
+    """
+    Duyệt một async generator cho tới hạn `deadline` giây tính từ `started_at` (theo loop.time()).
+    Luôn aclose() generator khi dừng, kể cả khi bị hủy giữa chừng.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            remaining = started_at + deadline - loop.time()
+            if remaining <= 0:
+                abort_stats.record(abort_stats.deadline_exceeded, endpoint)
+                raise DeadlineExceeded(deadline)
+            try:
+                part = await asyncio.wait_for(parts.__anext__(), remaining)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                abort_stats.record(abort_stats.deadline_exceeded, endpoint)
+                raise DeadlineExceeded(deadline)
+            yield part
+    finally:
+        # Client ngắt giữa chừng -> Starlette hủy/đóng generator này -> đóng luôn stream model bên dưới
+        await parts.aclose()
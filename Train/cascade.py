@@ -0,0 +1,77 @@
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict
+
+# Câu trả lời né tránh / không chắc chắn của model nhỏ -> nên hỏi lại model lớn
+UNCERTAIN_PATTERN = re.compile(
+    r"tôi không (biết|chắc|rõ|thể trả lời|có đủ thông tin)|không có thông tin|ngoài khả năng"
+    r"|i (don't|do not) know|i'm not sure|i am not sure|i (can't|cannot) (answer|help)|not enough information",
+    re.IGNORECASE,
+)
+
+
+@dataclass
+class CascadeDecision:
+    escalate: bool
+    reason: str
+    confidence: float | None  # exp(logprob trung bình) nếu Ollama trả logprobs
+
+
+class CascadePolicy:
+    """
+    Quyết định có chuyển câu hỏi từ model small sang model pro không, dựa trên câu trả lời của small:
+    logprob trung bình của token (nếu có), câu trả lời né tránh, quá ngắn so với câu hỏi, hoặc lặp vòng.
+    Các tín hiệu đều rẻ (không gọi thêm model) nên chi phí cascade chỉ là lượt sinh của small.
+    """
+
+    def __init__(self, min_confidence: float = 0.6, long_question_words: int = 15,
+                 min_answer_words: int = 12, min_distinct_trigrams: float = 0.5):
+        self.min_confidence = min_confidence
+        self.long_question_words = long_question_words
+        self.min_answer_words = min_answer_words
+        self.min_distinct_trigrams = min_distinct_trigrams
+        self.kept = 0
+        self.escalated: Counter = Counter()
+        self.busy_fallbacks = 0
+
+    def _decide(self, question: str, answer: str, mean_logprob: float | None, failed: bool) -> CascadeDecision:
+        confidence = math.exp(mean_logprob) if mean_logprob is not None else None
+        words = answer.split()
+
+        if failed or not words:
+            return CascadeDecision(True, "small_failed", confidence)
+        if UNCERTAIN_PATTERN.search(answer):
+            return CascadeDecision(True, "uncertain", confidence)
+        if confidence is not None and confidence < self.min_confidence:
+            return CascadeDecision(True, "low_logprob", confidence)
+        if len(question.split()) >= self.long_question_words and len(words) < self.min_answer_words:
+            return CascadeDecision(True, "too_short", confidence)
+        if len(words) >= 40:
+            trigrams = list(zip(words, words[1:], words[2:]))
+            if len(set(trigrams)) / len(trigrams) < self.min_distinct_trigrams:
+                return CascadeDecision(True, "repetitive", confidence)
+        return CascadeDecision(False, "confident", confidence)
+
+    def decide(self, question: str, answer: str, mean_logprob: float | None = None, failed: bool = False) -> CascadeDecision:
+        decision = self._decide(question, answer, mean_logprob, failed)
+        if decision.escalate:
+            self.escalated[decision.reason] += 1
+        else:
+            self.kept += 1
+        return decision
+
+    def record_busy_fallback(self):
+        """Đã quyết định chuyển lên pro nhưng pro quá tải -> giữ câu trả lời của small."""
+        self.busy_fallbacks += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.kept + sum(self.escalated.values())
+        return {
+            "min_confidence": self.min_confidence,
+            "answered_by_small": self.kept,
+            "escalated": dict(self.escalated),
+            "busy_fallbacks": self.busy_fallbacks,
+            "small_ratio": round(self.kept / total, 3) if total else 0.0,
+        }
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import math
+from typing import Any, Awaitable, Callable, Dict, List
+
+logging.basicConfig(level=logging.INFO)
+
+# Chi phí cố định của một message trong template chat (role, token phân cách...)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_INSTRUCTIONS = (
+    "Bạn là công cụ tóm tắt hội thoại. Tóm tắt ngắn gọn (tối đa 120 từ) nội dung cuộc trò chuyện dưới đây: "
+    "các câu hỏi chính của người dùng, thông tin quan trọng và kết luận đã đưa ra. "
+    "Nếu có tóm tắt cũ thì gộp vào. Viết bằng ngôn ngữ của cuộc trò chuyện, chỉ trả về đoạn tóm tắt."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Ước lượng nhanh số token (không cần tokenizer thật): ~4 byte UTF-8 mỗi token.
+    Chữ tiếng Việt có dấu chiếm 2-3 byte nên tự nhiên được tính nhiều token hơn, gần với SentencePiece.
+    """
+    return math.ceil(len(text.encode("utf-8")) / 4)
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    return estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+class HistoryManager:
+    """
+    Chọn lịch sử gửi cho model theo ngân sách token của từng tier (thay cho messages[-5:]).
+    Khi phần lịch sử cũ vượt ngưỡng, task nền dùng model small nén nó thành một đoạn tóm tắt cuốn chiếu
+    (session["summary"]) và bỏ các tin nhắn đã được tóm tắt khỏi session.
+    """
+
+    def __init__(self, store, summarize_fn: Callable[[List[Dict[str, str]]], Awaitable[str]],
+                 budgets: Dict[str, int], summarize_threshold: int = 1500, keep_recent: int = 6,
+                 trim_block: int = 8):
+        self.store = store
+        self.summarize_fn = summarize_fn
+        self.budgets = budgets
+        self.summarize_threshold = summarize_threshold
+        self.keep_recent = keep_recent
+        self.trim_block = max(1, trim_block)
+        for tier, budget in budgets.items():
+            if budget < summarize_threshold:
+                # Lịch sử chưa đủ dài để tóm tắt đã bị cắt ở mỗi lượt -> prefix KV cache đổi liên tục
+                logging.warning(f"History budget for '{tier}' ({budget}) is below summarize_threshold ({summarize_threshold}).")
+        self._running: Dict[str, asyncio.Task] = {}
+
+        self.summaries = 0
+        self.summary_failures = 0
+        self.summarized_messages = 0
+
+    def select_messages(self, session: Dict[str, Any], tier: str) -> List[Dict[str, str]]:
+        """
+        Các tin nhắn gần nhất vừa ngân sách của tier (luôn giữ ít nhất tin nhắn cuối).
+        Điểm bắt đầu chỉ dời theo bội số `trim_block` tin nhắn: khi phải cắt, cắt luôn cả khối,
+        nên các lượt tiếp theo chỉ nối thêm vào cuối và prefix (KV cache) giữ nguyên cho tới lần cắt sau.
+        """
+        messages = session["messages"]
+        if not messages:
+            return []
+        budget = self.budgets[tier] - estimate_tokens(session.get("summary", ""))
+        start = len(messages) - 1
+        used = message_tokens(messages[start])
+        while start > 0 and used + message_tokens(messages[start - 1]) <= budget:
+            start -= 1
+            used += message_tokens(messages[start])
+        start = min(-(-start // self.trim_block) * self.trim_block, len(messages) - 1)
+        return messages[start:]
+
+    def maybe_schedule_summary(self, session_id: str, session: Dict[str, Any]):
+        """Gọi sau khi lưu lượt chat. Không chặn request: việc tóm tắt chạy trong task nền."""
+        if session_id in self._running:
+            return
+        older = session["messages"][:-self.keep_recent] if self.keep_recent else session["messages"]
+        if not older or sum(message_tokens(m) for m in older) < self.summarize_threshold:
+            return
+        task = asyncio.create_task(self._summarize(session_id, [dict(m) for m in older], session.get("summary", "")))
+        self._running[session_id] = task
+        task.add_done_callback(lambda _: self._running.pop(session_id, None))
+
+    async def _summarize(self, session_id: str, older: List[Dict[str, str]], previous_summary: str):
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in older)
+        if previous_summary:
+            transcript = f"Tóm tắt cũ: {previous_summary}\n\n{transcript}"
+        try:
+            summary = (await self.summarize_fn([
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                {"role": "user", "content": transcript},
+            ])).strip()
+        except Exception as e:
+            self.summary_failures += 1
+            logging.warning(f"[{session_id}] History summary failed: {e}")
+            return
+        if not summary:
+            self.summary_failures += 1
+            return
+
+        # Session có thể đã đổi trong lúc tóm tắt (lượt mới, bị xóa, bị cắt bớt): chỉ áp dụng
+        # khi phần đầu vẫn đúng là các tin nhắn vừa được tóm tắt
+        session = self.store.get(session_id)
+        if not session or session["messages"][:len(older)] != older:
+            return
+        session["summary"] = summary
+        session["messages"] = session["messages"][len(older):]
+        self.store.set(session_id, session)
+
+        self.summaries += 1
+        self.summarized_messages += len(older)
+        logging.info(f"[{session_id}] Summarized {len(older)} old messages into {estimate_tokens(summary)} tokens.")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "budgets": self.budgets,
+            "summarize_threshold": self.summarize_threshold,
+            "trim_block": self.trim_block,
+            "running": len(self._running),
+            "summaries": self.summaries,
+            "summary_failures": self.summary_failures,
+            "summarized_messages": self.summarized_messages,
+        }
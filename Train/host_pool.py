@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+
+import httpx
+
+logging.basicConfig(level=logging.INFO)
+
+# Lỗi cho thấy chính host có vấn đề (không kết nối được, đứt kết nối) -> được thử sang host khác
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, ConnectionError)
+
+
+class NoHealthyHost(Exception):
+    """Không còn host nào trong pool của model để gửi request."""
+
+
+def is_host_failure(error: BaseException) -> bool:
+    if isinstance(error, CONNECT_ERRORS + (httpx.RemoteProtocolError, httpx.ReadError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(status, int) and status >= 500
+
+
+class HostState:
+    def __init__(self, url: str):
+        self.url = url
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.healthy = True
+        self.last_error: str | None = None
+
+    def usable(self, now: float) -> bool:
+        return self.healthy and self.ejected_until <= now
+
+
+class HostPool:
+    """
+    Các host phục vụ một model. Mỗi lời gọi đi tới host usable có ít request đang chạy nhất
+    (least outstanding requests). Host lỗi liên tiếp `eject_after` lần bị loại `cooldown` giây;
+    hết cooldown host chỉ quay lại nếu lần health check gần nhất thành công.
+    """
+
+    def __init__(self, model: str, urls: Iterable[str], eject_after: int = 2, cooldown: float = 30.0,
+                 on_capacity_change: Callable[[int], None] | None = None):
+        self.model = model
+        self.hosts: List[HostState] = [HostState(url) for url in dict.fromkeys(urls)]
+        self.eject_after = eject_after
+        self.cooldown = cooldown
+        self.on_capacity_change = on_capacity_change
+        self.ejections = 0
+        self._capacity_changed()
+
+    def __len__(self) -> int:
+        return len(self.hosts)
+
+    def usable_hosts(self) -> List[HostState]:
+        now = time.monotonic()
+        return [h for h in self.hosts if h.usable(now)]
+
+    def _capacity_changed(self):
+        if self.on_capacity_change:
+            self.on_capacity_change(max(1, len(self.usable_hosts())))
+
+    def pick(self, exclude: Iterable[str] = ()) -> HostState:
+        excluded = set(exclude)
+        candidates = [h for h in self.usable_hosts() if h.url not in excluded]
+        if not candidates:
+            # Mọi host đều đang bị loại: thử host sắp hết cooldown nhất thay vì từ chối hẳn
+            remaining = [h for h in self.hosts if h.url not in excluded]
+            if not remaining:
+                raise NoHealthyHost(f"No healthy host left for {self.model}")
+            candidates = [min(remaining, key=lambda h: h.ejected_until)]
+        # Hòa số request đang chạy -> host đã nhận ít request hơn (trải đều khi rảnh)
+        return min(candidates, key=lambda h: (h.in_flight, h.requests))
+
+    @asynccontextmanager
+    async def lease(self, exclude: Iterable[str] = ()):
+        host = self.pick(exclude)
+        host.in_flight += 1
+        host.requests += 1
+        try:
+            yield host
+        except BaseException as e:
+            if is_host_failure(e):
+                self.record_failure(host, e)
+            raise
+        else:
+            host.consecutive_failures = 0
+        finally:
+            host.in_flight -= 1
+
+    def record_failure(self, host: HostState, error: BaseException):
+        host.failures += 1
+        host.consecutive_failures += 1
+        host.last_error = f"{type(error).__name__}: {error}"
+        if host.consecutive_failures >= self.eject_after and host.ejected_until <= time.monotonic():
+            host.ejected_until = time.monotonic() + self.cooldown
+            self.ejections += 1
+            logging.warning(f"Ejected {host.url} from {self.model} pool for {self.cooldown:g}s ({host.last_error}).")
+            self._capacity_changed()
+
+    async def check_health(self, probe: Callable[[str], Awaitable[Any]], timeout: float = 3.0):
+        """Gọi `probe(url)` cho từng host; lỗi -> host không usable cho tới lần check thành công sau."""
+        async def check(host: HostState):
+            try:
+                await asyncio.wait_for(probe(host.url), timeout)
+            except Exception as e:
+                if host.healthy:
+                    logging.warning(f"Health check failed for {host.url} ({self.model}): {e!r}")
+                host.healthy = False
+                host.last_error = f"health check: {e!r}"
+                return
+            if not host.healthy:
+                logging.info(f"{host.url} is healthy again ({self.model}).")
+            host.healthy = True
+            if host.ejected_until <= time.monotonic():
+                host.consecutive_failures = 0
+
+        await asyncio.gather(*(check(h) for h in self.hosts))
+        self._capacity_changed()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "ejections": self.ejections,
+            "hosts": {
+                h.url: {
+                    "usable": h.usable(now),
+                    "healthy": h.healthy,
+                    "in_flight": h.in_flight,
+                    "requests": h.requests,
+                    "failures": h.failures,
+                    "ejected_for_s": round(max(0.0, h.ejected_until - now), 1),
+                    "last_error": h.last_error,
+                }
+                for h in self.hosts
+            },
+        }
@@ -0,0 +1,97 @@
+import re
+import unicodedata
+from typing import Tuple
+
+# Chữ cái có dấu của tiếng Việt (dạng NFC). Một số chữ (à, é, ô...) cũng có trong tiếng Pháp,
+# nhưng server chỉ phân biệt vi/en nên gặp bất kỳ chữ nào trong đây là coi như tiếng Việt
+VI_DIACRITIC_CHARS = set(
+    "đăằắẳẵặơờớởỡợưừứửữựảạẩậẻẽẹểễệỉĩịỏọổỗộủũụỳỷỹỵầấẫẩềếồố"
+    "àáâãèéêìíòóôõùúý"
+)
+
+# Từ rất thường gặp khi gõ tiếng Việt không dấu / tiếng Anh, dùng cho câu chỉ có ký tự ASCII
+VI_ASCII_HINTS = {
+    "la", "gi", "khong", "ko", "k", "ban", "minh", "toi", "cua", "cho", "nay", "vay", "nhe", "nha",
+    "duoc", "dc", "lam", "sao", "nao", "chao", "cam", "on", "oi", "ah", "roi", "voi",
+    "mot", "nhung", "cac", "nguoi", "bai", "hoc", "giai", "thich", "tai", "vi", "va", "co", "di",
+}
+EN_ASCII_HINTS = {
+    "the", "is", "are", "was", "what", "how", "why", "who", "you", "your", "i", "me", "my", "to",
+    "of", "and", "in", "on", "for", "with", "can", "do", "does", "please", "explain", "this",
+    "that", "it", "a", "an", "be", "about", "hello", "hi", "hey", "there", "thanks", "thank", "name",
+    "good", "morning", "night", "bye", "see", "later", "yes", "no",
+}
+
+_ASCII_WORD = re.compile(r"[a-z]+")
+
+
+def classify_script(text: str) -> str:
+    """ "vi" (có dấu tiếng Việt), "latin" (chỉ ASCII), "other" (chữ ngoài Latin) hoặc "none" (không có chữ)."""
+    text = unicodedata.normalize("NFC", text).lower()
+    vi_letters = ascii_letters = other = 0
+    for ch in text:
+        if ch in VI_DIACRITIC_CHARS:
+            vi_letters += 1
+        elif "a" <= ch <= "z":
+            ascii_letters += 1
+        elif ch.isalpha():
+            other += 1
+
+    if vi_letters:
+        return "vi"
+    if other > ascii_letters:
+        return "other"
+    if ascii_letters:
+        return "latin"
+    return "none"
+
+
+def _detect_ascii(text: str) -> str | None:
+    words = _ASCII_WORD.findall(text.lower())
+    vi_score = sum(w in VI_ASCII_HINTS for w in words)
+    en_score = sum(w in EN_ASCII_HINTS for w in words)
+    if vi_score > en_score and vi_score >= 1:
+        return "vi"
+    if en_score > vi_score and en_score >= 1:
+        return "en"
+    return None
+
+
+def _detect_langdetect(text: str) -> str:
+    try:
+        from langdetect import DetectorFactory, detect
+        DetectorFactory.seed = 0  # langdetect ngẫu nhiên nếu không cố định seed
+        return "vi" if detect(text) == "vi" else "en"
+    except Exception:
+        return "en"
+
+
+def detect_language_fast(text: str) -> Tuple[str, str]:
+    """
+    Trả về (ngôn ngữ "vi"/"en", script). Quét dấu tiếng Việt trước; câu chỉ có ASCII thì
+    chấm điểm theo từ gợi ý; chỉ khi vẫn không phân định được mới gọi langdetect.
+    """
+    script = classify_script(text)
+    if script == "vi":
+        return "vi", script
+    if script in ("other", "none"):
+        # Giữ hành vi cũ: ngôn ngữ ngoài vi/en -> "en"
+        return "en", script
+    return _detect_ascii(text) or _detect_langdetect(text), script
+
+
+def detect_language_for_session(text: str, previous: Tuple[str, str] | None = None) -> Tuple[str, str]:
+    """
+    Ghi nhớ theo session (`previous` = kết quả của câu trước). Câu có dấu hoặc câu ASCII có từ gợi ý
+    rõ ràng vẫn được phát hiện lại (rẻ). Câu mơ hồ ("ok", "123", "?") dùng lại ngôn ngữ của session
+    thay vì gọi langdetect, nên langdetect chỉ còn chạy ở lượt đầu của session.
+    """
+    if previous is None:
+        return detect_language_fast(text)
+
+    script = classify_script(text)
+    if script == "latin":
+        return _detect_ascii(text) or previous[0], script
+    if script == "none":
+        return previous[0], previous[1]
+    return detect_language_fast(text)
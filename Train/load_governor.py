@@ -0,0 +1,80 @@
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, Tuple
+
+from .admission import get_limiter
+
+
+class TierGovernor:
+    """
+    Hạ cấp câu hỏi tier pro theo tải thực tế của model pro (từ số liệu của ModelLimiter):
+    - "downgrade": chuyển sang small khi hàng đợi pro dài, hoặc khi pro đang kín slot mà p95 thời gian
+      chờ / thời gian sinh gần đây vượt ngưỡng. Câu trả lời nhanh của small tốt hơn câu trả lời chậm của pro.
+    - "shorten": pro kín slot nhưng chưa tới ngưỡng trên -> vẫn dùng pro, giới hạn num_predict để
+      giải phóng slot sớm hơn.
+    p95 chỉ được xét khi pro đang bận, nên số liệu cũ của một đợt cao điểm không giữ việc hạ cấp mãi.
+
+    Quyết định được đưa ra trước khi request vào hàng đợi của limiter, nên một loạt request đến cùng lúc
+    sẽ cùng thấy limiter rảnh. Vì vậy mỗi câu được giữ ở pro được tính là một route "đang tới" cho đến khi
+    limiter ghi nhận thêm một lượt vào (limiter.arrivals) hoặc quá `pending_ttl` giây (câu trả lời từ cache,
+    bị hủy trước khi gọi model...). Đây chỉ là ước lượng: lượt vào limiter không gắn với đúng request đã route.
+    """
+
+    def __init__(self, model: str, max_queue_depth: int = 4, max_wait_p95: float = 10.0,
+                 max_service_p95: float = 90.0, short_num_predict: int = 384, pending_ttl: float = 2.0):
+        self.model = model
+        self.max_queue_depth = max_queue_depth
+        self.max_wait_p95 = max_wait_p95
+        self.max_service_p95 = max_service_p95
+        self.short_num_predict = short_num_predict
+        self.pending_ttl = pending_ttl
+        self.actions: Counter = Counter()
+        self._pending: Deque[float] = deque()  # Thời điểm của các route pro chưa tới limiter
+        self._seen_arrivals = 0
+
+    def _pending_routes(self, limiter) -> int:
+        now = time.monotonic()
+        arrived = limiter.arrivals - self._seen_arrivals
+        self._seen_arrivals = limiter.arrivals
+        for _ in range(min(arrived, len(self._pending))):
+            self._pending.popleft()
+        while self._pending and now - self._pending[0] > self.pending_ttl:
+            self._pending.popleft()
+        return len(self._pending)
+
+    def _decide(self) -> Tuple[str | None, str]:
+        limiter = get_limiter(self.model)
+        # Các route pro chưa tới limiter lấp slot trống trước, phần dư coi như đang xếp hàng
+        busy = limiter.in_flight + self._pending_routes(limiter)
+        in_flight = min(busy, limiter.max_concurrency)
+        queue_depth = limiter.queue_depth + busy - in_flight
+        if queue_depth >= self.max_queue_depth:
+            return "downgrade", f"queue_depth={queue_depth}"
+        if in_flight < limiter.max_concurrency:
+            return None, ""
+
+        stats = limiter.stats()
+        if stats["wait_p95_s"] >= self.max_wait_p95:
+            return "downgrade", f"wait_p95={stats['wait_p95_s']}s"
+        if stats["service_p95_s"] >= self.max_service_p95:
+            return "downgrade", f"latency_p95={stats['service_p95_s']}s"
+        return "shorten", f"in_flight={in_flight}/{limiter.max_concurrency}"
+
+    def decide(self) -> Tuple[str | None, str]:
+        """Trả về (None | "downgrade" | "shorten", lý do)."""
+        action, reason = self._decide()
+        self.actions[action or "none"] += 1
+        if action != "downgrade":
+            self._pending.append(time.monotonic())
+        return action, reason
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "max_queue_depth": self.max_queue_depth,
+            "max_wait_p95_s": self.max_wait_p95,
+            "max_service_p95_s": self.max_service_p95,
+            "short_num_predict": self.short_num_predict,
+            "pending_routes": len(self._pending),
+            "actions": dict(self.actions),
+        }
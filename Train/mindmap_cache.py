@@ -0,0 +1,377 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from difflib import SequenceMatcher
+from typing import Any, Deque, Dict, List, Tuple
+
+from .perceptual_hash import PerceptualIndex
+
+logging.basicConfig(level=logging.INFO)
+
+# Tăng khi đổi cấu trúc payload: các entry có schema cũ bị coi như không có (và bị dọn dần)
+SCHEMA_VERSION = 1
+
+# Entry sinh bởi pipeline khác (model / prompt / options / OCR / code đã đổi):
+# "strict" = coi như không có, "stale" = vẫn trả về nhưng báo stale để bên gọi sinh lại trong nền,
+# "ignore" = trả về như entry mới
+VERSION_POLICIES = ("strict", "stale", "ignore")
+
+
+def mindmap_payload(topic: str, nodes: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Phản hồi của /generate_mindmap từ (topic, cây nodes): đây là nội dung được lưu trong cache."""
+    def extract_all_text(node):
+        items = [node.get("text", "")]
+        for child in node.get("children", []):
+            items.extend(extract_all_text(child))
+        return [i for i in items if i.strip()]
+
+    detail_list = []
+    summary_list = []
+    for node in nodes:
+        detail_list.extend(extract_all_text(node))
+        summary_list.append(node.get("text", ""))
+
+    return {
+        "topic": topic,
+        "mindmap_nodes": nodes,  # Nodes dạng cây, không có tọa độ x, y
+        "detail": detail_list,
+        "summary": summary_list[:4],
+    }
+
+
+def normalize_mindmap_text(text: str) -> str:
+    """Chuẩn hóa text dán vào (NFC, gộp khoảng trắng, tối đa một dòng trống) để cùng nội dung -> cùng key."""
+    text = unicodedata.normalize("NFC", text or "").replace("\r\n", "\n").replace("\r", "\n")
+    lines = [re.sub(r"[ \t\u00a0]+", " ", line).strip() for line in text.split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def normalize_ocr_text(lines: List[str]) -> str:
+    """Text OCR của ảnh ở dạng so sánh được (chuẩn hóa, chữ thường, tối đa 4000 ký tự)."""
+    return normalize_mindmap_text("\n".join(lines)).lower()[:4000]
+
+
+def text_similarity(a: str, b: str) -> float:
+    """Tỉ lệ giống nhau (0..1) của hai text OCR đã chuẩn hóa; hai text rỗng coi như giống hệt."""
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def text_cache_key(normalized_text: str) -> str:
+    """Key cache cho mindmap từ text; tiền tố "text:" tách khỏi key SHA-256 của file upload."""
+    return "text:" + hashlib.sha256(normalized_text.encode("utf-8")).hexdigest()
+
+
+class MindmapCache:
+    """
+    Cache mindmap hai tầng: LRU trong RAM phía trước một file SQLite (WAL) sống qua các lần restart.
+    - Ghi nguyên tử: mỗi entry được ghi trong một transaction.
+    - Ngân sách byte cho phần trên đĩa: vượt quá thì loại entry lâu không dùng nhất.
+    - Mỗi entry mang schema_version; entry khác SCHEMA_VERSION không bao giờ được trả về.
+    - Mỗi entry mang dấu vân tay `pipeline` đã sinh ra nó; entry của pipeline khác được xử lý theo
+      `version_policy` (VERSION_POLICIES) và bị loại trước khi vượt ngân sách byte.
+    - Nạp lười: chỉ mở file khi có lookup đầu tiên, entry được đưa lên RAM khi được đọc.
+    - Chỉ mục phụ cho ảnh: (dHash, pHash) của file gốc, để ảnh chụp lại / nén lại / cắt nhẹ vẫn
+      tìm được mindmap đã có qua find_similar(). Hash chỉ chọn ứng viên: hai slide cùng template
+      khác nội dung có hash rất gần nhau, nên ứng viên chỉ được nhận khi text OCR lưu kèm giống text
+      OCR của ảnh mới (>= `near_min_similarity`). Entry không có text OCR không bao giờ khớp gần trùng.
+    Truy vấn SQLite chạy trong thread để không chặn event loop. Chỉ mục gần trùng chỉ được đọc/ghi khi giữ
+    `_lock` (trong thread); LRU `_memory` chỉ được đụng tới trên event loop: key bị loại khỏi đĩa trong
+    thread được ghi vào `_evicted` và bỏ khỏi RAM ở lần gọi tiếp theo trên loop.
+    """
+
+    def __init__(self, path: str, memory_entries: int = 128, max_bytes: int = 256 * 1024 * 1024,
+                 legacy_json_path: str | None = None, near_max_distance: int = 8,
+                 near_min_similarity: float = 0.9, pipeline: str = "", version_policy: str = "strict"):
+        if version_policy not in VERSION_POLICIES:
+            raise ValueError(f"version_policy must be one of {VERSION_POLICIES}, got {version_policy!r}")
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self.legacy_json_path = legacy_json_path
+        self.near_max_distance = near_max_distance
+        self.near_min_similarity = near_min_similarity
+        self.pipeline = pipeline
+        self.version_policy = version_policy
+
+        # key -> (payload, pipeline)
+        self._memory: "OrderedDict[str, tuple[Dict[str, Any], str | None]]" = OrderedDict()
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        self._index = PerceptualIndex(near_max_distance)
+        self._evicted: Deque[str] = deque()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.near_hits = 0
+        self.near_rejected = 0
+        self.stale_hits = 0
+
+    # ---------- SQLite ----------
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS mindmaps ("
+                " key TEXT PRIMARY KEY, schema_version INTEGER NOT NULL, payload TEXT NOT NULL,"
+                " bytes INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL, pipeline TEXT)"
+            )
+            # File tạo trước khi có cột pipeline: entry cũ mang pipeline NULL ("legacy")
+            if "pipeline" not in {row[1] for row in conn.execute("PRAGMA table_info(mindmaps)")}:
+                conn.execute("ALTER TABLE mindmaps ADD COLUMN pipeline TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_mindmaps_accessed_at ON mindmaps(accessed_at)")
+            # Hash 64 bit không dấu vượt INTEGER của SQLite -> lưu dạng hex
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS image_hashes ("
+                " key TEXT PRIMARY KEY,"
+                " dhash TEXT NOT NULL, phash TEXT NOT NULL, ocr_text TEXT)"
+            )
+            if "ocr_text" not in {row[1] for row in conn.execute("PRAGMA table_info(image_hashes)")}:
+                conn.execute("ALTER TABLE image_hashes ADD COLUMN ocr_text TEXT")
+            conn.commit()
+            self._conn = conn
+            self._disk_bytes = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM mindmaps").fetchone()[0]
+            for key, d, p in conn.execute(
+                "SELECT h.key, h.dhash, h.phash FROM image_hashes h JOIN mindmaps m ON m.key = h.key"
+            ):
+                self._index.add(key, (int(d, 16), int(p, 16)))
+            self._import_legacy_json()
+        return self._conn
+
+    def _import_legacy_json(self):
+        """Nhập một lần file mindmap_results.json cũ ({file_hash: [topic, nodes]}) vào SQLite."""
+        if not self.legacy_json_path or not os.path.exists(self.legacy_json_path):
+            return
+        try:
+            with open(self.legacy_json_path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Cannot read legacy mindmap cache {self.legacy_json_path}: {e}")
+            return
+        imported = 0
+        for key, value in legacy.items():
+            # Bỏ các entry lưu nhầm từ lần parse JSON hỏng (topic là "```json")
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], list) \
+                    and not str(value[0]).startswith("```"):
+                if self._conn.execute("SELECT 1 FROM mindmaps WHERE key = ?", (key,)).fetchone() is None:
+                    self._write(key, mindmap_payload(value[0], value[1]), legacy=True)
+                    imported += 1
+        if imported:
+            logging.info(f"Imported {imported} mindmaps from {self.legacy_json_path}.")
+
+    def _read(self, key: str) -> tuple[Dict[str, Any], str | None] | None:
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT payload, pipeline FROM mindmaps WHERE key = ? AND schema_version = ?", (key, SCHEMA_VERSION)
+            ).fetchone()
+            if row is None or not self._acceptable(row[1]):
+                return None
+            with conn:
+                conn.execute("UPDATE mindmaps SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return json.loads(row[0]), row[1]
+
+    def _version_counts(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT COALESCE(pipeline, 'legacy'), COUNT(*), SUM(bytes) FROM mindmaps WHERE schema_version = ?"
+                " GROUP BY 1", (SCHEMA_VERSION,)
+            ).fetchall()
+        return {
+            pipeline: {"entries": entries, "bytes": size, "current": pipeline == self.pipeline}
+            for pipeline, entries, size in rows
+        }
+
+    def _write(self, key: str, payload: Dict[str, Any], image_hash: Tuple[int, int] | None = None,
+               legacy: bool = False, image_text: str | None = None):
+        raw = json.dumps(payload, ensure_ascii=False)
+        size = len(raw.encode("utf-8"))
+        now = time.time()
+        conn = self._conn
+        with conn:
+            old = conn.execute("SELECT bytes FROM mindmaps WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT INTO mindmaps (key, schema_version, payload, bytes, created_at, accessed_at, pipeline) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET schema_version = excluded.schema_version, "
+                "payload = excluded.payload, bytes = excluded.bytes, created_at = excluded.created_at, "
+                "accessed_at = excluded.accessed_at, pipeline = excluded.pipeline",
+                (key, SCHEMA_VERSION, raw, size, now, now, None if legacy else self.pipeline),
+            )
+            if image_hash is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO image_hashes (key, dhash, phash, ocr_text) VALUES (?, ?, ?, ?)",
+                    (key, format(image_hash[0], "016x"), format(image_hash[1], "016x"), image_text),
+                )
+            self._disk_bytes += size - (old[0] if old else 0)
+            self._enforce_budget(conn)
+        if image_hash is not None:
+            self._index.add(key, image_hash)
+
+    def _enforce_budget(self, conn: sqlite3.Connection):
+        # Entry của schema cũ không bao giờ được đọc lại -> loại trước, rồi tới entry của pipeline cũ,
+        # rồi tới entry lâu không dùng
+        if self._disk_bytes <= self.max_bytes:
+            return
+        rows = conn.execute(
+            "SELECT key, bytes FROM mindmaps ORDER BY schema_version = ?, pipeline IS ?, accessed_at",
+            (SCHEMA_VERSION, self.pipeline),
+        ).fetchall()
+        victims = []
+        for key, size in rows:
+            if self._disk_bytes <= self.max_bytes:
+                break
+            victims.append((key,))
+            self._disk_bytes -= size
+        conn.executemany("DELETE FROM mindmaps WHERE key = ?", victims)
+        conn.executemany("DELETE FROM image_hashes WHERE key = ?", victims)
+        for (key,) in victims:
+            self._index.discard(key)
+            self._evicted.append(key)
+        self.evictions += len(victims)
+
+    def _store(self, key: str, payload: Dict[str, Any], image_hash: Tuple[int, int] | None,
+               image_text: str | None):
+        with self._lock:
+            self._connection()
+            self._write(key, payload, image_hash, image_text=image_text)
+
+    # ---------- API ----------
+    def _acceptable(self, pipeline: str | None) -> bool:
+        return self.version_policy != "strict" or pipeline == self.pipeline
+
+    def _forget_evicted(self):
+        # deque: append (thread) / popleft (loop) an toàn giữa các thread mà không phải chờ _lock trên loop
+        while self._evicted:
+            self._memory.pop(self._evicted.popleft(), None)
+
+    def _remember(self, key: str, payload: Dict[str, Any], pipeline: str | None):
+        self._memory[key] = (payload, pipeline)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    async def lookup(self, key: str) -> tuple[Dict[str, Any], bool] | None:
+        """(payload, stale) theo version_policy; stale=True chỉ khi policy "stale" và entry thuộc pipeline khác."""
+        self._forget_evicted()
+        entry = self._memory.get(key)
+        if entry is not None and self._acceptable(entry[1]):
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+        else:
+            try:
+                entry = await asyncio.to_thread(self._read, key)
+            except sqlite3.Error as e:
+                logging.error(f"Mindmap cache read error: {e}")
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, *entry)
+        payload, pipeline = entry
+        stale = self.version_policy == "stale" and pipeline != self.pipeline
+        self.stale_hits += stale
+        return payload, stale
+
+    async def get(self, key: str) -> Dict[str, Any] | None:
+        entry = await self.lookup(key)
+        return entry[0] if entry else None
+
+    async def version_counts(self) -> Dict[str, Dict[str, Any]]:
+        """Số entry và số byte theo từng pipeline (NULL = "legacy")."""
+        try:
+            return await asyncio.to_thread(self._version_counts)
+        except sqlite3.Error as e:
+            logging.error(f"Mindmap cache read error: {e}")
+            return {}
+
+    async def find_similar(self, image_hash: Tuple[int, int],
+                           image_text: str | None) -> Tuple[str, int, Dict[str, Any], bool] | None:
+        """
+        Mindmap của ảnh gần trùng nhất với `image_hash` (dhash, phash) có text OCR lưu kèm giống
+        `image_text` (normalize_ocr_text): (key, khoảng cách Hamming, payload, stale).
+        `image_text` None (không OCR được) -> không thể kiểm tra nội dung, không trả về gì.
+        """
+        if image_text is None:
+            return None
+        try:
+            candidates = await asyncio.to_thread(self._near_candidates, image_hash)
+        except sqlite3.Error as e:
+            logging.error(f"Mindmap cache read error: {e}")
+            return None
+        for key, distance, stored_text in candidates:
+            if stored_text is None or text_similarity(image_text, stored_text) < self.near_min_similarity:
+                self.near_rejected += 1
+                continue
+            entry = await self.lookup(key)
+            if entry is None:
+                continue
+            self.near_hits += 1
+            return key, distance, *entry
+        return None
+
+    def _near_candidates(self, image_hash: Tuple[int, int]) -> List[Tuple[str, int, str | None]]:
+        """(key, khoảng cách, text OCR) của các ảnh trong ngưỡng, gần nhất trước; giữ `_lock` khi duyệt chỉ mục."""
+        with self._lock:
+            conn = self._connection()
+            return [
+                (key, distance, row[0] if row else None)
+                for key, distance in self._index.candidates(image_hash)
+                for row in [conn.execute("SELECT ocr_text FROM image_hashes WHERE key = ?", (key,)).fetchone()]
+            ]
+
+    async def put(self, key: str, payload: Dict[str, Any], image_hash: Tuple[int, int] | None = None,
+                  image_text: str | None = None):
+        """
+        `image_hash` (dhash, phash) của file gốc nếu là ảnh: thêm vào chỉ mục gần trùng, kèm
+        `image_text` (normalize_ocr_text) để find_similar kiểm tra nội dung.
+        """
+        self._remember(key, payload, self.pipeline)
+        try:
+            await asyncio.to_thread(self._store, key, payload, image_hash, image_text)
+            self._forget_evicted()
+        except sqlite3.Error as e:
+            # Vẫn còn trong RAM; lần sau sẽ được ghi lại
+            logging.error(f"Mindmap cache write error: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "schema_version": SCHEMA_VERSION,
+            "pipeline": self.pipeline,
+            "version_policy": self.version_policy,
+            "memory_entries": len(self._memory),
+            "max_memory_entries": self.memory_entries,
+            "disk_bytes": self._disk_bytes,
+            "max_disk_bytes": self.max_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "near_hits": self.near_hits,
+            "near_rejected": self.near_rejected,
+            "near_min_similarity": self.near_min_similarity,
+            "stale_hits": self.stale_hits,
+            "image_hashes": len(self._index),
+        }
@@ -0,0 +1,378 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List
+
+logging.basicConfig(level=logging.INFO)
+
+# queued -> running -> done | failed. Các mốc trong lúc chạy nằm ở `stages`:
+# hashed, ocr_done (lines), llm_running, parsed, cached
+TERMINAL_STATUSES = ("done", "failed")
+
+
+class JobQueueFull(Exception):
+    """Hàng đợi job mindmap đã đầy (429)."""
+
+    def __init__(self, limit: int, retry_after: int = 30):
+        super().__init__(f"{limit} mindmap jobs already queued")
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class MindmapJob:
+    def __init__(self, job_id: str, file_hash: str, upload_path: str, size: int, status: str = "queued",
+                 stages: List[Dict[str, Any]] | None = None, result: Dict[str, Any] | None = None,
+                 error: str | None = None, created_at: float | None = None, updated_at: float | None = None):
+        self.id = job_id
+        self.file_hash = file_hash
+        self.upload_path = upload_path
+        self.size = size
+        self.status = status
+        self.stages = stages or []
+        self.result = result
+        self.error = error
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+        # Được set rồi thay mới mỗi khi job thay đổi: SSE / long-poll chờ trên event hiện tại
+        self.changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def touch(self):
+        self.updated_at = time.time()
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stages[-1]["stage"] if self.stages else None,
+            "stages": self.stages,
+            "file_hash": self.file_hash,
+            "size": self.size,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class MindmapJobs:
+    """
+    Chạy sinh mindmap thành job nền để HTTP request không phải giữ kết nối suốt vài phút của llava.
+    - Pool `workers` task lấy job từ hàng đợi (tối đa `max_queued` job chờ, vượt quá -> JobQueueFull).
+    - Job đang chạy nằm trong RAM (poll / SSE đọc trực tiếp); mỗi lần đổi trạng thái được ghi vào
+      bảng jobs của một file SQLite, nên kết quả vẫn đọc được sau restart.
+    - Mỗi job chưa xong được một tiến trình giữ bằng lease (`owner`, `lease_until`) gia hạn định kỳ.
+      Job hết lease (tiến trình cũ đã tắt / chết) được nhận lại bằng một UPDATE có điều kiện, nên với
+      `uvicorn --workers N` dùng chung file SQLite mỗi job chỉ được một worker chạy lại.
+      File upload thiếu -> failed.
+    - File upload thuộc về job: chỉ bị xóa khi job xong (done / failed), tắt server giữa chừng thì giữ lại.
+    - Hai job cùng file_hash đang chờ/chạy -> job sau trả về job trước.
+    `process(job)` (do Server cung cấp) sinh mindmap và trả về payload phản hồi; không được xóa job.upload_path.
+    """
+
+    def __init__(self, path: str, process: Callable[[MindmapJob], Awaitable[Dict[str, Any]]],
+                 workers: int = 2, max_queued: int = 100, deadline: float = 900.0, retention: float = 86400.0,
+                 lease: float = 60.0):
+        self.path = path
+        self.process = process
+        self.workers = workers
+        self.max_queued = max_queued
+        self.deadline = deadline
+        self.retention = retention
+        self.lease = lease
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._active: Dict[str, MindmapJob] = {}
+        self._by_hash: Dict[str, MindmapJob] = {}
+        self._queue: asyncio.Queue | None = None
+        self._tasks: List[asyncio.Task] = []
+        self._lease_task: asyncio.Task | None = None
+
+        self.submitted = 0
+        self.deduplicated = 0
+        self.completed = 0
+        self.failed = 0
+        self.recovered = 0
+
+    # ---------- SQLite ----------
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY, file_hash TEXT NOT NULL, upload_path TEXT NOT NULL, size INTEGER NOT NULL,"
+                " status TEXT NOT NULL, stages TEXT NOT NULL, result TEXT, error TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT, lease_until REAL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs(updated_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _write(self, row: tuple):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO jobs (job_id, file_hash, upload_path, size, status, stages, result, error,"
+                    " created_at, updated_at, owner, lease_until) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    row + (self.owner, time.time() + self.lease),
+                )
+
+    def _read(self, job_id: str) -> MindmapJob | None:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT job_id, file_hash, upload_path, size, status, stages, result, error, created_at, updated_at"
+                " FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return self._from_row(row) if row else None
+
+    def _claim_orphans(self) -> List[MindmapJob]:
+        """Nhận các job chưa xong mà không tiến trình nào giữ lease; mỗi job chỉ một tiến trình nhận được."""
+        now = time.time()
+        claimed = []
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                # Dọn job đã xong quá hạn lưu giữ
+                conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                             (*TERMINAL_STATUSES, now - self.retention))
+            rows = conn.execute(
+                "SELECT job_id, file_hash, upload_path, size, status, stages, result, error, created_at, updated_at"
+                " FROM jobs WHERE status NOT IN (?, ?) AND (lease_until IS NULL OR lease_until < ?) ORDER BY created_at",
+                (*TERMINAL_STATUSES, now),
+            ).fetchall()
+            for row in rows:
+                with conn:
+                    cursor = conn.execute(
+                        "UPDATE jobs SET owner = ?, lease_until = ?, status = 'queued' WHERE job_id = ?"
+                        " AND status NOT IN (?, ?) AND (lease_until IS NULL OR lease_until < ?)",
+                        (self.owner, now + self.lease, row[0], *TERMINAL_STATUSES, now),
+                    )
+                if cursor.rowcount == 1:
+                    claimed.append(self._from_row(row))
+        return claimed
+
+    def _release(self, job_ids: List[str]):
+        """Tắt bình thường: bỏ lease ngay để tiến trình khác / lần khởi động sau nhận lại không phải chờ."""
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    "UPDATE jobs SET lease_until = NULL WHERE job_id = ? AND owner = ? AND status NOT IN (?, ?)",
+                    [(job_id, self.owner, *TERMINAL_STATUSES) for job_id in job_ids],
+                )
+
+    def _renew(self, job_ids: List[str]):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND owner = ?",
+                    [(time.time() + self.lease, job_id, self.owner) for job_id in job_ids],
+                )
+
+    @staticmethod
+    def _from_row(row) -> MindmapJob:
+        job_id, file_hash, upload_path, size, status, stages, result, error, created_at, updated_at = row
+        return MindmapJob(job_id, file_hash, upload_path, size, status, json.loads(stages),
+                          json.loads(result) if result else None, error, created_at, updated_at)
+
+    async def _save(self, job: MindmapJob):
+        # Chụp trạng thái trên event loop, ghi trong thread
+        row = (job.id, job.file_hash, job.upload_path, job.size, job.status,
+               json.dumps(job.stages, ensure_ascii=False),
+               json.dumps(job.result, ensure_ascii=False) if job.result is not None else None,
+               job.error, job.created_at, job.updated_at)
+        try:
+            await asyncio.to_thread(self._write, row)
+        except sqlite3.Error as e:
+            logging.error(f"Mindmap job table write error: {e}")
+
+    # ---------- vòng đời ----------
+    async def start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        await self._recover()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._lease_task = asyncio.create_task(self._lease_loop())
+
+    async def _recover(self):
+        recovered = 0
+        for job in await asyncio.to_thread(self._claim_orphans):
+            if job.id in self._active:
+                continue
+            if os.path.exists(job.upload_path):
+                job.status = "queued"
+                self._enqueue(job)
+                recovered += 1
+            else:
+                job.status, job.error = "failed", "Server restarted and the uploaded file is gone."
+                job.touch()
+                await self._save(job)
+        if recovered:
+            self.recovered += recovered
+            logging.info(f"Re-queued {recovered} unfinished mindmap jobs.")
+
+    async def _lease_loop(self):
+        # Gia hạn lease của job mình giữ, và nhận job của tiến trình đã chết giữa chừng
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if self._active:
+                    await asyncio.to_thread(self._renew, list(self._active))
+                await self._recover()
+            except sqlite3.Error as e:
+                logging.error(f"Mindmap job lease error: {e}")
+
+    async def close(self):
+        # Job đang chạy giữ trạng thái chưa xong và file upload; lease hết hạn -> lần khởi động sau chạy lại
+        tasks = self._tasks + ([self._lease_task] if self._lease_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._lease_task = None
+        if self._active:
+            try:
+                await asyncio.to_thread(self._release, list(self._active))
+            except sqlite3.Error as e:
+                logging.error(f"Mindmap job table write error: {e}")
+        self._active.clear()
+        self._by_hash.clear()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _enqueue(self, job: MindmapJob):
+        self._active[job.id] = job
+        self._by_hash[job.file_hash] = job
+        self._queue.put_nowait(job)
+
+    async def submit(self, file_hash: str, upload_path: str, size: int) -> tuple[MindmapJob, bool]:
+        """Trả về (job, created). created=False: đã có job cùng file đang chờ/chạy, file mới không được dùng."""
+        existing = self._by_hash.get(file_hash)
+        if existing is not None and not existing.finished:
+            self.deduplicated += 1
+            return existing, False
+        if self._queue.qsize() >= self.max_queued:
+            raise JobQueueFull(self.max_queued)
+
+        job = MindmapJob(uuid.uuid4().hex, file_hash, upload_path, size)
+        job.stages.append({"stage": "hashed", "at": job.created_at, "size": size})
+        self._enqueue(job)
+        self.submitted += 1
+        await self._save(job)
+        return job, True
+
+    def record_stage(self, job: MindmapJob, stage: str, **info):
+        job.stages.append({"stage": stage, "at": time.time(), **info})
+        job.touch()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f"Mindmap job {job.id} crashed:")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: MindmapJob):
+        job.status = "running"
+        job.touch()
+        await self._save(job)
+        try:
+            job.result = await asyncio.wait_for(self.process(job), self.deadline)
+            job.status = "done"
+            self.completed += 1
+        except asyncio.TimeoutError:
+            job.status, job.error = "failed", f"Quá thời gian xử lý ({self.deadline:g}s)."
+            self.failed += 1
+        except asyncio.CancelledError:
+            # Server tắt giữa chừng: giữ trạng thái chưa xong để lần khởi động sau chạy lại
+            raise
+        except Exception as e:
+            job.status, job.error = "failed", f"{type(e).__name__}: {e}"
+            self.failed += 1
+        job.touch()
+        await self._save(job)
+        # Job đã xong: file upload không còn cần cho việc chạy lại
+        try:
+            os.remove(job.upload_path)
+        except FileNotFoundError:
+            pass
+        self._active.pop(job.id, None)
+        if self._by_hash.get(job.file_hash) is job:
+            del self._by_hash[job.file_hash]
+
+    # ---------- truy vấn ----------
+    async def get(self, job_id: str) -> MindmapJob | None:
+        job = self._active.get(job_id)
+        if job is not None:
+            return job
+        try:
+            return await asyncio.to_thread(self._read, job_id)
+        except sqlite3.Error as e:
+            logging.error(f"Mindmap job table read error: {e}")
+            return None
+
+    async def events(self, job_id: str, heartbeat: float = 15.0) -> AsyncIterator[Dict[str, Any] | None]:
+        """
+        Các mốc của job theo thứ tự (kể cả các mốc đã qua), rồi một event cuối {"stage": status, ...}
+        khi job xong. None = không có gì mới sau `heartbeat` giây (để gửi keep-alive qua proxy).
+        """
+        sent = 0
+        while True:
+            job = await self.get(job_id)
+            if job is None:
+                return
+            changed = job.changed
+            for stage in job.stages[sent:]:
+                yield stage
+            sent = len(job.stages)
+            if job.finished:
+                yield {"stage": job.status, "at": job.updated_at, "result": job.result, "error": job.error}
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "active": len(self._active),
+            "max_queued": self.max_queued,
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "completed": self.completed,
+            "failed": self.failed,
+            "recovered": self.recovered,
+        }
@@ -1,48 +1,94 @@
-import ollama
-from typing import List, Dict
+from typing import Any, List, Dict
 import re
 import logging
 
+from .admission import AdmissionRejected, configure_limit
+from .ollama_client import chat, chat_stream, set_keep_alive
+from .prompt_builder import build_chat_messages
+
 logging.basicConfig(level=logging.INFO)
 
 MODEL_NAME = "gemma3:4b-it-q8_0"
 
+# Hạn chót (giây) cho một lượt sinh của model này
+REQUEST_TIMEOUT = 180
+
+# Số lời gọi đồng thời tới Ollama, số request được xếp hàng, thời gian chờ tối đa trong hàng (giây)
+configure_limit(MODEL_NAME, max_concurrency=2, max_queue=16, queue_timeout=20)
+
+# Model chat: giữ trong RAM luôn (-1) để không phải nạp lại giữa các câu hỏi
+KEEP_ALIVE = -1
+set_keep_alive(MODEL_NAME, KEEP_ALIVE)
+
 SYSTEM_PROMPT_FORMAT = (
     "Bạn là trợ lý AI chuyên nghiệp và hữu ích. Hãy trả lời một cách tự nhiên và thân thiện, "
     "cung cấp câu trả lời chính xác và chi tiết cho các câu hỏi phức tạp. "
     "TUYỆT ĐỐI không sử dụng bất kỳ định dạng Markdown hoặc ký tự đặc biệt nào (như *, **, #, [], v.v.). "
-    "Chỉ trả về văn bản thuần. Yêu cầu về ngôn ngữ ĐẦU RA (Việt/Anh) phải được TUÂN THỦ NGHIÊM NGẶT từ các hướng dẫn trước đó."
+    "Chỉ trả về văn bản thuần. Yêu cầu về ngôn ngữ ĐẦU RA (Việt/Anh) phải được TUÂN THỦ NGHIÊM NGẶT theo hướng dẫn trong ngoặc ở cuối câu hỏi."
 )
 
-def call_gemma_pro_chat(messages: List[Dict[str, str]]):
-    
-    lang_system_prompt = next((m for m in messages if m['role'] == 'system'), None)
-    
-    full_messages = []
-    
-    # 1. Thêm System Prompt về Format/Tone
-    full_messages.append({"role": "system", "content": SYSTEM_PROMPT_FORMAT})
+def _build_full_messages(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    # SYSTEM_PROMPT_FORMAT luôn đứng đầu và không đổi -> Ollama dùng lại KV cache của phần này
+    return build_chat_messages(SYSTEM_PROMPT_FORMAT, messages)
+
+
+def _options(num_predict: int | None) -> Dict[str, Any]:
+    # num_predict: giới hạn độ dài câu trả lời khi server đang tải cao (None = không giới hạn)
+    options: Dict[str, Any] = {"temperature": 0.3}
+    if num_predict is not None:
+        options["num_predict"] = num_predict
+    return options
+
+
+async def call_gemma_pro_chat(messages: List[Dict[str, str]], num_predict: int | None = None):
     
-    # 2. Thêm System Prompt về Ngôn ngữ (Ưu tiên cao)
-    if lang_system_prompt:
-        full_messages.append(lang_system_prompt)
-        
-    # 3. Thêm các tin nhắn lịch sử và tin nhắn User hiện tại
-    full_messages.extend([m for m in messages if m['role'] != 'system'])
+    full_messages = _build_full_messages(messages)
 
     try:
         logging.info(f"Calling Ollama Pro: {MODEL_NAME} with {len(full_messages)} messages.")
 
-        response = ollama.chat(
+        response = await chat(
             model=MODEL_NAME, 
             messages=full_messages, 
-            options={"temperature": 0.3}
+            options=_options(num_predict),
+            timeout=REQUEST_TIMEOUT
         )
         
         text = response.get("message", {}).get("content", "")
         text = re.sub(r'[*_~`#]', '', text)
         return text.strip()
-        
+
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logging.error(f"Lỗi gọi model Pro ({MODEL_NAME}): {e}")
-        return f"Xin lỗi, mô hình Pro hiện đang gặp lỗi: {str(e)}"
\ No newline at end of file
+        return f"Xin lỗi, mô hình Pro hiện đang gặp lỗi: {str(e)}"
+
+
+async def stream_gemma_pro_chat(messages: List[Dict[str, str]], num_predict: int | None = None):
+    """Giống call_gemma_pro_chat nhưng yield từng đoạn text ngay khi Ollama sinh ra."""
+    full_messages = _build_full_messages(messages)
+    started = False
+
+    try:
+        logging.info(f"Streaming Ollama Pro: {MODEL_NAME} with {len(full_messages)} messages.")
+
+        async for part in chat_stream(
+            model=MODEL_NAME,
+            messages=full_messages,
+            options=_options(num_predict),
+            timeout=REQUEST_TIMEOUT
+        ):
+            chunk = re.sub(r'[*_~`#]', '', part["message"]["content"] or "")
+            if not started:
+                # Bỏ khoảng trắng đầu câu giống .strip() của bản không stream
+                chunk = chunk.lstrip()
+                started = bool(chunk)
+            if chunk:
+                yield chunk
+
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logging.error(f"Lỗi stream model Pro ({MODEL_NAME}): {e}")
+        yield f"Xin lỗi, mô hình Pro hiện đang gặp lỗi: {str(e)}"
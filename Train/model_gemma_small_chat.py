@@ -1,48 +1,135 @@
-import ollama
-from typing import List, Dict
+from typing import List, Dict, Tuple
 import re
 import logging
 
+from .admission import AdmissionRejected, configure_limit
+from .ollama_client import chat, chat_stream, set_keep_alive
+from .prompt_builder import build_chat_messages
+
 logging.basicConfig(level=logging.INFO)
 
 MODEL_NAME = "gemma3:1b"
 
+# Hạn chót (giây) cho một lượt sinh của model này
+REQUEST_TIMEOUT = 60
+
+# Số lời gọi đồng thời tới Ollama, số request được xếp hàng, thời gian chờ tối đa trong hàng (giây)
+configure_limit(MODEL_NAME, max_concurrency=4, max_queue=32, queue_timeout=10)
+
+# Model chat: giữ trong RAM luôn (-1) để không phải nạp lại giữa các câu hỏi
+KEEP_ALIVE = -1
+set_keep_alive(MODEL_NAME, KEEP_ALIVE)
+
 SYSTEM_PROMPT_FORMAT = (
     "Bạn là trợ lý AI Skemi. Hãy trả lời một cách tự nhiên và hữu ích như một người bạn, phù hợp với cấp độ câu hỏi đơn giản. "
     "TUYỆT ĐỐI không sử dụng bất kỳ định dạng Markdown hoặc ký tự đặc biệt nào như *, **, #, [], v.v. "
-    "Chỉ trả về văn bản thuần. Yêu cầu về ngôn ngữ ĐẦU RA (Việt/Anh) phải được TUÂN THỦ NGHIÊM NGẶT từ các hướng dẫn trước đó."
+    "Chỉ trả về văn bản thuần. Yêu cầu về ngôn ngữ ĐẦU RA (Việt/Anh) phải được TUÂN THỦ NGHIÊM NGẶT theo hướng dẫn trong ngoặc ở cuối câu hỏi."
 )
 
 
-def call_gemma__small_chat(messages: List[Dict[str, str]]):
-    
-    lang_system_prompt = next((m for m in messages if m['role'] == 'system'), None)
-    
-    full_messages = []
-    
-    # 1. Thêm System Prompt về Format/Tone
-    full_messages.append({"role": "system", "content": SYSTEM_PROMPT_FORMAT})
+def _build_full_messages(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    # SYSTEM_PROMPT_FORMAT luôn đứng đầu và không đổi -> Ollama dùng lại KV cache của phần này
+    return build_chat_messages(SYSTEM_PROMPT_FORMAT, messages)
+
+
+async def call_gemma__small_chat(messages: List[Dict[str, str]]):
     
-    # 2. Thêm System Prompt về Ngôn ngữ (Ưu tiên cao)
-    if lang_system_prompt:
-        full_messages.append(lang_system_prompt)
-        
-    # 3. Thêm các tin nhắn lịch sử và tin nhắn User hiện tại
-    full_messages.extend([m for m in messages if m['role'] != 'system'])
+    full_messages = _build_full_messages(messages)
 
     try:
         logging.info(f"Calling Ollama Small: {MODEL_NAME} with {len(full_messages)} messages.")
         
-        response = ollama.chat(
+        response = await chat(
             model=MODEL_NAME,
             messages=full_messages,
-            options={'temperature': 0.5}
+            options={'temperature': 0.5},
+            timeout=REQUEST_TIMEOUT
         )
 
         text = getattr(response.message, "content", str(response))
         text = re.sub(r'[*_~`#]', '', text)
         return text.strip()
 
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logging.error(f"Lỗi gọi model SMALL ({MODEL_NAME}): {e}")
+        return "Xin lỗi, tôi không thể trả lời lúc này."
+
+
+async def call_gemma__small_summary(messages: List[Dict[str, str]]) -> str:
+    """
+    Gửi `messages` nguyên trạng (không persona Skemi, không qua build_chat_messages) cho việc nén lịch sử:
+    system message của người gọi là chỉ dẫn chính. Lỗi được raise thay vì trả câu xin lỗi,
+    để câu xin lỗi không bị lưu làm tóm tắt.
+    """
+    logging.info(f"Calling Ollama Small (summary): {MODEL_NAME} with {len(messages)} messages.")
+    response = await chat(
+        model=MODEL_NAME,
+        messages=messages,
+        options={'temperature': 0.2},
+        timeout=REQUEST_TIMEOUT
+    )
+    text = getattr(response.message, "content", str(response))
+    return re.sub(r'[*_~`#]', '', text).strip()
+
+
+async def call_gemma__small_chat_scored(messages: List[Dict[str, str]]) -> Tuple[str, float | None]:
+    """
+    Như call_gemma__small_chat nhưng xin thêm logprob của từng token để chế độ cascade đánh giá độ tự tin.
+    Trả về (text, logprob trung bình); logprob là None nếu bản Ollama đang chạy không hỗ trợ logprobs.
+    """
+    full_messages = _build_full_messages(messages)
+
+    try:
+        logging.info(f"Calling Ollama Small (scored): {MODEL_NAME} with {len(full_messages)} messages.")
+
+        response = await chat(
+            model=MODEL_NAME,
+            messages=full_messages,
+            options={'temperature': 0.5},
+            timeout=REQUEST_TIMEOUT,
+            logprobs=True
+        )
+
+        logprobs = response.get("logprobs") or []
+        mean_logprob = sum(lp["logprob"] for lp in logprobs) / len(logprobs) if logprobs else None
+
+        text = getattr(response.message, "content", str(response))
+        text = re.sub(r'[*_~`#]', '', text)
+        return text.strip(), mean_logprob
+
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logging.error(f"Lỗi gọi model SMALL ({MODEL_NAME}): {e}")
-        return "Xin lỗi, tôi không thể trả lời lúc này."
\ No newline at end of file
+        return "Xin lỗi, tôi không thể trả lời lúc này.", None
+
+
+async def stream_gemma__small_chat(messages: List[Dict[str, str]]):
+    """Giống call_gemma__small_chat nhưng yield từng đoạn text ngay khi Ollama sinh ra."""
+    full_messages = _build_full_messages(messages)
+    started = False
+
+    try:
+        logging.info(f"Streaming Ollama Small: {MODEL_NAME} with {len(full_messages)} messages.")
+
+        async for part in chat_stream(
+            model=MODEL_NAME,
+            messages=full_messages,
+            options={'temperature': 0.5},
+            timeout=REQUEST_TIMEOUT
+        ):
+            chunk = re.sub(r'[*_~`#]', '', part["message"]["content"] or "")
+            if not started:
+                # Bỏ khoảng trắng đầu câu giống .strip() của bản không stream
+                chunk = chunk.lstrip()
+                started = bool(chunk)
+            if chunk:
+                yield chunk
+
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logging.error(f"Lỗi stream model SMALL ({MODEL_NAME}): {e}")
+        yield "Xin lỗi, tôi không thể trả lời lúc này."
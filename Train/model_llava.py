@@ -1,30 +1,73 @@
+import asyncio
+import hashlib
 import json
 import math # Giữ math nhưng không dùng trong logic tính tọa độ
 import logging
 import re
 import tempfile
-from typing import Any, List, Dict
+from typing import Any, Callable, List, Dict
 import os
 
 # (Giữ nguyên phần import module OCR và OLLAMA)
 try:
-    from .ocr_module import extract_text_from_image
+    from . import ocr_module
+    from .ocr_module import OCR_LANGUAGES, extract_text_from_image
     _OCR_AVAILABLE = True
 except ImportError:
     logging.warning("OCR module not available.")
     _OCR_AVAILABLE = False
 
+from .admission import AdmissionRejected, configure_limit
+
 try:
-    from ollama import chat
+    from .ollama_client import chat, set_keep_alive
     _OLLAMA_AVAILABLE = True
     MODEL_NAME = "llava:13b"
     OLLAMA_OPTIONS = {"temperature":0.1, "seed":42, "num_ctx":4096}
+    REQUEST_TIMEOUT = 600 # llava:13b trên CPU có thể mất vài phút
+    # llava:13b chiếm gần hết CPU: chạy từng cái một, hàng đợi ngắn
+    configure_limit(MODEL_NAME, max_concurrency=1, max_queue=4, queue_timeout=60)
+    # llava:13b tốn nhiều RAM: nhả khỏi bộ nhớ sau LLAVA_KEEP_ALIVE phút không dùng
+    KEEP_ALIVE = f"{os.getenv('LLAVA_KEEP_ALIVE', '10')}m"
+    set_keep_alive(MODEL_NAME, KEEP_ALIVE)
 except Exception:
     logging.warning("OLLAMA not available, using mock")
     _OLLAMA_AVAILABLE = False
 
 logging.basicConfig(level=logging.INFO)
 
+# Prompt cho ảnh không có chữ (llava chỉ nhận diện chủ đề)
+IMAGE_TOPIC_PROMPT = (
+    "You are a Mind Map Topic Identifier. "
+    "TASK: Identify the MAIN TOPIC/SUBJECT of the uploaded IMAGE (no OCR text available). "
+    "Respond ONLY with a JSON object: {'topic':'TOPIC_IN_ENGLISH','nodes':[]}. "
+    "If the image is a person/logo/simple object, use the name as the topic. If it's a diagram, describe the subject."
+    "Example 1: {'topic':'Cristiano Ronaldo Footballer','nodes':[]}. Example 2: {'topic':'Chatbot Digital Assistant','nodes':[]}"
+)
+# Prompt sinh mindmap từ text OCR (text được nối vào cuối)
+MINDMAP_PROMPT = (
+    "You are a mind map generation expert. TASK: Based on the following text, "
+    "identify the MAIN TOPIC in **ENGLISH** and create mindmap nodes in Vietnamese "
+    "up to 3 levels deep. ONLY RETURN JSON: {'topic':'TOPIC_IN_ENGLISH','nodes':[{'text':'','children':[...]}]}. "
+)
+# Tăng khi sửa logic parse / fallback / hậu xử lý làm thay đổi kết quả với cùng model và prompt
+PIPELINE_VERSION = 1
+
+
+def pipeline_fingerprint() -> str:
+    """
+    Dấu vân tay của pipeline sinh mindmap (model, prompt, options, ngôn ngữ OCR, PIPELINE_VERSION).
+    Được lưu cùng mỗi entry cache: đổi bất kỳ thành phần nào thì kết quả cũ bị coi là cũ (stale).
+    """
+    parts = {
+        "model": MODEL_NAME if _OLLAMA_AVAILABLE else None,
+        "prompts": hashlib.sha256((IMAGE_TOPIC_PROMPT + "\0" + MINDMAP_PROMPT).encode("utf-8")).hexdigest(),
+        "options": OLLAMA_OPTIONS if _OLLAMA_AVAILABLE else None,
+        "ocr_languages": OCR_LANGUAGES if _OCR_AVAILABLE else None,
+        "version": PIPELINE_VERSION,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
 def _clean_and_extract_json(raw_text: str) -> str | None:
     # Tìm đoạn JSON từ { đến }
     match = re.search(r'\{.*\}', raw_text, re.DOTALL)
@@ -86,7 +129,85 @@ def save_bytes_to_tempfile(file_bytes: bytes, suffix: str = ".png") -> str:
     return temp_file.name
 
 
-def call_mindmap_generation(input_data: bytes) -> List[Any]:
+async def structure_mindmap_text(input_text: str, on_stage: Callable[..., None] | None = None) -> List[Any]:
+    """Phần dựng mindmap từ text (prompt -> llava -> parse JSON / fallback), dùng chung cho OCR và text dán vào."""
+    if on_stage:
+        on_stage("llm_running")
+    # SỬA 2: ÉP buộc đầu ra Tiếng Anh cho TOPIC và kèm theo YÊU CẦU JSON (Logic giữ nguyên)
+    prompt = f"{MINDMAP_PROMPT}Text:\n--- {input_text} ---"
+    messages = [
+        {"role":"system","content":prompt},
+        {"role":"user","content":"Analyze text and return JSON mindmap."}
+    ]
+
+    resp = await chat(model=MODEL_NAME, messages=messages, options=OLLAMA_OPTIONS, timeout=REQUEST_TIMEOUT)
+    raw = getattr(resp, "message", {}).get("content", str(resp))
+    cleaned_json = _clean_and_extract_json(raw)
+
+    if not cleaned_json:
+        logging.warning(f"LLM failed to return valid JSON. Fallback initiated. Raw response: {raw[:100]}...")
+
+        # FALLBACK LOGIC
+        lines = [ln.strip() for ln in (raw or "").splitlines() if ln.strip()]
+        topic_guess = "Undefined Topic (JSON Error)"
+        nodes = []
+
+        if lines:
+            first_line = lines[0].strip()
+            topic_raw = first_line.replace('{','').replace('}','').split(',')[0].split(':')[-1].strip().replace("'", "").replace('"', "")
+            topic_guess = simple_vn_to_en_topic(topic_raw) 
+            nodes = fallback_to_flat_nodes(lines)
+
+        return [topic_guess, nodes]
+
+    # LOGIC KHI THÀNH CÔNG JSON
+    data = json.loads(cleaned_json)
+    topic = data.get("topic", "")
+    nodes = data.get("nodes", [])
+
+    if not topic or (isinstance(topic, str) and topic.strip() == ''):
+        topic = "Topic Not Found (Empty Field)"
+    else:
+        topic = simple_vn_to_en_topic(topic) 
+
+    # --- ĐÃ XÓA LỆNH GỌI TÍNH TỌA ĐỘ ---
+    # assign_coords_recursive(nodes, 400, 300)
+    # ------------------------------------
+    return [topic, nodes]
+
+
+async def call_mindmap_generation_from_text(text: str, on_stage: Callable[..., None] | None = None) -> List[Any]:
+    """Như call_mindmap_generation nhưng với text người dùng dán vào: không file tạm, không EasyOCR."""
+    if not _OLLAMA_AVAILABLE:
+        return ["Mock Topic - English", fallback_to_flat_nodes(["Main Idea 1", "Main Idea 2"])]
+    try:
+        return await structure_mindmap_text(text, on_stage)
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logging.exception("call_mindmap_generation_from_text error:")
+        return [f"Error processing Mindmap: {str(e)}", []]
+
+
+async def read_image_text(image_path: str) -> List[str] | None:
+    """Các dòng OCR của ảnh (EasyOCR chạy trong thread); None nếu không có OCR để đọc."""
+    if not _OCR_AVAILABLE or ocr_module.reader is None:
+        return None
+    return await asyncio.to_thread(extract_text_from_image, image_path)
+
+
+async def call_mindmap_generation(input_data: bytes | str, on_stage: Callable[..., None] | None = None,
+                                  ocr_lines: List[str] | None = None) -> List[Any]:
+    """
+    `input_data` là đường dẫn tới file đã lưu sẵn (file tạm của Server, bên gọi tự xóa) hoặc bytes
+    (được ghi ra file tạm riêng và xóa khi xong).
+    `ocr_lines`: kết quả OCR bên gọi đã có sẵn (read_image_text) -> không OCR lại.
+    `on_stage(stage, **info)` được gọi ở các mốc: "ocr_done" (lines=...), "llm_running".
+    """
+    def stage(name: str, **info):
+        if on_stage:
+            on_stage(name, **info)
+
     if not _OCR_AVAILABLE:
         return ["Error: OCR Module is not available", []]
     if not _OLLAMA_AVAILABLE:
@@ -94,28 +215,27 @@ def call_mindmap_generation(input_data: bytes) -> List[Any]:
 
     temp_path = None
     try:
-        temp_path = save_bytes_to_tempfile(input_data)
-        ocr_lines = extract_text_from_image(temp_path)
+        if isinstance(input_data, str):
+            image_path = input_data
+        else:
+            image_path = temp_path = save_bytes_to_tempfile(input_data)
+        if ocr_lines is None:
+            # EasyOCR là CPU-bound và blocking -> đẩy sang thread, không chặn event loop
+            ocr_lines = await asyncio.to_thread(extract_text_from_image, image_path)
+        stage("ocr_done", lines=len(ocr_lines or []))
         
         # SỬA 1: Xử lý trường hợp ảnh không có chữ (Logic VLLM giữ nguyên)
         if not ocr_lines or not "".join(ocr_lines).strip():
             logging.warning("No significant text extracted by OCR. Using VLLM for image description.")
             
             # --- TẠO PROMPT MỚI CHO VLLM (Visual Language Model) ---
-            vllm_prompt = (
-                "You are a Mind Map Topic Identifier. "
-                "TASK: Identify the MAIN TOPIC/SUBJECT of the uploaded IMAGE (no OCR text available). "
-                "Respond ONLY with a JSON object: {'topic':'TOPIC_IN_ENGLISH','nodes':[]}. "
-                "If the image is a person/logo/simple object, use the name as the topic. If it's a diagram, describe the subject."
-                "Example 1: {'topic':'Cristiano Ronaldo Footballer','nodes':[]}. Example 2: {'topic':'Chatbot Digital Assistant','nodes':[]}"
-            )
-            
             messages_vllm = [
-                {"role":"system","content": vllm_prompt},
-                {"role":"user","content":[{"type":"text","text":"Analyze image for main topic."}, {"type":"image","path":temp_path}]}
+                {"role":"system","content": IMAGE_TOPIC_PROMPT},
+                {"role":"user","content":[{"type":"text","text":"Analyze image for main topic."}, {"type":"image","path":image_path}]}
             ]
             
-            resp_vllm = chat(model=MODEL_NAME, messages=messages_vllm, options=OLLAMA_OPTIONS)
+            stage("llm_running")
+            resp_vllm = await chat(model=MODEL_NAME, messages=messages_vllm, options=OLLAMA_OPTIONS, timeout=REQUEST_TIMEOUT)
             raw_vllm = getattr(resp_vllm, "message", {}).get("content", str(resp_vllm))
             cleaned_json_vllm = _clean_and_extract_json(raw_vllm)
             
@@ -132,53 +252,10 @@ def call_mindmap_generation(input_data: bytes) -> List[Any]:
         input_text = "\n".join(ocr_lines)
         logging.info(f"OCR success: {len(ocr_lines)} lines")
 
-        # SỬA 2: ÉP buộc đầu ra Tiếng Anh cho TOPIC và kèm theo YÊU CẦU JSON (Logic giữ nguyên)
-        prompt = (
-            "You are a mind map generation expert. TASK: Based on the following text, "
-            "identify the MAIN TOPIC in **ENGLISH** and create mindmap nodes in Vietnamese "
-            "up to 3 levels deep. ONLY RETURN JSON: {'topic':'TOPIC_IN_ENGLISH','nodes':[{'text':'','children':[...]}]}. "
-            f"Text:\n--- {input_text} ---"
-        )
-        messages = [
-            {"role":"system","content":prompt},
-            {"role":"user","content":"Analyze text and return JSON mindmap."}
-        ]
-        
-        resp = chat(model=MODEL_NAME, messages=messages, options=OLLAMA_OPTIONS)
-        raw = getattr(resp, "message", {}).get("content", str(resp))
-        cleaned_json = _clean_and_extract_json(raw)
-        
-        if not cleaned_json:
-            logging.warning(f"LLM failed to return valid JSON. Fallback initiated. Raw response: {raw[:100]}...")
-            
-            # FALLBACK LOGIC
-            lines = [ln.strip() for ln in (raw or "").splitlines() if ln.strip()]
-            topic_guess = "Undefined Topic (JSON Error)"
-            nodes = []
-            
-            if lines:
-                first_line = lines[0].strip()
-                topic_raw = first_line.replace('{','').replace('}','').split(',')[0].split(':')[-1].strip().replace("'", "").replace('"', "")
-                topic_guess = simple_vn_to_en_topic(topic_raw) 
-                nodes = fallback_to_flat_nodes(lines)
-                
-            return [topic_guess, nodes]
-
-        # LOGIC KHI THÀNH CÔNG JSON
-        data = json.loads(cleaned_json)
-        topic = data.get("topic", "")
-        nodes = data.get("nodes", [])
-        
-        if not topic or (isinstance(topic, str) and topic.strip() == ''):
-            topic = "Topic Not Found (Empty Field)"
-        else:
-            topic = simple_vn_to_en_topic(topic) 
-            
-        # --- ĐÃ XÓA LỆNH GỌI TÍNH TỌA ĐỘ ---
-        # assign_coords_recursive(nodes, 400, 300)
-        # ------------------------------------
-        return [topic, nodes]
+        return await structure_mindmap_text(input_text, on_stage)
 
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logging.exception("call_mindmap_generation error:")
         return [f"Error processing Mindmap: {str(e)}", []]
@@ -2,9 +2,10 @@ import easyocr
 import logging
 
 logging.basicConfig(level=logging.INFO)
+OCR_LANGUAGES = ['vi','en']
 try:
     # Tải EasyOCR (giả định đã được cài đặt)
-    reader = easyocr.Reader(['vi','en'], gpu=False)
+    reader = easyocr.Reader(OCR_LANGUAGES, gpu=False)
     logging.info("EasyOCR loaded (CPU mode).")
 except Exception as e:
     logging.error(f"OCR init error: {e}")
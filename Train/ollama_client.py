@@ -0,0 +1,256 @@
+import os
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List
+
+import httpx
+
+from .admission import get_limiter
+from .backends import InferenceBackend, create_backend
+from .host_pool import CONNECT_ERRORS, HostPool
+from .prompt_builder import prompt_stats
+from .singleflight import SingleFlight, request_key
+
+logging.basicConfig(level=logging.INFO)
+
+# Runtime suy luận: "ollama" (mặc định), "openai" (llama.cpp server / server tương thích OpenAI)
+# hoặc "fake" (backend giả tất định để load test). Các module model không cần sửa khi đổi.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "ollama")
+DEFAULT_HOSTS = {"ollama": "http://127.0.0.1:11434", "openai": "http://127.0.0.1:8080", "fake": ""}
+
+# Mỗi host một client async dùng chung cho cả tiến trình: các model dùng chung pool kết nối
+# keep-alive tới runtime thay vì mở kết nối HTTP mới (và chiếm 1 thread) mỗi lần gọi.
+OLLAMA_HOST = os.getenv("OLLAMA_HOST") or os.getenv("INFERENCE_HOST") or DEFAULT_HOSTS.get(INFERENCE_BACKEND, "")
+MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "32"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OLLAMA_MAX_KEEPALIVE", "16"))
+KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "120"))
+CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+DEFAULT_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "300"))
+
+# Nhiều máy chạy Ollama: OLLAMA_HOSTS="http://a:11434,http://b:11434" cho mọi model, hoặc riêng từng
+# model: OLLAMA_HOST_POOLS='{"llava:13b": ["http://b:11434"]}'. Mặc định chỉ một host OLLAMA_HOST.
+OLLAMA_HOSTS = [h.strip() for h in os.getenv("OLLAMA_HOSTS", "").split(",") if h.strip()] or [OLLAMA_HOST]
+OLLAMA_HOST_POOLS: Dict[str, List[str]] = json.loads(os.getenv("OLLAMA_HOST_POOLS", "{}"))
+HOST_EJECT_AFTER = int(os.getenv("OLLAMA_HOST_EJECT_AFTER", "2"))
+HOST_COOLDOWN = float(os.getenv("OLLAMA_HOST_COOLDOWN", "30"))
+HEALTH_CHECK_INTERVAL = float(os.getenv("OLLAMA_HEALTH_CHECK_INTERVAL", "10"))
+
+_clients: Dict[str, InferenceBackend] = {}
+_pools: Dict[str, HostPool] = {}
+_health_task: asyncio.Task | None = None
+
+# Chính sách keep_alive theo model (-1 = giữ trong RAM mãi, "10m" = nhả sau 10 phút rảnh).
+# Được áp cho mọi lời gọi chat tới model đó nếu bên gọi không tự truyền keep_alive.
+_keep_alive: Dict[str, Any] = {}
+
+# Các request giống hệt nhau (model, prompt, options) đang chạy chỉ sinh một lần rồi chia kết quả
+flight = SingleFlight()
+
+
+def get_client(host: str = OLLAMA_HOST) -> InferenceBackend:
+    if host not in _clients:
+        _clients[host] = create_backend(
+            INFERENCE_BACKEND,
+            host,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            connect_timeout=CONNECT_TIMEOUT,
+        )
+        logging.info(f"Inference backend '{INFERENCE_BACKEND}' created for {host or 'in-process'} (max {MAX_CONNECTIONS} connections).")
+    return _clients[host]
+
+
+def pool_for(model: str) -> HostPool:
+    if model not in _pools:
+        # Giới hạn đồng thời của model được cấu hình theo từng host -> nhân theo số host đang dùng được
+        _pools[model] = HostPool(model, OLLAMA_HOST_POOLS.get(model) or OLLAMA_HOSTS,
+                                 eject_after=HOST_EJECT_AFTER, cooldown=HOST_COOLDOWN,
+                                 on_capacity_change=get_limiter(model).set_hosts)
+    return _pools[model]
+
+
+def host_stats() -> Dict[str, Any]:
+    return {model: pool.stats() for model, pool in _pools.items()}
+
+
+async def _health_loop():
+    while True:
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        for pool in list(_pools.values()):
+            await pool.check_health(lambda url: get_client(url).ps())
+
+
+def start_health_checks():
+    """Chỉ cần khi có model chạy trên nhiều host; gọi trong startup của Server."""
+    global _health_task
+    if _health_task is None and (len(OLLAMA_HOSTS) > 1 or OLLAMA_HOST_POOLS):
+        _health_task = asyncio.create_task(_health_loop())
+
+
+async def close_client():
+    global _health_task
+    if _health_task is not None:
+        _health_task.cancel()
+        _health_task = None
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
+
+
+async def _on_host(model: str, call: Callable[[InferenceBackend], Awaitable[Any]]) -> Any:
+    """Chạy `call` trên host ít request nhất; không kết nối được thì thử lần lượt các host còn lại."""
+    pool = pool_for(model)
+    tried: List[str] = []
+    while True:
+        host = None
+        try:
+            async with pool.lease(tried) as host:
+                return await call(get_client(host.url))
+        except CONNECT_ERRORS:
+            if host is None:
+                raise
+            tried.append(host.url)
+            if len(tried) >= len(pool):
+                raise
+            logging.warning(f"{host.url} unreachable for {model}, retrying on another host.")
+
+
+def set_keep_alive(model: str, keep_alive: Any):
+    _keep_alive[model] = keep_alive
+
+
+def keep_alive_policy() -> Dict[str, Any]:
+    return dict(_keep_alive)
+
+
+def _with_keep_alive(model: str, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    if model in _keep_alive and "keep_alive" not in kwargs:
+        return {**kwargs, "keep_alive": _keep_alive[model]}
+    return kwargs
+
+
+async def warm_up(model: str, timeout: float = DEFAULT_TIMEOUT):
+    """Nạp model vào RAM trên mọi host của pool bằng một request rỗng, áp luôn keep_alive của model."""
+    urls = [h.url for h in pool_for(model).hosts]
+    results = await asyncio.gather(
+        *(asyncio.wait_for(get_client(url).generate(model=model, prompt="", keep_alive=_keep_alive.get(model)), timeout)
+          for url in urls),
+        return_exceptions=True,
+    )
+    errors = [r for r in results if isinstance(r, BaseException)]
+    for url, error in zip(urls, results):
+        if isinstance(error, BaseException):
+            logging.warning(f"Warm-up of {model} failed on {url}: {error!r}")
+    if len(errors) == len(urls):
+        raise errors[0]
+
+
+async def resident_models(timeout: float = 5.0) -> Dict[str, Dict[str, Any]]:
+    """Các model đang nằm trong bộ nhớ (ollama ps) trên ít nhất một host, kèm danh sách host."""
+    urls = list(dict.fromkeys(OLLAMA_HOSTS + [h.url for p in _pools.values() for h in p.hosts]))
+    responses = await asyncio.gather(*(asyncio.wait_for(get_client(url).ps(), timeout) for url in urls),
+                                     return_exceptions=True)
+    if all(isinstance(r, BaseException) for r in responses):
+        raise responses[0]
+
+    resident: Dict[str, Dict[str, Any]] = {}
+    for url, response in zip(urls, responses):
+        if isinstance(response, BaseException):
+            continue
+        for m in response["models"]:
+            entry = resident.setdefault(m["model"], {
+                "size": m["size"],
+                "expires_at": str(m["expires_at"]) if m["expires_at"] else None,
+                "hosts": [],
+            })
+            entry["hosts"].append(url)
+    return resident
+
+
+async def chat(model: str, messages: List[Dict[str, Any]], options: Dict[str, Any] | None = None,
+               timeout: float = DEFAULT_TIMEOUT, **kwargs):
+    """
+    Gọi ollama chat (không stream), hủy request nếu vượt quá `timeout` giây.
+    Chỉ lời gọi dẫn đầu của single-flight mới chiếm slot của model (AdmissionRejected nếu quá tải).
+    """
+    kwargs = _with_keep_alive(model, kwargs)
+
+    async def call():
+        async with get_limiter(model).slot():
+            response = await _on_host(model, lambda client: asyncio.wait_for(
+                client.chat(model=model, messages=messages, options=options, **kwargs),
+                timeout,
+            ))
+        prompt_stats.record(model, messages, response)
+        return response
+
+    return await flight.do(request_key(model, messages, options, **kwargs), call)
+
+
+def chat_stream(model: str, messages: List[Dict[str, Any]], options: Dict[str, Any] | None = None,
+                timeout: float = DEFAULT_TIMEOUT, **kwargs) -> AsyncIterator[Any]:
+    """Gọi ollama chat dạng stream. `timeout` là hạn chót cho toàn bộ lượt sinh."""
+    kwargs = _with_keep_alive(model, kwargs)
+    return flight.stream(
+        request_key(model, messages, options, stream=True, **kwargs),
+        lambda: _chat_stream(model, messages, options, timeout, **kwargs),
+    )
+
+
+async def _chat_stream(model: str, messages: List[Dict[str, Any]], options: Dict[str, Any] | None,
+                       timeout: float, **kwargs) -> AsyncIterator[Any]:
+    # Slot của model và host được giữ suốt lượt sinh
+    async with get_limiter(model).slot():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        pool = pool_for(model)
+        tried: List[str] = []
+
+        while True:
+            host = None
+            started = False
+            try:
+                async with pool.lease(tried) as host:
+                    stream = await asyncio.wait_for(
+                        get_client(host.url).chat(model=model, messages=messages, options=options, stream=True, **kwargs),
+                        timeout,
+                    )
+                    parts = stream.__aiter__()
+                    try:
+                        while True:
+                            remaining = deadline - loop.time()
+                            if remaining <= 0:
+                                raise asyncio.TimeoutError(f"Ollama stream for {model} exceeded {timeout}s")
+                            try:
+                                part = await asyncio.wait_for(parts.__anext__(), remaining)
+                            except StopAsyncIteration:
+                                break
+                            if part.get("done"):
+                                # Chunk cuối mang prompt_eval_count/prompt_eval_duration của cả lượt
+                                prompt_stats.record(model, messages, part)
+                            started = True
+                            yield part
+                    finally:
+                        # Đóng stream để giải phóng kết nối về pool ngay khi dừng sớm
+                        aclose = getattr(parts, "aclose", None)
+                        if aclose:
+                            await aclose()
+                return
+            except CONNECT_ERRORS:
+                # Chỉ thử host khác khi chưa gửi phần nào cho bên gọi
+                if host is None or started:
+                    raise
+                tried.append(host.url)
+                if len(tried) >= len(pool):
+                    raise
+                logging.warning(f"{host.url} unreachable for {model}, retrying stream on another host.")
+
+
+async def embed(model: str, text: str, timeout: float = 30.0) -> List[float]:
+    """Trả về vector embedding của `text` bằng một model embedding của Ollama."""
+    response = await _on_host(model, lambda client: asyncio.wait_for(client.embed(model=model, input=text), timeout))
+    return response["embeddings"][0]
@@ -0,0 +1,154 @@
+import logging
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+try:
+    from PIL import Image
+    _PIL_AVAILABLE = True
+except ImportError:
+    logging.warning("Pillow not available: near-duplicate image lookup disabled.")
+    _PIL_AVAILABLE = False
+
+logging.basicConfig(level=logging.INFO)
+
+HASH_BITS = 64
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    # Ma trận DCT-II trực chuẩn: dct2(x) = D @ x @ D.T
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    d[0] /= np.sqrt(2.0)
+    return d
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def dhash(gray: "Image.Image") -> int:
+    """Difference hash 64 bit: so sánh độ sáng các pixel kề nhau trên ảnh xám 9x8."""
+    pixels = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.float32)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(gray: "Image.Image") -> int:
+    """Perceptual hash 64 bit: 8x8 hệ số DCT tần số thấp (bỏ DC) của ảnh xám 32x32, so với trung vị."""
+    pixels = np.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8].flatten()
+    median = np.median(low[1:])
+    return _bits_to_int(low > median)
+
+
+def image_hashes(path: str) -> Tuple[int, int] | None:
+    """
+    (dhash, phash) của file ảnh, None nếu không phải ảnh đọc được hoặc ảnh gần như một màu
+    (mọi ảnh trơn đều có hash giống nhau, không dùng để so trùng được). Blocking: gọi qua asyncio.to_thread.
+    """
+    if not _PIL_AVAILABLE:
+        return None
+    try:
+        with Image.open(path) as image:
+            image.draft("L", (256, 256))  # JPEG: giải mã thẳng ở độ phân giải thấp
+            gray = image.convert("L")
+    except Exception:
+        return None
+    d, p = dhash(gray), phash(gray)
+    if not 4 < bin(p).count("1") < HASH_BITS - 4:
+        return None
+    return d, p
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """Cây BK theo khoảng cách Hamming: tìm mọi hash cách `value` không quá `max_distance` bit."""
+
+    def __init__(self):
+        # node = (hash, [keys], {khoảng cách: node con})
+        self._root: tuple[int, List[str], Dict[int, tuple]] | None = None
+        self.size = 0
+
+    def add(self, value: int, key: str):
+        self.size += 1
+        if self._root is None:
+            self._root = (value, [key], {})
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [key], {})
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, str]]:
+        found: List[Tuple[int, str]] = []
+        stack = [self._root] if self._root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, key) for key in node[1])
+            # Bất đẳng thức tam giác: chỉ các nhánh con trong [d - max, d + max] có thể chứa kết quả
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+
+class PerceptualIndex:
+    """
+    Chỉ mục gần trùng cho ảnh: BK-tree trên pHash, ứng viên phải khớp cả dHash.
+    Khoảng cách của một cặp = max(Hamming pHash, Hamming dHash); chỉ nhận khi <= `max_distance`.
+    Key bị xóa (cache evict) chỉ bị bỏ khỏi bảng tra, các node cũ trong cây được lọc khi tìm.
+    """
+
+    def __init__(self, max_distance: int = 8):
+        self.max_distance = max_distance
+        self._tree = BKTree()
+        self._hashes: Dict[str, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def add(self, key: str, hashes: Tuple[int, int]):
+        if self._hashes.get(key) == hashes:
+            return
+        self._hashes[key] = hashes
+        self._tree.add(hashes[1], key)
+
+    def discard(self, key: str):
+        self._hashes.pop(key, None)
+
+    def candidates(self, hashes: Tuple[int, int]) -> List[Tuple[str, int]]:
+        """Mọi (key, khoảng cách) trong ngưỡng, gần nhất trước."""
+        found: Dict[str, int] = {}
+        for _, key in self._tree.search(hashes[1], self.max_distance):
+            stored = self._hashes.get(key)
+            if stored is None:
+                continue
+            # Tính lại từ hash hiện tại của key (node trong cây có thể là hash cũ của key đó)
+            distance = max(hamming(hashes[0], stored[0]), hamming(hashes[1], stored[1]))
+            if distance <= self.max_distance:
+                found[key] = distance
+        return sorted(found.items(), key=lambda item: item[1])
+
+    def nearest(self, hashes: Tuple[int, int]) -> Tuple[str, int] | None:
+        """(key, khoảng cách) gần nhất trong ngưỡng, hoặc None."""
+        found = self.candidates(hashes)
+        return found[0] if found else None
@@ -0,0 +1,85 @@
+from typing import Any, Dict, List
+
+from .history import message_tokens
+
+# Chỉ dẫn ngôn ngữ ngắn, gắn vào CUỐI câu hỏi hiện tại (không nằm trong prefix dùng chung)
+LANGUAGE_DIRECTIVES = {
+    "vi": "Luôn trả lời bằng tiếng Việt.",
+    "en": "Always reply in English.",
+}
+
+
+def build_chat_messages(static_prompt: str, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    Sắp xếp prompt để Ollama/llama.cpp dùng lại KV cache của phần đầu giống nhau:
+
+        [system tĩnh của model]  -> giống hệt nhau byte-by-byte ở mọi lượt, mọi session
+        [system ngữ cảnh]        -> tóm tắt hội thoại, chỉ đổi khi lịch sử được nén lại
+        [lịch sử user/assistant] -> lượt sau chỉ nối thêm vào cuối
+        [câu hỏi hiện tại + chỉ dẫn]
+
+    Quy ước đầu vào (giữ như trước): system message đầu tiên là chỉ dẫn theo lượt (ngôn ngữ...),
+    các system message sau đó là ngữ cảnh. Chỉ dẫn được nối vào câu hỏi cuối thay vì đứng trước
+    lịch sử, nên đổi ngôn ngữ giữa các lượt không làm mất cache của toàn bộ lịch sử.
+    """
+    system = [m["content"] for m in messages if m["role"] == "system"]
+    turns = [m for m in messages if m["role"] != "system"]
+    directive, context = (system[0], system[1:]) if system else (None, [])
+
+    full_messages = [{"role": "system", "content": static_prompt}]
+    full_messages.extend({"role": "system", "content": c} for c in context)
+    full_messages.extend(turns)
+
+    if directive:
+        if full_messages[-1]["role"] == "user":
+            last = full_messages[-1]
+            full_messages[-1] = {**last, "content": f"{last['content']}\n\n({directive})"}
+        else:
+            full_messages.append({"role": "user", "content": directive})
+    return full_messages
+
+
+class PromptStats:
+    """
+    Đo lợi ích của prefix cache theo từng model từ các trường Ollama trả về.
+    prompt_eval_count chỉ đếm token thực sự phải tính lại, nên
+    (số token ước lượng của prompt - prompt_eval_count) ≈ số token được dùng lại từ KV cache.
+    Thời gian tiết kiệm = token dùng lại × thời gian prompt-eval trung bình mỗi token.
+    """
+
+    def __init__(self):
+        self._models: Dict[str, Dict[str, float]] = {}
+
+    def record(self, model: str, messages: List[Dict[str, Any]], response: Any):
+        try:
+            evaluated = response["prompt_eval_count"] or 0
+            duration_ns = response["prompt_eval_duration"] or 0
+        except (KeyError, TypeError):
+            return
+        estimated = sum(message_tokens(m) for m in messages if isinstance(m.get("content"), str))
+
+        m = self._models.setdefault(model, {
+            "requests": 0, "prompt_tokens_est": 0, "evaluated_tokens": 0,
+            "reused_tokens_est": 0, "eval_seconds": 0.0, "saved_seconds_est": 0.0,
+        })
+        m["requests"] += 1
+        m["prompt_tokens_est"] += estimated
+        m["evaluated_tokens"] += evaluated
+        m["eval_seconds"] += duration_ns / 1e9
+        if evaluated:
+            reused = max(0, estimated - evaluated)
+            m["reused_tokens_est"] += reused
+            m["saved_seconds_est"] += reused * duration_ns / evaluated / 1e9
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for model, m in self._models.items():
+            result[model] = {
+                **{k: round(v, 3) if isinstance(v, float) else v for k, v in m.items()},
+                "ms_per_prompt_token": round(m["eval_seconds"] * 1e3 / m["evaluated_tokens"], 3) if m["evaluated_tokens"] else 0.0,
+                "reuse_ratio_est": round(m["reused_tokens_est"] / m["prompt_tokens_est"], 3) if m["prompt_tokens_est"] else 0.0,
+            }
+        return result
+
+
+prompt_stats = PromptStats()
@@ -0,0 +1,65 @@
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """NFC + casefold + gộp khoảng trắng: "Xin  Chào " và "xin chào" cho cùng một key."""
+    text = unicodedata.normalize("NFC", text).casefold()
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+class ExactReplyCache:
+    """
+    Cache LRU khớp chính xác (sau chuẩn hóa) cho câu hỏi ngắn của model small.
+    Mỗi key giữ tối đa `answers_per_key` câu trả lời: khi chưa đủ thì vẫn gọi model (miss)
+    để gom thêm, khi đủ thì trả lần lượt từng câu để giữ sự đa dạng như temperature 0.5.
+    """
+
+    def __init__(self, max_entries: int = 1024, answers_per_key: int = 1):
+        self.max_entries = max_entries
+        self.answers_per_key = max(answers_per_key, 1)
+        # (câu hỏi chuẩn hóa, ngôn ngữ) -> [danh sách câu trả lời, vị trí xoay vòng tiếp theo]
+        self._entries: "OrderedDict[Tuple[str, str], List[Any]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, question: str, language: str) -> str | None:
+        key = (normalize_question(question), language)
+        entry = self._entries.get(key)
+        if entry is None or len(entry[0]) < self.answers_per_key:
+            self.misses += 1
+            return None
+        answers, position = entry
+        entry[1] = (position + 1) % len(answers)
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return answers[position]
+
+    def put(self, question: str, language: str, answer: str):
+        key = (normalize_question(question), language)
+        entry = self._entries.setdefault(key, [[], 0])
+        self._entries.move_to_end(key)
+        # Câu trả lời trùng vẫn được giữ, nếu không key có thể không bao giờ đủ để dùng
+        if len(entry[0]) < self.answers_per_key:
+            entry[0].append(answer)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "answers_per_key": self.answers_per_key,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,96 @@
+import logging
+import math
+import os
+import re
+import zlib
+from typing import Dict, Iterable, List
+
+logging.basicConfig(level=logging.INFO)
+
+LOW_COMPLEXITY_KEYWORDS = [
+    "chào", "hello", "xin chào", "hi", "hey",
+    "bạn là ai", "ai tạo ra bạn", "tên bạn", "who are you", "what is your name",
+    "hôm nay là ngày mấy", "ngày hôm nay", "ngày mấy", "today's date", "what time is it",
+    "lộ vậy", "đùa tao à", "hả", "sao", "what", "fuck", "shit", "why you so small",
+    "làm ơn", "please", "thank you", "cảm ơn"
+]
+
+HIGH_COMPLEXITY_KEYWORDS = ["giải thích", "phân tích", "tóm tắt", "sự khác biệt", "vì sao", "how does", "what is the difference", "tóm gọn"]
+
+# Số bucket mặc định cho đặc trưng n-gram băm của classifier
+DEFAULT_HASH_BUCKETS = 2 ** 16
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def hashed_ngram_features(text: str, buckets: int = DEFAULT_HASH_BUCKETS) -> List[int]:
+    """Chỉ số bucket của unigram + bigram từ (crc32 để kết quả giống nhau giữa các tiến trình)."""
+    tokens = _TOKEN.findall(text.lower())
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    return [zlib.crc32(g.encode("utf-8")) % buckets for g in grams]
+
+
+class ComplexityRouter:
+    """
+    Chọn tier "small"/"pro" cho câu hỏi.
+    Tất cả từ khóa được biên dịch thành MỘT regex alternation có ranh giới từ, nên chỉ quét chuỗi
+    một lần. Các từ khóa dài hơn được thử trước: "vì sao" được khớp nguyên cụm thay vì bị "sao"
+    (từ khóa small) chiếm. Nếu có file trọng số logistic regression (.npy) thì classifier quyết định.
+    """
+
+    def __init__(self, low_keywords: Iterable[str] = LOW_COMPLEXITY_KEYWORDS,
+                 high_keywords: Iterable[str] = HIGH_COMPLEXITY_KEYWORDS, weights_path: str | None = None):
+        self._tiers: Dict[str, str] = {}
+        for word in low_keywords:
+            self._tiers[word.lower()] = "small"
+        for word in high_keywords:
+            self._tiers[word.lower()] = "pro"
+
+        alternation = "|".join(re.escape(w) for w in sorted(self._tiers, key=len, reverse=True))
+        self._pattern = re.compile(rf"(?<!\w)(?:{alternation})(?!\w)", re.UNICODE)
+
+        self._weights = None
+        self._bias = 0.0
+        if weights_path:
+            self.load_weights(weights_path)
+
+    def load_weights(self, path: str):
+        if not os.path.exists(path):
+            logging.warning(f"Router weights not found at {path}, using keyword rules.")
+            return
+        try:
+            import numpy as np
+            weights = np.load(path)
+        except Exception as e:
+            logging.error(f"Cannot load router weights {path}: {e}")
+            return
+        # Phần tử cuối là bias, phần còn lại là trọng số theo bucket.
+        # Giữ dạng list: với vài chục chỉ số mỗi câu, cộng trên list nhanh hơn fancy-index NumPy
+        self._weights = weights[:-1].astype("float64").tolist()
+        self._bias = float(weights[-1])
+        logging.info(f"Router classifier loaded: {len(self._weights)} buckets from {path}")
+
+    @property
+    def uses_classifier(self) -> bool:
+        return self._weights is not None
+
+    def pro_probability(self, question: str) -> float:
+        indices = hashed_ngram_features(question, len(self._weights))
+        score = self._bias + sum(self._weights[i] for i in indices)
+        return 1.0 / (1.0 + math.exp(-score))
+
+    def route_by_keywords(self, question: str) -> str:
+        q_lower = question.lower().strip()
+        word_count = len(q_lower.split())
+        matched = {self._tiers[m] for m in self._pattern.findall(q_lower)}
+
+        if "small" in matched or word_count <= 4:
+            return "small"
+        if "pro" in matched or word_count > 6:
+            return "pro"
+        return "small"
+
+    def route(self, question: str) -> str:
+        if self._weights is not None:
+            return "pro" if self.pro_probability(question) >= 0.5 else "small"
+        return self.route_by_keywords(question)
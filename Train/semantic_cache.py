@@ -0,0 +1,111 @@
+import time
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+
+
+class SemanticReplyCache:
+    """
+    Cache câu trả lời theo ngữ nghĩa cho /ask: câu hỏi được embed, so cosine với các câu hỏi
+    đã trả lời (một ma trận NumPy cố định `capacity` dòng), trên ngưỡng `threshold` thì dùng lại
+    câu trả lời cũ. Mỗi entry gắn với (ngôn ngữ, model tier) và có TTL riêng.
+    """
+
+    def __init__(self, embed_fn: Callable[[str], Awaitable[List[float]]], capacity: int = 2048,
+                 threshold: float = 0.92, ttl_seconds: float = 3600.0):
+        self.embed_fn = embed_fn
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl_seconds
+
+        # Ma trận vector đã chuẩn hóa; cấp phát khi biết số chiều của embedding đầu tiên
+        self._matrix: np.ndarray | None = None
+        self._key_ids = np.full(capacity, -1, dtype=np.int32)
+        self._expires_at = np.zeros(capacity, dtype=np.float64)  # 0 = slot trống
+        self._inserted_at = np.zeros(capacity, dtype=np.float64)
+        self._answers: List[str | None] = [None] * capacity
+        self._keys: Dict[Tuple[str, str], int] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.embed_errors = 0
+
+    def _key_id(self, language: str, tier: str) -> int:
+        return self._keys.setdefault((language, tier), len(self._keys))
+
+    async def embed(self, question: str) -> np.ndarray | None:
+        try:
+            vector = np.asarray(await self.embed_fn(question.strip().lower()), dtype=np.float32)
+        except Exception as e:
+            self.embed_errors += 1
+            logging.warning(f"SemanticReplyCache: embedding failed, skipping cache: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    async def lookup(self, question: str, language: str, tier: str) -> Tuple[str | None, np.ndarray | None]:
+        """Trả về (câu trả lời hoặc None, vector câu hỏi để dùng lại khi store)."""
+        vector = await self.embed(question)
+        if vector is None:
+            return None, None
+        if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+            self.misses += 1
+            return None, vector
+
+        valid = (self._key_ids == self._key_id(language, tier)) & (self._expires_at > time.time())
+        if not valid.any():
+            self.misses += 1
+            return None, vector
+
+        scores = np.where(valid, self._matrix @ vector, -1.0)
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            self.hits += 1
+            return self._answers[best], vector
+        self.misses += 1
+        return None, vector
+
+    def store(self, vector: np.ndarray | None, language: str, tier: str, answer: str):
+        if vector is None:
+            return
+        if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+            # Lần đầu (hoặc đổi model embedding): cấp phát lại, bỏ các entry cũ không còn so được
+            self._matrix = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+            self._expires_at[:] = 0
+            self._key_ids[:] = -1
+            self._answers = [None] * self.capacity
+
+        now = time.time()
+        free = np.flatnonzero(self._expires_at <= now)
+        if free.size:
+            slot = int(free[0])
+        else:
+            # Đầy: thay entry được thêm vào sớm nhất
+            slot = int(np.argmin(self._inserted_at))
+            self.evictions += 1
+
+        self._matrix[slot] = vector
+        self._key_ids[slot] = self._key_id(language, tier)
+        self._expires_at[slot] = now + self.ttl
+        self._inserted_at[slot] = now
+        self._answers[slot] = answer
+        self.stores += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": int((self._expires_at > time.time()).sum()),
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "embed_errors": self.embed_errors,
+        }
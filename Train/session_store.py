@@ -0,0 +1,370 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict
+
+logging.basicConfig(level=logging.INFO)
+
+# Ước lượng chi phí bộ nhớ cố định của một message dict / một session (ngoài phần text)
+MESSAGE_OVERHEAD_BYTES = 64
+SESSION_OVERHEAD_BYTES = 256
+
+
+def estimate_session_bytes(session: Dict[str, Any]) -> int:
+    total = SESSION_OVERHEAD_BYTES
+    for m in session.get("messages", []):
+        total += MESSAGE_OVERHEAD_BYTES + len(m.get("content", "").encode("utf-8"))
+    return total
+
+
+class SessionStore:
+    """
+    Kho session trong bộ nhớ có giới hạn:
+    - hết hạn theo thời gian rảnh (TTL), quét định kỳ bằng task asyncio chạy nền
+    - giới hạn số session và tổng số byte, vượt quá thì loại session ít dùng nhất (LRU)
+    """
+
+    def __init__(self, ttl: timedelta, max_entries: int = 5000, max_bytes: int = 64 * 1024 * 1024,
+                 max_session_bytes: int | None = None, sweep_interval: float = 60.0):
+        self.ttl = ttl.total_seconds()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes or max(max_bytes // 8, 1)
+        self.sweep_interval = sweep_interval
+
+        # session_id -> (session, bytes, last_access). Thứ tự = thứ tự truy cập (cũ nhất ở đầu)
+        self._entries: "OrderedDict[str, tuple[Dict[str, Any], int, float]]" = OrderedDict()
+        self._bytes = 0
+        self._sweeper: asyncio.Task | None = None
+
+        self.evictions = 0
+        self.expirations = 0
+        self.trimmed_messages = 0
+
+    # ---------- truy cập ----------
+    def get(self, session_id: str) -> Dict[str, Any] | None:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        session, size, last_access = entry
+        now = time.monotonic()
+        if now - last_access > self.ttl:
+            self._remove(session_id)
+            self.expirations += 1
+            return None
+        self._entries[session_id] = (session, size, now)
+        self._entries.move_to_end(session_id)
+        return session
+
+    def set(self, session_id: str, session: Dict[str, Any]):
+        if session_id in self._entries:
+            self._remove(session_id)
+
+        size = estimate_session_bytes(session)
+        messages = session.get("messages", [])
+        # Một session quá lớn: bỏ bớt tin nhắn cũ nhất thay vì đẩy các session khác ra ngoài
+        while size > self.max_session_bytes and len(messages) > 1:
+            dropped = messages.pop(0)
+            size -= MESSAGE_OVERHEAD_BYTES + len(dropped.get("content", "").encode("utf-8"))
+            self.trimmed_messages += 1
+
+        self._entries[session_id] = (session, size, time.monotonic())
+        self._bytes += size
+        self._evict()
+
+    def delete(self, session_id: str) -> bool:
+        if session_id not in self._entries:
+            return False
+        self._remove(session_id)
+        return True
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # ---------- dọn dẹp ----------
+    def _remove(self, session_id: str):
+        _, size, _ = self._entries.pop(session_id)
+        self._bytes -= size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    async def sweep(self) -> int:
+        """
+        Xóa mọi session đã rảnh quá TTL. Trả về số session bị xóa.
+        Không cần await gì nhưng vẫn là coroutine để cùng chữ ký với SQLiteSessionStore.sweep.
+        """
+        cutoff = time.monotonic() - self.ttl
+        removed = 0
+        # Các entry xếp theo thời gian truy cập nên chỉ cần duyệt từ đầu tới entry còn hạn đầu tiên
+        while self._entries:
+            oldest, (_, _, last_access) = next(iter(self._entries.items()))
+            if last_access > cutoff:
+                break
+            self._remove(oldest)
+            removed += 1
+        self.expirations += removed
+        return removed
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            removed = await self.sweep()
+            if removed:
+                logging.info(f"SessionStore: expired {removed} idle sessions, {len(self._entries)} live.")
+
+    def start(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "backend": "memory",
+            "live_sessions": len(self._entries),
+            "bytes_held": self._bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "trimmed_messages": self.trimmed_messages,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def _encode_session(session: Dict[str, Any]) -> str:
+    return json.dumps(session, ensure_ascii=False, default=lambda o: o.isoformat() if isinstance(o, datetime) else str(o))
+
+
+def _decode_session(raw: str) -> Dict[str, Any]:
+    session = json.loads(raw)
+    if isinstance(session.get("created_at"), str):
+        session["created_at"] = datetime.fromisoformat(session["created_at"])
+    return session
+
+
+class SQLiteSessionStore:
+    """
+    Kho session dùng chung giữa nhiều worker uvicorn (cùng một máy) qua một file SQLite ở chế độ WAL.
+    Ghi theo kiểu write-behind: set()/delete() chỉ cập nhật hàng đợi trong tiến trình,
+    task nền gom lại và ghi cả lô trong một transaction mỗi `flush_interval` giây.
+    Cùng interface với SessionStore: get / set / delete / start / stats là hàm thường, sweep / close là coroutine;
+    thêm flush() để ghi ngay hàng đợi.
+    """
+
+    def __init__(self, path: str, ttl: timedelta, max_entries: int = 5000, max_bytes: int = 64 * 1024 * 1024,
+                 max_session_bytes: int | None = None, sweep_interval: float = 60.0, flush_interval: float = 0.05):
+        self.path = path
+        self.ttl = ttl.total_seconds()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes or max(max_bytes // 8, 1)
+        self.sweep_interval = sweep_interval
+        self.flush_interval = flush_interval
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Kết nối đọc dùng trên event loop; kết nối ghi chỉ dùng trong thread flush
+        self._reader = self._connect()
+        self._writer = self._connect()
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY, data TEXT NOT NULL,"
+            " bytes INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._writer.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions(last_access)")
+        self._writer.commit()
+
+        # session_id -> (json, bytes, last_access) hoặc None nếu là lệnh xóa
+        self._pending: Dict[str, tuple[str, int, float] | None] = {}
+        self._flushing: Dict[str, tuple[str, int, float] | None] = {}
+        self._flusher: asyncio.Task | None = None
+        self._sweeper: asyncio.Task | None = None
+
+        self.evictions = 0
+        self.expirations = 0
+        self.trimmed_messages = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # App có thể được import ở thread khác với thread chạy event loop/flush
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # ---------- truy cập ----------
+    def _lookup(self, session_id: str) -> tuple[str, int, float] | None:
+        for queue in (self._pending, self._flushing):
+            if session_id in queue:
+                return queue[session_id]
+        row = self._reader.execute(
+            "SELECT data, bytes, last_access FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def get(self, session_id: str) -> Dict[str, Any] | None:
+        entry = self._lookup(session_id)
+        if entry is None:
+            return None
+        raw, _, last_access = entry
+        if time.time() - last_access > self.ttl:
+            self._pending[session_id] = None
+            self.expirations += 1
+            return None
+        return _decode_session(raw)
+
+    def set(self, session_id: str, session: Dict[str, Any]):
+        size = estimate_session_bytes(session)
+        messages = session.get("messages", [])
+        while size > self.max_session_bytes and len(messages) > 1:
+            dropped = messages.pop(0)
+            size -= MESSAGE_OVERHEAD_BYTES + len(dropped.get("content", "").encode("utf-8"))
+            self.trimmed_messages += 1
+        self._pending[session_id] = (_encode_session(session), size, time.time())
+
+    def delete(self, session_id: str) -> bool:
+        existed = self._lookup(session_id) is not None
+        self._pending[session_id] = None
+        return existed
+
+    def __contains__(self, session_id: str) -> bool:
+        return self._lookup(session_id) is not None
+
+    def __len__(self) -> int:
+        return self._reader.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    # ---------- ghi nền ----------
+    def _write_batch(self, batch: Dict[str, tuple[str, int, float] | None]):
+        upserts = [(sid, *entry) for sid, entry in batch.items() if entry is not None]
+        deletes = [(sid,) for sid, entry in batch.items() if entry is None]
+        with self._writer:
+            if upserts:
+                self._writer.executemany(
+                    "INSERT INTO sessions (session_id, data, bytes, last_access) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(session_id) DO UPDATE SET data = excluded.data, "
+                    "bytes = excluded.bytes, last_access = excluded.last_access",
+                    upserts,
+                )
+            if deletes:
+                self._writer.executemany("DELETE FROM sessions WHERE session_id = ?", deletes)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write_batch, self._flushing)
+            self.flushes += 1
+            self.rows_flushed += len(self._flushing)
+        except Exception as e:
+            logging.error(f"SQLiteSessionStore flush error: {e}")
+            # Giữ lại các thay đổi chưa ghi được, thay đổi mới hơn trong _pending được ưu tiên
+            self._pending = {**self._flushing, **self._pending}
+        finally:
+            self._flushing = {}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    # ---------- dọn dẹp ----------
+    def _enforce_budget(self) -> tuple[int, int]:
+        cutoff = time.time() - self.ttl
+        with self._writer:
+            expired = self._writer.execute("DELETE FROM sessions WHERE last_access < ?", (cutoff,)).rowcount
+            count, total = self._writer.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions").fetchone()
+            evicted = 0
+            if count > self.max_entries or total > self.max_bytes:
+                # Loại các session ít dùng nhất cho tới khi về lại trong ngân sách
+                rows = self._writer.execute("SELECT session_id, bytes FROM sessions ORDER BY last_access").fetchall()
+                victims = []
+                for sid, size in rows:
+                    if count <= self.max_entries and total <= self.max_bytes:
+                        break
+                    victims.append((sid,))
+                    count -= 1
+                    total -= size
+                self._writer.executemany("DELETE FROM sessions WHERE session_id = ?", victims)
+                evicted = len(victims)
+        return expired, evicted
+
+    async def sweep(self) -> int:
+        await self.flush()
+        expired, evicted = await asyncio.to_thread(self._enforce_budget)
+        self.expirations += expired
+        self.evictions += evicted
+        return expired + evicted
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                removed = await self.sweep()
+                if removed:
+                    logging.info(f"SQLiteSessionStore: removed {removed} expired/evicted sessions.")
+            except Exception as e:
+                logging.error(f"SQLiteSessionStore sweep error: {e}")
+
+    def start(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self):
+        for task in (self._flusher, self._sweeper):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._flusher = self._sweeper = None
+        # Ghi nốt những gì còn trong hàng đợi trước khi tắt worker
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        count, total = self._reader.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions").fetchone()
+        return {
+            "backend": "sqlite",
+            "live_sessions": count,
+            "bytes_held": total,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "trimmed_messages": self.trimmed_messages,
+            "pending_writes": len(self._pending),
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def create_session_store(backend: str, ttl: timedelta, sqlite_path: str = "session_data/sessions.db", **kwargs):
+    """backend = "memory" (mặc định, 1 worker) hoặc "sqlite" (dùng chung giữa nhiều worker)."""
+    if backend == "sqlite":
+        return SQLiteSessionStore(sqlite_path, ttl, **kwargs)
+    if backend != "memory":
+        logging.warning(f"Unknown session backend '{backend}', falling back to memory.")
+    return SessionStore(ttl, **kwargs)
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import re
+import unicodedata
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", value)).strip()
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def request_key(model: str, messages: List[Dict[str, Any]], options: Dict[str, Any] | None = None, **extra) -> str:
+    """Key (model, prompt đã chuẩn hóa, options) cho các request Ollama giống nhau."""
+    payload = {"model": model, "messages": _normalize(messages), "options": options or {}, **extra}
+    return json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+
+
+class _SharedStream:
+    def __init__(self):
+        self.parts: List[Any] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.changed = asyncio.Condition()
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi giống nhau đang chạy: chỉ lời gọi đầu tiên thực sự chạy, các lời gọi sau
+    cùng key chờ và nhận chung kết quả. Nếu mọi bên chờ đều bỏ đi thì lời gọi chung bị hủy.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self._streams: Dict[Hashable, _SharedStream] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            self._waiters[task] = 0
+            task.add_done_callback(lambda t: self._calls.pop(key, None) if self._calls.get(key) is t else None)
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        self._waiters[task] += 1
+        try:
+            # shield: một bên chờ bị hủy không được hủy lời gọi chung của các bên khác
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if self._waiters[task] == 0:
+                del self._waiters[task]
+                if not task.done():
+                    # Không ai còn chờ: bỏ key ngay để lời gọi mới không nhập vào task đang bị hủy
+                    if self._calls.get(key) is task:
+                        del self._calls[key]
+                    task.cancel()
+                    # Chờ lời gọi chung dọn xong (trả slot của model) trước khi bên gọi trả lời client
+                    await asyncio.gather(task, return_exceptions=True)
+
+    async def stream(self, key: Hashable, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """Như do() nhưng cho stream: bên đến sau nhận lại các phần đã sinh rồi tiếp tục nhận trực tiếp."""
+        shared = self._streams.get(key)
+        if shared is None:
+            shared = _SharedStream()
+            self._streams[key] = shared
+            shared.task = asyncio.create_task(self._pump(key, shared, factory))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        shared.subscribers += 1
+        position = 0
+        try:
+            while True:
+                while position < len(shared.parts):
+                    yield shared.parts[position]
+                    position += 1
+                if shared.done:
+                    if shared.error is not None:
+                        raise shared.error
+                    return
+                async with shared.changed:
+                    await shared.changed.wait_for(lambda: position < len(shared.parts) or shared.done)
+        finally:
+            shared.subscribers -= 1
+            if shared.subscribers == 0 and not shared.done:
+                # Không ai còn nghe: bỏ key ngay để request mới không nhận phải stream đang bị hủy
+                if self._streams.get(key) is shared:
+                    del self._streams[key]
+                shared.task.cancel()
+                await asyncio.gather(shared.task, return_exceptions=True)
+
+    async def _pump(self, key: Hashable, shared: _SharedStream, factory: Callable[[], AsyncIterator[Any]]):
+        parts = factory()
+        try:
+            async for part in parts:
+                shared.parts.append(part)
+                async with shared.changed:
+                    shared.changed.notify_all()
+        except BaseException as e:
+            # Gồm cả CancelledError: các bên đang chờ phải được báo, không treo mãi
+            shared.error = e
+        finally:
+            # Đóng generator ngay để stream Ollama bên dưới trả kết nối về pool
+            await parts.aclose()
+            shared.done = True
+            if self._streams.get(key) is shared:
+                del self._streams[key]
+            async with shared.changed:
+                shared.changed.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._calls) + len(self._streams),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable
+
+logging.basicConfig(level=logging.INFO)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    """File upload vượt quá giới hạn kích thước (413)."""
+
+    def __init__(self, limit: int):
+        super().__init__(f"upload exceeds {limit} bytes")
+        self.limit = limit
+
+
+@dataclass
+class SpooledUpload:
+    """Upload đã được chép ra file tạm của ta (kèm SHA-256); file này được đưa thẳng cho OCR/trích xuất."""
+    path: str
+    sha256: str
+    size: int
+    taken: bool = False  # True khi một lượt xử lý đã nhận file và sẽ tự xóa nó
+    persistent: bool = False  # File của job nền: chỉ job xóa khi xong, remove() không làm gì
+
+    def remove(self):
+        if self.persistent:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _copy_and_hash(source: BinaryIO, path: str, max_bytes: int, chunk_size: int) -> tuple[str, int]:
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as out:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest(), size
+
+
+async def spool_upload(upload, directory: str, max_bytes: int, chunk_size: int = CHUNK_SIZE) -> SpooledUpload:
+    """
+    Chép `upload` (UploadFile của FastAPI) ra một file tạm trong `directory` theo từng chunk, tính SHA-256
+    ngay trong vòng chép đó, không bao giờ giữ cả file trong RAM. File vượt `max_bytes` bị từ chối
+    ngay khi biết (từ kích thước khai báo hoặc khi đọc tới đó) và file tạm được xóa.
+
+    Đây là lần ghi đĩa thứ hai: lúc endpoint chạy, Starlette đã đọc xong body multipart vào
+    SpooledTemporaryFile của nó (ra đĩa khi quá 1 MB). Ta chép lại để có file có đuôi đúng, sống lâu hơn
+    request (job nền) và tránh phải đọc thêm một lượt chỉ để băm. Cả vòng chép chạy trong một thread để
+    không chặn event loop.
+    """
+    declared = getattr(upload, "size", None)
+    if declared is not None and declared > max_bytes:
+        raise UploadTooLarge(max_bytes)
+
+    # Giữ đuôi file gốc: OCR / bộ trích xuất nhận dạng loại file theo đuôi
+    suffix = os.path.splitext(upload.filename or "")[1].lower()[:16] or ".bin"
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=directory)
+    os.close(fd)
+    try:
+        sha256, size = await asyncio.to_thread(_copy_and_hash, upload.file, path, max_bytes, chunk_size)
+    except BaseException:
+        os.remove(path)
+        raise
+    return SpooledUpload(path=path, sha256=sha256, size=size)
+
+
+class UploadSizeLimit:
+    """
+    Middleware ASGI thuần: từ chối (413) request tới `paths` có Content-Length vượt `max_bytes` trước khi
+    body được đọc. Không bọc `receive`, nên request.is_disconnected() của endpoint vẫn thấy client ngắt
+    (BaseHTTPMiddleware / @app.middleware("http") làm mất tín hiệu này).
+    """
+
+    def __init__(self, app, paths: Iterable[str], max_bytes: int, slack: int = 64 * 1024):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = max_bytes
+        # Phần overhead multipart (boundary, header của part) ngoài nội dung file
+        self.slack = slack
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.paths:
+            length = dict(scope["headers"]).get(b"content-length", b"")
+            if length.isdigit() and int(length) > self.max_bytes + self.slack:
+                body = json.dumps(
+                    {"error": f"File quá lớn (tối đa {self.max_bytes // (1024 * 1024)} MB)."}, ensure_ascii=False
+                ).encode("utf-8")
+                await send({
+                    "type": "http.response.start",
+                    "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+                })
+                await send({"type": "http.response.body", "body": body})
+                return
+        await self.app(scope, receive, send)
@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Server đọc cấu hình lúc import: backend giả (không cần Ollama), cache / job ghi vào thư mục tạm
+_DATA_DIR = tempfile.mkdtemp(prefix="skemi-tests-")
+os.environ.setdefault("INFERENCE_BACKEND", "fake")
+os.environ.setdefault("FAKE_TOKENS_PER_SEC", "400")
+os.environ.setdefault("FAKE_OUTPUT_TOKENS", "16")
+os.environ.setdefault("WARMUP_MODELS", "")
+os.environ.setdefault("MINDMAP_CACHE_PATH", os.path.join(_DATA_DIR, "mindmap_cache.db"))
+os.environ.setdefault("MINDMAP_JOBS_PATH", os.path.join(_DATA_DIR, "mindmap_jobs.db"))
+
+
+@pytest.fixture(scope="session")
+def server():
+    os.chdir(ROOT)  # Server dùng đường dẫn tương đối (tmp_files, Home.html)
+    import Server
+    return Server
+
+
+@pytest.fixture
+def client(server):
+    from fastapi.testclient import TestClient
+    with TestClient(server.app) as c:
+        yield c
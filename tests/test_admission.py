@@ -0,0 +1,108 @@
+import asyncio
+import uuid
+
+import pytest
+
+from Train.admission import AdmissionRejected, ModelLimiter
+
+
+def test_limits_concurrency_and_hands_slots_in_order():
+    async def main():
+        limiter = ModelLimiter("m", max_concurrency=2, max_queue=8, queue_timeout=5)
+        running, peak, order = 0, 0, []
+
+        async def call(i):
+            nonlocal running, peak
+            async with limiter.slot():
+                running += 1
+                peak = max(peak, running)
+                order.append(i)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*(call(i) for i in range(6)))
+        return limiter, peak, order
+
+    limiter, peak, order = asyncio.run(main())
+    assert peak == 2
+    assert order == list(range(6))
+    assert limiter.in_flight == 0 and limiter.queue_depth == 0
+    assert limiter.admitted == 6
+
+
+def test_rejects_when_queue_full():
+    async def main():
+        limiter = ModelLimiter("m", max_concurrency=1, max_queue=1, queue_timeout=5)
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.slot():
+                await release.wait()
+
+        holders = [asyncio.create_task(hold()) for _ in range(2)]  # 1 chạy + 1 chờ
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            async with limiter.slot():
+                pass
+        release.set()
+        await asyncio.gather(*holders)
+        return limiter, rejected.value
+
+    limiter, rejected = asyncio.run(main())
+    assert rejected.status_code == 429 and rejected.retry_after >= 1
+    assert limiter.rejected_full == 1
+    assert limiter.in_flight == 0
+
+
+def test_queue_timeout_and_cancelled_waiter_release_nothing():
+    async def main():
+        limiter = ModelLimiter("m", max_concurrency=1, max_queue=4, queue_timeout=0.05)
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.slot():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            async with limiter.slot():
+                pass
+
+        waiter = asyncio.create_task(limiter.slot().__aenter__())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        depth_after_cancel = limiter.queue_depth
+
+        release.set()
+        await holder
+        return limiter, rejected.value, depth_after_cancel
+
+    limiter, rejected, depth_after_cancel = asyncio.run(main())
+    assert rejected.status_code == 503
+    assert depth_after_cancel == 0
+    assert limiter.in_flight == 0
+
+
+def test_retry_after_without_samples_uses_per_slot_share_of_timeout():
+    limiter = ModelLimiter("m", max_concurrency=4, max_queue=8, queue_timeout=170)
+    # (0 chờ + 1) / 4 vòng × 170 / 4 giây
+    assert limiter.retry_after() == 11
+    limiter.service_times.extend([2.0, 2.0])
+    assert limiter.retry_after() == 1
+
+
+def test_ask_returns_429_with_retry_after_when_model_is_full(server, client, monkeypatch):
+    limiter = server.get_limiter(server.SMALL_MODEL_NAME)
+    monkeypatch.setattr(limiter, "in_flight", limiter.max_concurrency)
+    monkeypatch.setattr(limiter, "max_queue", 0)
+
+    session_id = uuid.uuid4().hex
+    response = client.post("/ask", json={"session_id": session_id, "question": "hello there"})
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    # Câu hỏi bị từ chối không nằm lại trong lịch sử
+    session = server.sessions.get(session_id)
+    assert not session or not session["messages"]
@@ -0,0 +1,71 @@
+import json
+import uuid
+
+PRO_QUESTION = "giải thích vì sao trời mưa"
+
+
+def run_batch(client, items, parallel=None):
+    response = client.post("/ask_batch", json={"items": items, "parallel": parallel})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    return {line["index"]: line for line in lines if line["type"] == "result"}, lines[-1]
+
+
+def test_each_item_is_routed_on_its_own(server, client, monkeypatch):
+    monkeypatch.setattr(server, "governor", None)
+    session = uuid.uuid4().hex
+    items = [
+        {"session_id": session, "question": "hi"},
+        {"session_id": session, "question": PRO_QUESTION},
+        {"session_id": session, "question": "hello"},
+    ]
+
+    results, done = run_batch(client, items)
+
+    assert [results[i]["model"] for i in range(3)] == ["gemmaSmall", "gemmaPro", "gemmaSmall"]
+    assert done["errors"] == 0 and done["groups"] == {"small": 2, "pro": 1}
+    # Câu cùng session chạy lần lượt, đúng thứ tự trong batch
+    questions = [m["content"] for m in server.sessions.get(session)["messages"] if m["role"] == "user"]
+    assert questions == ["hi", PRO_QUESTION, "hello"]
+
+
+def test_slots_follow_the_model_actually_called(server, client, monkeypatch):
+    monkeypatch.setattr(server, "governor", None)
+    active = {"small": 0, "pro": 0}
+    peak = {"small": 0, "pro": 0}
+    answer_question = server.answer_question
+
+    async def tracked(data, tier_decision=None):
+        tier = tier_decision[0]
+        active[tier] += 1
+        peak[tier] = max(peak[tier], active[tier])
+        try:
+            return await answer_question(data, tier_decision)
+        finally:
+            active[tier] -= 1
+
+    monkeypatch.setattr(server, "answer_question", tracked)
+    items = [{"session_id": uuid.uuid4().hex, "question": q} for q in ["hi", PRO_QUESTION] * 4]
+
+    results, done = run_batch(client, items, parallel=1)
+
+    assert done["errors"] == 0 and len(results) == 8
+    assert peak == {"small": 1, "pro": 1}
+
+
+def test_downgraded_item_runs_under_small_slot(server, client, monkeypatch):
+    tiers = []
+    answer_question = server.answer_question
+
+    async def tracked(data, tier_decision=None):
+        tiers.append(tier_decision[0])
+        return await answer_question(data, tier_decision)
+
+    monkeypatch.setattr(server, "answer_question", tracked)
+    monkeypatch.setattr(server, "govern_tier", lambda tier: ("small", None, {"action": "downgrade", "from": tier, "reason": "test"}))
+
+    results, done = run_batch(client, [{"session_id": uuid.uuid4().hex, "question": PRO_QUESTION}])
+
+    assert tiers == ["small"]
+    assert results[0]["model"].startswith("gemmaSmall")
+    assert done["groups"] == {"small": 1}
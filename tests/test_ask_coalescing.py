@@ -0,0 +1,42 @@
+import asyncio
+import uuid
+
+import httpx
+
+
+def post_concurrently(server, client, payloads):
+    async def main():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await asyncio.gather(*(http.post("/ask", json=p) for p in payloads))
+
+    # Chạy trên event loop của TestClient (nơi lifespan của app đang chạy)
+    return client.portal.call(main)
+
+
+def test_double_submit_in_one_session_shares_one_turn(server, client):
+    session = uuid.uuid4().hex
+    assert client.post("/ask", json={"session_id": session, "question": "hi"}).status_code == 200
+    payload = {"session_id": session, "question": "hello double click"}
+    before = server.ask_flight.coalesced
+
+    first, second = post_concurrently(server, client, [payload, {**payload, "question": " hello  double click "}])
+
+    assert first.status_code == second.status_code == 200
+    assert first.json()["answer"] == second.json()["answer"]
+    assert server.ask_flight.coalesced == before + 1
+    messages = server.sessions.get(session)["messages"]
+    assert [m["role"] for m in messages] == ["user", "assistant"] * 2
+    assert messages[2]["content"] == "hello double click"
+
+
+def test_same_question_in_other_sessions_is_not_coalesced(server, client):
+    sessions = [uuid.uuid4().hex, uuid.uuid4().hex]
+    before = server.ask_flight.coalesced
+
+    responses = post_concurrently(server, client, [{"session_id": s, "question": "hello twins"} for s in sessions])
+
+    assert all(r.status_code == 200 for r in responses)
+    assert server.ask_flight.coalesced == before
+    for session in sessions:
+        assert len(server.sessions.get(session)["messages"]) == 2
@@ -0,0 +1,69 @@
+import asyncio
+import uuid
+
+import pytest
+
+from Train import cancellation
+from Train.cancellation import ClientDisconnected, DeadlineExceeded, abort_stats, run_until_disconnected
+
+
+async def _never_disconnected():
+    return False
+
+
+async def _disconnected():
+    return True
+
+
+def test_disconnect_cancels_work(monkeypatch):
+    monkeypatch.setattr(cancellation, "DISCONNECT_POLL_INTERVAL", 0.01)
+    before = abort_stats.stats()["disconnected"].get("/test", 0)
+
+    async def main():
+        cancelled = asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with pytest.raises(ClientDisconnected):
+            await run_until_disconnected("/test", work(), _disconnected, deadline=5)
+        return cancelled.is_set()
+
+    assert asyncio.run(main())
+    assert abort_stats.stats()["disconnected"]["/test"] == before + 1
+
+
+def test_deadline_cancels_work_and_result_passes_through():
+    async def main():
+        with pytest.raises(DeadlineExceeded):
+            await run_until_disconnected("/test", asyncio.sleep(10), _never_disconnected, deadline=0.02)
+        return await run_until_disconnected("/test", asyncio.sleep(0, result="ok"), _never_disconnected, deadline=1)
+
+    assert asyncio.run(main()) == "ok"
+
+
+def test_ask_deadline_frees_slot_and_drops_question(server, client, monkeypatch):
+    monkeypatch.setattr(server, "ASK_DEADLINE", 0.001)
+    session_id = uuid.uuid4().hex
+
+    response = client.post("/ask", json={"session_id": session_id, "question": "hello again"})
+
+    assert response.status_code == 504
+    assert server.get_limiter(server.SMALL_MODEL_NAME).in_flight == 0
+    session = server.sessions.get(session_id)
+    assert not session or not session["messages"]
+    assert client.get("/stats").json()["aborts"]["deadline_exceeded"].get("/ask", 0) >= 1
+
+
+def test_ask_answers_within_deadline(server, client):
+    session_id = uuid.uuid4().hex
+
+    response = client.post("/ask", json={"session_id": session_id, "question": "hello again"})
+
+    assert response.status_code == 200
+    assert response.json()["answer"]
+    assert [m["role"] for m in server.sessions.get(session_id)["messages"]] == ["user", "assistant"]
@@ -0,0 +1,36 @@
+import uuid
+
+from Train.cascade import CascadeDecision
+
+
+def test_escalated_reply_is_served_from_cache(server, client, monkeypatch):
+    monkeypatch.setattr(server, "CHAT_ROUTING", "cascade")
+    monkeypatch.setattr(server.cascade, "decide", lambda *args, **kwargs: CascadeDecision(True, "low_confidence", 0.1))
+    question = f"explain cascade caching {uuid.uuid4().hex[:6]}"
+
+    # ExactReplyCache chỉ trả lời khi key đã đủ answers_per_key câu trả lời
+    for _ in range(server.small_reply_cache.answers_per_key):
+        body = client.post("/ask", json={"session_id": uuid.uuid4().hex, "question": question}).json()
+        assert body["route"]["path"] == ["small", "pro"]
+        assert "cached" not in body
+
+    body = client.post("/ask", json={"session_id": uuid.uuid4().hex, "question": question}).json()
+    assert body["cached"] is True
+
+
+def test_downgraded_reply_does_not_fill_pro_cache(server, monkeypatch):
+    stored = []
+
+    class RecordingCache:
+        def store(self, vector, language, tier, reply):
+            stored.append(tier)
+
+    monkeypatch.setattr(server, "semantic_cache", RecordingCache())
+    session = {"messages": [{"role": "user", "content": "q"}, {"role": "assistant", "content": "a"}]}
+    downgraded = server.ChatTurn("s", "q", session, [], "small", "en", 0.0, {"path": ["small"]}, None, "pro")
+    server.store_cached_reply(downgraded, [0.1], "a small answer")
+    assert stored == []
+
+    escalated = server.ChatTurn("s", "q", session, [], "pro", "en", 0.0, {"path": ["small", "pro"]}, None, "small")
+    server.store_cached_reply(escalated, [0.1], "a pro answer")
+    assert stored == ["small"]
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import uuid
+
+from Train.mindmap_jobs import MindmapJobs
+
+
+def make_upload(directory, content=b"image bytes"):
+    path = os.path.join(directory, f"{uuid.uuid4().hex}.png")
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+async def wait_finished(jobs, job_id, timeout=5.0):
+    async def poll():
+        while True:
+            job = await jobs.get(job_id)
+            if job.finished:
+                return job
+            await asyncio.sleep(0.01)
+
+    return await asyncio.wait_for(poll(), timeout)
+
+
+def test_job_interrupted_by_shutdown_is_rerun_after_restart(tmp_path):
+    db = str(tmp_path / "jobs.db")
+    upload = make_upload(tmp_path)
+
+    async def first_run():
+        running = asyncio.Event()
+
+        async def hang(job):
+            running.set()
+            await asyncio.sleep(60)
+
+        jobs = MindmapJobs(db, hang, workers=1)
+        await jobs.start()
+        job, created = await jobs.submit("hash-1", upload, 11)
+        await running.wait()
+        await jobs.close()
+        return job.id, created
+
+    job_id, created = asyncio.run(first_run())
+    assert created
+    # Tắt server giữa chừng: file upload còn đó để chạy lại
+    assert os.path.exists(upload)
+
+    async def second_run():
+        async def process(job):
+            with open(job.upload_path, "rb") as f:
+                return {"topic": f.read().decode()}
+
+        jobs = MindmapJobs(db, process, workers=1)
+        await jobs.start()
+        job = await wait_finished(jobs, job_id)
+        recovered = jobs.stats()["recovered"]
+        await jobs.close()
+        return job, recovered
+
+    job, recovered = asyncio.run(second_run())
+    assert recovered == 1
+    assert job.status == "done" and job.result == {"topic": "image bytes"}
+    # Job xong: file upload được xóa
+    assert not os.path.exists(upload)
+
+
+def test_orphaned_job_is_claimed_by_one_manager_only(tmp_path):
+    db = str(tmp_path / "jobs.db")
+    upload = make_upload(tmp_path)
+
+    async def main():
+        async def hang(job):
+            await asyncio.sleep(60)
+
+        original = MindmapJobs(db, hang, workers=1)
+        await original.start()
+        await original.submit("hash-2", upload, 11)
+        await asyncio.sleep(0.05)
+        await original.close()
+
+        managers = [MindmapJobs(db, hang, workers=1) for _ in range(2)]
+        await asyncio.gather(*(m.start() for m in managers))
+        counts = sorted(m.stats()["recovered"] for m in managers)
+        for m in managers:
+            await m.close()
+        return counts
+
+    assert asyncio.run(main()) == [0, 1]
+
+
+def test_job_with_missing_upload_fails_on_recovery(tmp_path):
+    db = str(tmp_path / "jobs.db")
+    upload = make_upload(tmp_path)
+
+    async def main():
+        async def hang(job):
+            await asyncio.sleep(60)
+
+        jobs = MindmapJobs(db, hang, workers=1)
+        await jobs.start()
+        job, _ = await jobs.submit("hash-3", upload, 11)
+        await asyncio.sleep(0.05)
+        await jobs.close()
+        os.remove(upload)
+
+        jobs = MindmapJobs(db, hang, workers=1)
+        await jobs.start()
+        recovered = await jobs.get(job.id)
+        await jobs.close()
+        return recovered
+
+    job = asyncio.run(main())
+    assert job.status == "failed"
+    assert "uploaded file is gone" in job.error
+
+
+def test_live_lease_is_not_stolen(tmp_path):
+    db = str(tmp_path / "jobs.db")
+    upload = make_upload(tmp_path)
+
+    async def main():
+        async def hang(job):
+            await asyncio.sleep(60)
+
+        owner = MindmapJobs(db, hang, workers=1, lease=60)
+        await owner.start()
+        await owner.submit("hash-4", upload, 11)
+        await asyncio.sleep(0.05)
+
+        other = MindmapJobs(db, hang, workers=1)
+        await other.start()
+        stolen = other.stats()["recovered"]
+        await other.close()
+        await owner.close()
+        return stolen
+
+    assert asyncio.run(main()) == 0
+    assert os.path.exists(upload)
@@ -0,0 +1,183 @@
+import asyncio
+import io
+import random
+import uuid
+
+import pytest
+
+PIL = pytest.importorskip("PIL")
+from PIL import Image, ImageDraw, PngImagePlugin
+
+from Train.mindmap_cache import MindmapCache, normalize_ocr_text
+from Train.perceptual_hash import BKTree, PerceptualIndex, hamming, image_hashes
+
+CLIMATE = ["Climate and the ocean", "Sea level rise", "Ocean heat content", "Coral bleaching"]
+PHOTOSYNTHESIS = ["Photosynthesis overview", "Chloroplast", "Light reactions make ATP", "Calvin cycle", "Glucose"]
+
+
+def slide(lines, fmt="PNG", crop=0, quality=90, marker=0):
+    """Slide cùng template (thanh tiêu đề + nền), chữ khác nhau; text OCR giả được nhúng vào metadata của file."""
+    img = Image.new("RGB", (800, 600), "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([0, 0, 800, 90], fill=(20, 60, 140))
+    draw.rectangle([0, 560, 800, 600], fill=(20, 60, 140))
+    draw.ellipse([690, 110, 780, 200], fill=(240, 180, 40))
+    for i, line in enumerate(lines):
+        draw.text((60, 130 + 60 * i), f"- {line}", fill="black")
+    if marker:
+        draw.rectangle([40, 110, 40 + marker, 120], fill=(200, 30, 30))
+    if crop:
+        img = img.crop((crop, crop, 800 - crop, 600 - crop))
+    out = io.BytesIO()
+    text = "\n".join(lines)
+    if fmt == "JPEG":
+        img.save(out, "JPEG", quality=quality, comment=text.encode("utf-8"))
+    else:
+        info = PngImagePlugin.PngInfo()
+        info.add_text("ocr", text)
+        img.save(out, "PNG", pnginfo=info)
+    return out.getvalue()
+
+
+def fake_ocr(path):
+    with Image.open(path) as img:
+        text = img.info.get("ocr") or img.info.get("comment", b"").decode("utf-8")
+    return text.split("\n") if text else []
+
+
+def hashes_of(data, tmp_path):
+    path = tmp_path / f"{uuid.uuid4().hex}.img"
+    path.write_bytes(data)
+    return image_hashes(str(path))
+
+
+def test_bk_tree_search_matches_brute_force():
+    rng = random.Random(7)
+    values = [rng.getrandbits(64) for _ in range(500)]
+    # Thêm vài hash rất gần nhau để có kết quả trong ngưỡng
+    values += [values[0] ^ (1 << bit) for bit in range(0, 64, 9)]
+    tree = BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, f"k{i}")
+
+    for query in values[:20] + [rng.getrandbits(64) for _ in range(20)]:
+        for max_distance in (0, 3, 8, 20):
+            expected = sorted((hamming(query, v), f"k{i}") for i, v in enumerate(values) if hamming(query, v) <= max_distance)
+            assert sorted(tree.search(query, max_distance)) == expected
+
+
+def test_index_candidates_sorted_and_discarded_keys_dropped():
+    index = PerceptualIndex(max_distance=4)
+    index.add("a", (0b0000, 0b0000))
+    index.add("b", (0b0011, 0b0001))
+    index.add("c", (0b1111, 0b1111))
+    assert index.candidates((0, 0)) == [("a", 0), ("b", 2), ("c", 4)]
+    index.discard("a")
+    assert index.nearest((0, 0)) == ("b", 2)
+
+
+def test_same_template_with_different_text_is_a_hash_candidate_but_rejected(tmp_path):
+    a = hashes_of(slide(CLIMATE), tmp_path)
+    b = hashes_of(slide(PHOTOSYNTHESIS), tmp_path)
+    distance = max(hamming(a[0], b[0]), hamming(a[1], b[1]))
+    # Đúng trường hợp cần kiểm tra nội dung: hash không phân biệt được hai slide
+    assert distance <= 8
+
+    async def main():
+        cache = MindmapCache(str(tmp_path / "c.db"), pipeline="p")
+        await cache.put("a", {"topic": "Climate"}, a, normalize_ocr_text(CLIMATE))
+        rejected = await cache.find_similar(b, normalize_ocr_text(PHOTOSYNTHESIS))
+        accepted = await cache.find_similar(b, normalize_ocr_text(CLIMATE))
+        unknown = await cache.find_similar(a, None)
+        stats = cache.stats()
+        cache.close()
+        return rejected, accepted, unknown, stats
+
+    rejected, accepted, unknown, stats = asyncio.run(main())
+    assert rejected is None
+    assert accepted is not None and accepted[0] == "a"
+    assert unknown is None  # Không OCR được -> không kiểm tra được nội dung -> không trả về
+    assert stats["near_rejected"] == 1 and stats["near_hits"] == 1
+
+
+@pytest.fixture
+def fake_mindmap(server, monkeypatch):
+    calls = []
+
+    async def generate(path, on_stage=None, ocr_lines=None):
+        calls.append(ocr_lines)
+        return [f"Topic {len(calls)}", [{"text": (ocr_lines or ["?"])[0]}]]
+
+    async def read_text(path):
+        return await asyncio.to_thread(fake_ocr, path)
+
+    monkeypatch.setattr(server, "call_mindmap_generation", generate)
+    monkeypatch.setattr(server, "read_image_text", read_text)
+    return calls
+
+
+def post(client, data, name):
+    response = client.post("/generate_mindmap", files={"file": (name, data)})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_recompressed_or_cropped_slide_is_served_from_cache(client, fake_mindmap):
+    lines = CLIMATE + [uuid.uuid4().hex]  # Không đụng entry của test khác trong cùng file cache
+    first = post(client, slide(lines), "a.png")
+    assert len(fake_mindmap) == 1
+    # OCR của lượt kiểm tra gần trùng được dùng lại, không OCR lần hai
+    assert fake_mindmap[0] == lines
+
+    recompressed = post(client, slide(lines, "JPEG", quality=45), "a.jpg")
+    cropped = post(client, slide(lines, crop=4), "a-crop.png")
+
+    assert len(fake_mindmap) == 1
+    for reply in (recompressed, cropped):
+        assert reply["near_duplicate"]["distance"] <= 8
+        assert reply["topic"] == first["topic"]
+
+
+def test_same_template_different_text_generates_its_own_mindmap(client, fake_mindmap):
+    tag = uuid.uuid4().hex
+    first = post(client, slide(CLIMATE + [tag]), "a.png")
+    other = post(client, slide(PHOTOSYNTHESIS + [tag]), "b.png")
+
+    assert len(fake_mindmap) == 2
+    assert "near_duplicate" not in other
+    assert other["topic"] != first["topic"]
+    assert other["mindmap_nodes"][0]["text"] == PHOTOSYNTHESIS[0]
+
+
+def test_concurrent_puts_with_evictions_and_near_lookups(tmp_path):
+    rng = random.Random(3)
+    base = rng.getrandbits(64)
+
+    async def main():
+        # Ngân sách nhỏ: gần như mỗi lần put đều loại entry khác (sửa chỉ mục trong thread)
+        cache = MindmapCache(str(tmp_path / "c.db"), memory_entries=8, max_bytes=2000, pipeline="p")
+        text = normalize_ocr_text(CLIMATE)
+
+        async def writer(i):
+            near = (base ^ (1 << (i % 64)), base ^ (1 << ((i * 7) % 64)))
+            await cache.put(f"k{i}", {"topic": "x" * 200, "i": i}, near, text)
+
+        async def reader():
+            found = []
+            for _ in range(50):
+                match = await cache.find_similar((base, base), text)
+                if match is not None:
+                    found.append(match)
+                await asyncio.sleep(0)
+            return found
+
+        results = await asyncio.gather(*(writer(i) for i in range(200)), *(reader() for _ in range(4)))
+        live = {key for key, _ in cache._index.candidates((base, base))}
+        stats = cache.stats()
+        cache.close()
+        return [m for found in results[200:] for m in found], live, stats
+
+    found, live, stats = asyncio.run(main())
+    assert stats["evictions"] > 0
+    assert found and all(payload["i"] == int(key[1:]) for key, _, payload, _ in found)
+    assert live  # Chỉ mục vẫn nhất quán sau các lần loại
@@ -0,0 +1,91 @@
+import asyncio
+from types import SimpleNamespace
+
+from Train import model_gemma_small_chat
+from Train.history import SUMMARY_INSTRUCTIONS, HistoryManager
+from Train.prompt_builder import LANGUAGE_DIRECTIVES, build_chat_messages
+
+STATIC = "static system prompt"
+
+
+class DictStore:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+
+def turn(content, role="user"):
+    return {"role": role, "content": content}
+
+
+def test_directive_goes_after_question_and_context_after_static_prompt():
+    messages = [
+        {"role": "system", "content": LANGUAGE_DIRECTIVES["en"]},
+        {"role": "system", "content": "summary"},
+        turn("hi"), turn("hello", "assistant"), turn("how are you?"),
+    ]
+
+    full = build_chat_messages(STATIC, messages)
+
+    assert full[0] == {"role": "system", "content": STATIC}
+    assert full[1] == {"role": "system", "content": "summary"}
+    assert full[2:4] == messages[2:4]
+    assert full[-1] == turn(f"how are you?\n\n({LANGUAGE_DIRECTIVES['en']})")
+
+
+def test_changing_language_keeps_history_prefix():
+    history = [turn("hi"), turn("hello", "assistant"), turn("next question")]
+
+    vi = build_chat_messages(STATIC, [{"role": "system", "content": LANGUAGE_DIRECTIVES["vi"]}] + history)
+    en = build_chat_messages(STATIC, [{"role": "system", "content": LANGUAGE_DIRECTIVES["en"]}] + history)
+
+    assert vi[:-1] == en[:-1]
+    assert vi[-1] != en[-1]
+
+
+def test_history_window_moves_in_blocks():
+    manager = HistoryManager(DictStore(), None, budgets={"small": 300}, summarize_threshold=200, trim_block=8)
+    session = {"messages": []}
+    starts = []
+    for i in range(40):
+        session["messages"].append(turn("x" * 100, "user" if i % 2 == 0 else "assistant"))
+        selected = manager.select_messages(session, "small")
+        assert selected[-1] is session["messages"][-1]
+        starts.append(len(session["messages"]) - len(selected))
+
+    assert all(start % 8 == 0 for start in starts)
+    # Điểm bắt đầu chỉ đổi khi cắt cả khối, không phải ở mỗi lượt
+    assert len(set(starts)) <= 40 // 8 + 1
+    assert starts == sorted(starts)
+
+
+def test_summarizer_gets_its_own_instructions_without_chat_persona(monkeypatch):
+    store = DictStore()
+    session = {"messages": [turn(f"question {i} " + "y" * 200, "user" if i % 2 == 0 else "assistant") for i in range(20)]}
+    store.set("s", session)
+    sent = []
+
+    async def fake_chat(model, messages, options=None, timeout=None, **kwargs):
+        sent.append(messages)
+        return SimpleNamespace(message=SimpleNamespace(content="**short** summary"))
+
+    monkeypatch.setattr(model_gemma_small_chat, "chat", fake_chat)
+    manager = HistoryManager(store, model_gemma_small_chat.call_gemma__small_summary,
+                             budgets={"small": 2000}, summarize_threshold=100, keep_recent=6)
+
+    async def main():
+        manager.maybe_schedule_summary("s", session)
+        await asyncio.gather(*manager._running.values())
+
+    asyncio.run(main())
+
+    assert len(sent) == 1
+    assert sent[0][0] == {"role": "system", "content": SUMMARY_INSTRUCTIONS}
+    assert all(model_gemma_small_chat.SYSTEM_PROMPT_FORMAT not in m["content"] for m in sent[0])
+    assert store.get("s")["summary"] == "short summary"
+    assert len(store.get("s")["messages"]) == 6
@@ -0,0 +1,28 @@
+import asyncio
+import inspect
+from datetime import timedelta
+
+import pytest
+
+from Train.session_store import SessionStore, SQLiteSessionStore
+
+
+def make_store(backend, tmp_path):
+    ttl = timedelta(seconds=0)
+    if backend == "sqlite":
+        return SQLiteSessionStore(str(tmp_path / "sessions.db"), ttl)
+    return SessionStore(ttl)
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_sweep_has_one_signature_for_both_backends(backend, tmp_path):
+    store = make_store(backend, tmp_path)
+    assert inspect.iscoroutinefunction(store.sweep)
+    store.set("idle", {"messages": [{"role": "user", "content": "hi"}]})
+
+    async def main():
+        await asyncio.sleep(0.01)
+        return await store.sweep()
+
+    assert asyncio.run(main()) == 1
+    assert "idle" not in store